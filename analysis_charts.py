@@ -0,0 +1,174 @@
+# Графики по результатам анализа. Данные для них заранее агрегируются и прореживаются,
+# поэтому число точек, отправляемых в браузер, не зависит от размера кабинета
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from analysis_core import StageProfiler
+
+# Ограничения на число точек
+CHART_MAX_POINTS = 5000
+CHART_GRID_BINS = 100
+PARETO_MAX_POINTS = 400
+
+# Категории рекомендаций (таблицы результата) в порядке приоритета и их цвета (как у карточек на странице)
+CHART_CATEGORIES = [
+    ('Удалить', 'delete_ads', '#DC2626'),
+    ('Масштабировать', 'scale_ads', '#16A34A'),
+    ('Оптимизировать', 'optimize_ads', '#F59E0B')
+]
+CATEGORY_OTHER = 'Наблюдать'
+CATEGORY_COLORS = {name: color for name, _, color in CHART_CATEGORIES}
+CATEGORY_COLORS[CATEGORY_OTHER] = '#3B82F6'
+CATEGORY_ORDER = [name for name, _, _ in CHART_CATEGORIES] + [CATEGORY_OTHER]
+
+def recommendation_categories(flags, category_flags):
+    # Одна категория на объявление: если сработали правила разных категорий, берется первая по приоритету.
+    # category_flags - биты правил каждой категории в наборе правил анализа
+    flags = np.asarray(flags)
+    conditions = [(flags & category_flags[key]) != 0 for _, key, _ in CHART_CATEGORIES]
+    names = np.select(conditions, [name for name, _, _ in CHART_CATEGORIES], default=CATEGORY_OTHER)
+    return pd.Categorical(names, categories=CATEGORY_ORDER)
+
+def scatter_points(points, max_points=CHART_MAX_POINTS, bins=CHART_GRID_BINS):
+    # Если объявлений больше max_points - одна точка на заполненную ячейку сетки
+    # (логарифм затрат x метрика в пределах 1-99 перцентилей) отдельно для каждой категории
+    if len(points) <= max_points:
+        return points.assign(count=1), False
+
+    x = np.log10(points['spent'])
+    low, high = points['metric'].quantile([0.01, 0.99])
+    y = points['metric'].clip(low, high)
+    cells = [
+        points['category'],
+        pd.cut(x, bins, labels=False).rename('x_bin'),
+        pd.cut(y, bins, labels=False).rename('y_bin')
+    ]
+    binned = points.assign(metric=y).groupby(cells, observed=True).agg(
+        id=('id', 'first'),
+        spent=('spent', 'mean'),
+        metric=('metric', 'mean'),
+        count=('spent', 'size')
+    ).reset_index(level='category').reset_index(drop=True)
+    if len(binned) > max_points:
+        binned = binned.nlargest(max_points, 'count')
+    return binned, True
+
+def pareto_curve(spent, max_points=PARETO_MAX_POINTS):
+    # Кривая концентрации затрат: доля объявлений (по убыванию затрат) -> доля всех затрат
+    values = np.sort(spent[np.isfinite(spent)].clip(min=0))[::-1]
+    if len(values) == 0 or values.sum() <= 0:
+        return pd.DataFrame({'ads_share': [0.0], 'spent_share': [0.0]}), None
+
+    spent_share = np.cumsum(values) / values.sum() * 100
+    ads_share = np.arange(1, len(values) + 1) / len(values) * 100
+    # Доля объявлений, на которые приходится 80% затрат
+    share_80 = ads_share[min(np.searchsorted(spent_share, 80), len(values) - 1)]
+
+    if len(values) > max_points:
+        positions = np.unique(np.linspace(0, len(values) - 1, max_points).round().astype(int))
+        ads_share = ads_share[positions]
+        spent_share = spent_share[positions]
+    curve = pd.DataFrame({'ads_share': np.append(0.0, ads_share), 'spent_share': np.append(0.0, spent_share)})
+    return curve, share_80
+
+def chart_data(analysis):
+    # Небольшие таблицы для графиков; сами результаты анализа не копируются
+    result = analysis['result_sorted']
+    has_revenue_data = analysis['summary_stats']['has_revenue_data']
+    metric = 'ROI, %' if has_revenue_data else 'Конверсия, %'
+    categories = recommendation_categories(
+        analysis['recommendation_flags'].reindex(result.index).to_numpy(), analysis['category_flags']
+    )
+
+    points = pd.DataFrame({
+        'id': result['ID объявления'].to_numpy(),
+        'spent': result['Затраты, ₽'].to_numpy(dtype='float64'),
+        'metric': result[metric].to_numpy(dtype='float64'),
+        'category': categories
+    })
+    # На логарифмической оси нет места нулевым затратам, а ROI без затрат не определен
+    points = points[(points['spent'] > 0) & np.isfinite(points['metric'])]
+    points, binned = scatter_points(points)
+
+    distribution = pd.DataFrame({
+        'category': categories,
+        'spent': result['Затраты, ₽'].to_numpy(dtype='float64')
+    }).groupby('category', observed=False)['spent'].agg(['size', 'sum'])
+
+    pareto, share_80 = pareto_curve(result['Затраты, ₽'].to_numpy(dtype='float64'))
+    return {
+        'metric': metric,
+        'points': points,
+        'binned': binned,
+        'distribution': distribution,
+        'pareto': pareto,
+        'share_80': share_80
+    }
+
+def scatter_figure(data):
+    fig = go.Figure()
+    for category in CATEGORY_ORDER:
+        points = data['points'][data['points']['category'] == category]
+        if points.empty:
+            continue
+        if data['binned']:
+            hover = "Затраты: %{x:,.0f} ₽<br>" + data['metric'] + ": %{y:.1f}<br>Объявлений: %{customdata}<extra></extra>"
+            customdata = points['count']
+            size = np.clip(4 + 2 * np.log2(points['count']), 4, 20)
+        else:
+            hover = "ID: %{customdata}<br>Затраты: %{x:,.0f} ₽<br>" + data['metric'] + ": %{y:.1f}<extra></extra>"
+            customdata = points['id'].astype(str)
+            size = 6
+        fig.add_trace(go.Scattergl(
+            x=points['spent'], y=points['metric'], mode='markers', name=category,
+            marker={'color': CATEGORY_COLORS[category], 'size': size, 'opacity': 0.7},
+            customdata=customdata, hovertemplate=hover
+        ))
+    title = f"Затраты и {data['metric']}"
+    if data['binned']:
+        title += " (точки сгруппированы, размер - число объявлений)"
+    fig.update_layout(title=title, xaxis_title="Затраты, ₽", yaxis_title=data['metric'], legend_title="Рекомендация")
+    fig.update_xaxes(type='log')
+    return fig
+
+def pareto_figure(data):
+    fig = go.Figure(go.Scatter(
+        x=data['pareto']['ads_share'], y=data['pareto']['spent_share'], mode='lines', fill='tozeroy',
+        line={'color': '#2563EB'},
+        hovertemplate="%{x:.1f}% объявлений - %{y:.1f}% затрат<extra></extra>"
+    ))
+    fig.add_hline(y=80, line_dash='dash', line_color='#666')
+    title = "Концентрация затрат"
+    if data['share_80'] is not None:
+        title += f": 80% затрат приходится на {data['share_80']:.1f}% объявлений"
+    fig.update_layout(title=title, xaxis_title="Доля объявлений, %", yaxis_title="Доля затрат, %")
+    return fig
+
+def distribution_figure(data):
+    distribution = data['distribution']
+    fig = go.Figure(go.Bar(
+        x=distribution.index.astype(str), y=distribution['size'],
+        marker_color=[CATEGORY_COLORS[category] for category in distribution.index],
+        customdata=distribution['sum'],
+        text=[f"{spent:,.0f} ₽" for spent in distribution['sum']], textposition='outside',
+        hovertemplate="%{x}: %{y} объявлений<br>Затраты: %{customdata:,.0f} ₽<extra></extra>"
+    ))
+    fig.update_layout(title="Распределение рекомендаций", xaxis_title="Рекомендация", yaxis_title="Объявлений")
+    return fig
+
+def analysis_figures(analysis):
+    # Фигуры строятся один раз и хранятся вместе с результатом анализа (кэш по хэшу входных данных)
+    figures = analysis.get('figures')
+    if figures is None:
+        profiler = StageProfiler()
+        with profiler.stage('charts'):
+            data = chart_data(analysis)
+            figures = {
+                'scatter': scatter_figure(data),
+                'pareto': pareto_figure(data),
+                'distribution': distribution_figure(data)
+            }
+        analysis['figures'] = figures
+        analysis['profile'] = analysis['profile'] + profiler.records
+    return figures
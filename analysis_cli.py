@@ -0,0 +1,441 @@
+# Пакетный режим анализа без streamlit:
+#   python analysis_cli.py --ads "выгрузки/ads_*.xlsx" --crm crm.csv --output-dir отчеты --format xlsx csv
+#   python analysis_cli.py --manifest accounts.csv --workers 8 --timeout 600 --output-dir отчеты
+#   python analysis_cli.py --ads ads.xlsx --crm crm.csv --rules правила_клиента.yaml
+#   python analysis_cli.py --ads ads.xlsx --crm crm.csv --rules robust
+#   python analysis_cli.py --ads ads.xlsx --crm crm.csv --id-pattern "vk=vk_ad_(\d+)" --id-pattern "utm=utm_content=(\d+)"
+#   python analysis_cli.py --store история.sqlite --crm crm_вчера.csv --crm-key "Номер заказа" --output-dir отчеты
+#   python analysis_cli.py --ads ads.xlsx --crm crm.csv --history analysis_history.sqlite --account клиент_1
+import argparse
+import datetime
+import glob
+import json
+import logging
+import math
+import os
+import re
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from analysis_core import (
+    ATTRIBUTION_PATTERNS,
+    EXCEL_ENGINES,
+    INPUT_CACHE_DIR,
+    REPORT_FRAMES,
+    MissingColumnsError,
+    StageProfiler,
+    ads_columns_mapping,
+    analyze,
+    attribution_report,
+    compile_attribution_pattern,
+    compute_analysis_key,
+    create_excel_report,
+    crm_columns_mapping,
+    load_table,
+    stage_totals
+)
+from analysis_history import DEFAULT_ACCOUNT, HISTORY_PATH, AnalysisHistory
+from analysis_timeseries import last_days_window
+from column_mapping import MAPPING_REGISTRY_PATH, MappingRegistry, needs_confirmation
+from incremental_store import IncrementalStore
+from recommendation_rules import RULE_PRESET_TEXTS, RuleSetError, compile_rule_set
+
+OUTPUT_FORMATS = ['xlsx', 'csv', 'parquet']
+
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern))
+        if not matched:
+            raise FileNotFoundError(f"Файлы не найдены: {pattern}")
+        paths.extend(path for path in matched if path not in paths)
+    return paths
+
+def read_tables(paths, excel_engine=None, cache_dir=None):
+    # Несколько файлов одного типа (например, выгрузки за разные дни) объединяются в одну таблицу
+    frames = [load_table(path, excel_engine, cache_dir) for path in paths]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+def analyze_files(ads_patterns, crm_patterns, excel_engine=None, cache_dir=None, registry=None, learn_mapping=False, rules=None, attribution_patterns=ATTRIBUTION_PATTERNS):
+    profiler = StageProfiler()
+    with profiler.stage('read', 'ads'):
+        ads_df = read_tables(expand_paths(ads_patterns), excel_engine, cache_dir)
+    with profiler.stage('read', 'crm'):
+        crm_df = read_tables(expand_paths(crm_patterns), excel_engine, cache_dir)
+    analysis = analyze(ads_df, crm_df, {'attribution_patterns': attribution_patterns}, registry=registry, rules=rules)
+    analysis['profile'] = profiler.records + analysis['profile']
+    if learn_mapping and registry is not None:
+        # Нечеткие сопоставления запоминаются: следующие выгрузки с теми же заголовками берутся из реестра
+        for resolution in analysis['data_info']['column_mapping'].values():
+            if needs_confirmation(resolution):
+                registry.remember(resolution)
+    return analysis
+
+def fuzzy_columns(analysis):
+    # Столбцы, найденные по похожему названию, - для проверки после пакетной обработки;
+    # необязательные без подтверждения (--learn-mapping или реестр) не используются
+    column_mapping = analysis['data_info'].get('column_mapping', {})
+    return '; '.join(
+        [f"{kind}.{key} = {resolution['columns'][key]}"
+         for kind, resolution in column_mapping.items()
+         for key, method in resolution['methods'].items() if method == 'fuzzy']
+        + [f"{kind}.{key} ? {header} (не использован)"
+           for kind, resolution in column_mapping.items()
+           for key, header in resolution['suggested'].items()]
+    )
+
+def analyze_store(store_path, ads_patterns=None, crm_patterns=None, ads_key=None, crm_key=None, excel_engine=None, registry=None, rules=None, attribution_patterns=ATTRIBUTION_PATTERNS):
+    # Инкрементальный режим: дельты добавляются к агрегатам в хранилище, отчет строится по агрегатам
+    profiler = StageProfiler()
+    with IncrementalStore(store_path, registry=registry, attribution_patterns=attribution_patterns) as store:
+        if ads_patterns:
+            with profiler.stage('read', 'ads: дельта'):
+                store.fold_ads(read_tables(expand_paths(ads_patterns), excel_engine), ads_key)
+        if crm_patterns:
+            with profiler.stage('read', 'crm: дельта'):
+                store.fold_crm(read_tables(expand_paths(crm_patterns), excel_engine), crm_key)
+        analysis = store.analysis(rules=rules)
+    analysis['profile'] = profiler.records + analysis['profile']
+    return analysis
+
+def files_bytes(paths):
+    # Содержимое входных файлов для ключа анализа; один файл - те же байты, что при загрузке в приложение
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    if len(contents) == 1:
+        return contents[0]
+    return b''.join(len(content).to_bytes(8, 'little') + content for content in contents)
+
+def history_analysis_key(analysis, ads_patterns=None, crm_patterns=None, rules_text=None, attribution_patterns=ATTRIBUTION_PATTERNS, store=False):
+    # Ключ для истории (как в приложении - compute_analysis_key): повторный запуск на тех же файлах с теми же
+    # настройками не добавляет запуск. В инкрементальном режиме дельта может уже быть в хранилище,
+    # поэтому ключ считается по накопленному результату
+    options = {
+        'rules': rules_text,
+        'attribution_patterns': [list(pattern) for pattern in attribution_patterns],
+        'columns': {kind: resolution['columns'] for kind, resolution in analysis['data_info'].get('column_mapping', {}).items()}
+    }
+    if store:
+        result_hash = pd.util.hash_pandas_object(analysis['result_sorted'], index=False).to_numpy().tobytes()
+        return compute_analysis_key(result_hash, b'', ads_columns_mapping, crm_columns_mapping, {**options, 'store': True})
+    return compute_analysis_key(
+        files_bytes(expand_paths(ads_patterns)), files_bytes(expand_paths(crm_patterns)),
+        ads_columns_mapping, crm_columns_mapping, options
+    )
+
+def json_value(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+def summary_to_json(summary_stats):
+    return {key: json_value(value) for key, value in summary_stats.items()}
+
+def baseline_to_json(baseline_stats):
+    # NaN (показатель не определен) -> null
+    return {key: None if pd.isna(value) else json_value(value) for key, value in baseline_stats.items()}
+
+def attribution_to_json(attribution):
+    report = attribution_report(attribution)
+    if report is None:
+        return None
+    return [{key: None if pd.isna(value) else json_value(value) for key, value in row.items()} for row in report.to_dict('records')]
+
+def parse_id_patterns(values):
+    # NAME=REGEX; шаблоны из командной строки заменяют встроенные, порядок задает приоритет
+    patterns = []
+    for value in values:
+        name, sep, pattern = value.partition('=')
+        if not sep or not name.strip() or not pattern:
+            raise ValueError(f"Шаблон '{value}': ожидается ИМЯ=РЕГУЛЯРНОЕ_ВЫРАЖЕНИЕ")
+        patterns.append((name.strip(), pattern))
+    try:
+        compile_attribution_pattern(tuple(patterns))
+    except re.error as e:
+        raise ValueError(f"Ошибка в шаблоне ID: {e}") from None
+    return patterns
+
+def write_outputs(analysis, output_dir, prefix, formats, last_days=None):
+    profiler = StageProfiler()
+    with profiler.stage('export', ', '.join(formats)):
+        written = write_output_files(analysis, output_dir, prefix, formats)
+        if last_days and analysis.get('timeseries') is not None:
+            written += write_last_days(analysis, output_dir, prefix, last_days)
+    analysis['profile'] = analysis['profile'] + profiler.records
+    return written
+
+def write_output_files(analysis, output_dir, prefix, formats):
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+
+    if 'xlsx' in formats:
+        path = os.path.join(output_dir, f"{prefix}.xlsx")
+        report = create_excel_report(
+            analysis['result_sorted'],
+            analysis['delete_ads'],
+            analysis['scale_ads'],
+            analysis['optimize_ads'],
+            analysis['summary_stats']
+        )
+        with open(path, 'wb') as f:
+            f.write(report.getvalue())
+        written.append(path)
+
+    for key, suffix in REPORT_FRAMES:
+        frame = analysis[key]
+        if 'csv' in formats:
+            path = os.path.join(output_dir, f"{prefix}_{suffix}.csv")
+            frame.to_csv(path, index=False, encoding='utf-8-sig')
+            written.append(path)
+        if 'parquet' in formats:
+            path = os.path.join(output_dir, f"{prefix}_{suffix}.parquet")
+            frame.to_parquet(path, index=False)
+            written.append(path)
+
+    return written
+
+def write_last_days(analysis, output_dir, prefix, days):
+    # Метрики по объявлениям за последние N дней и по дням внутри этого окна
+    window = last_days_window(analysis, days)
+    written = []
+    for key, suffix in (('window_ads', f"последние_{days}_дней"), ('window_periods', f"последние_{days}_дней_по_дням")):
+        path = os.path.join(output_dir, f"{prefix}_{suffix}.csv")
+        window[key].to_csv(path, index=False, encoding='utf-8-sig')
+        written.append(path)
+    return written
+
+# Поля summary_stats, которые суммируются по кабинетам
+ROLLUP_SUM_FIELDS = [
+    'total_leads', 'total_orders_reklama', 'total_orders_drugoe', 'total_spent',
+    'total_revenue_reklama', 'total_profit_reklama'
+]
+
+class AccountTimeout(Exception):
+    pass
+
+def raise_account_timeout(signum, frame):
+    raise AccountTimeout()
+
+def read_manifest(path):
+    # Манифест - CSV со столбцами account, ads, crm (пути или маски файлов)
+    manifest = pd.read_csv(path, dtype=str)
+    missing = [col for col in ('account', 'ads', 'crm') if col not in manifest.columns]
+    if missing:
+        raise ValueError(f"В манифесте нет столбцов: {missing}")
+    return manifest[['account', 'ads', 'crm']].to_dict('records')
+
+def safe_file_name(name):
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') or 'account'
+
+def run_account(task):
+    # Выполняется в дочернем процессе; таймаут обеспечивается SIGALRM там, где он есть
+    started = time.perf_counter()
+    result = {
+        'account': task['account'], 'status': 'ok', 'error': None, 'files': [], 'summary_stats': None,
+        'stage_seconds': {}, 'fuzzy_columns': None, 'attribution': None, 'history_run_id': None
+    }
+    use_alarm = task.get('timeout') and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, raise_account_timeout)
+        signal.alarm(math.ceil(task['timeout']))
+    try:
+        # Правила передаются текстом (скомпилированный набор не сериализуется) и компилируются один раз на процесс
+        rules = compile_rule_set(task['rules']) if task['rules'] else None
+        analysis = analyze_files(
+            [task['ads']], [task['crm']], task['excel_engine'], task['cache_dir'], task['registry'], task['learn_mapping'],
+            rules, task['attribution_patterns']
+        )
+        result['fuzzy_columns'] = fuzzy_columns(analysis) or None
+        account_name = safe_file_name(task['account'])
+        result['files'] = write_outputs(analysis, os.path.join(task['output_dir'], account_name), account_name, task['formats'])
+        result['summary_stats'] = summary_to_json(analysis['summary_stats'])
+        result['stage_seconds'] = stage_totals(analysis['profile'])
+        result['attribution'] = attribution_to_json(analysis['attribution'])
+        if task['history']:
+            analysis_key = history_analysis_key(analysis, [task['ads']], [task['crm']], task['rules'], task['attribution_patterns'])
+            result['history_run_id'] = AnalysisHistory(task['history']).record(analysis, task['account'], analysis_key=analysis_key)
+    except AccountTimeout:
+        result['status'] = 'timeout'
+        result['error'] = f"превышено время {task['timeout']} с"
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+def rollup_summaries(results):
+    # Сводка по всем успешно обработанным кабинетам
+    summaries = [r['summary_stats'] for r in results if r['status'] == 'ok']
+    rollup = {field: sum(s[field] for s in summaries) for field in ROLLUP_SUM_FIELDS}
+    rollup['accounts'] = len(summaries)
+    rollup['has_revenue_data'] = any(s['has_revenue_data'] for s in summaries)
+    rollup['avg_conversion_reklama'] = (
+        rollup['total_orders_reklama'] / rollup['total_leads'] * 100 if rollup['total_leads'] > 0 else 0
+    )
+    # ROI считается только по кабинетам, где есть выручка
+    revenue_spent = sum(s['total_spent'] for s in summaries if s['has_revenue_data'])
+    rollup['overall_roi_reklama'] = (
+        rollup['total_profit_reklama'] / revenue_spent * 100 if revenue_spent > 0 else 0
+    )
+    return rollup
+
+def run_batch(manifest, output_dir, formats, workers=None, timeout=None, excel_engine=None, cache_dir=None, registry=None, learn_mapping=False, rules_text=None, attribution_patterns=ATTRIBUTION_PATTERNS, history_path=None):
+    tasks = [
+        {
+            **entry, 'output_dir': output_dir, 'formats': formats, 'timeout': timeout,
+            'excel_engine': excel_engine, 'cache_dir': cache_dir, 'registry': registry, 'learn_mapping': learn_mapping,
+            'rules': rules_text, 'attribution_patterns': attribution_patterns, 'history': history_path
+        }
+        for entry in manifest
+    ]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_account, task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"{result['account']}: {result['status']} ({result['seconds']} с)", file=sys.stderr)
+            results.append(result)
+
+    results.sort(key=lambda r: r['account'])
+    rollup = rollup_summaries(results)
+
+    # Сводная таблица по кабинетам + итоговая строка
+    os.makedirs(output_dir, exist_ok=True)
+    rows = [
+        {
+            'account': r['account'], 'status': r['status'], 'error': r['error'], 'seconds': r['seconds'],
+            'fuzzy_columns': r['fuzzy_columns'],
+            'attribution_matched': sum(row['matched'] for row in r['attribution']) if r['attribution'] else None,
+            **(r['summary_stats'] or {}),
+            **{f"stage_{stage}": seconds for stage, seconds in r['stage_seconds'].items()}
+        }
+        for r in results
+    ]
+    rows.append({'account': 'ИТОГО', 'status': 'ok', **rollup})
+    rollup_path = os.path.join(output_dir, 'сводка_по_кабинетам.csv')
+    pd.DataFrame(rows).to_csv(rollup_path, index=False, encoding='utf-8-sig')
+
+    return {'rollup': rollup, 'accounts': results, 'rollup_file': rollup_path}
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Анализ эффективности рекламных объявлений без веб-интерфейса")
+    parser.add_argument('--ads', nargs='+', help="файлы или маски файлов рекламного кабинета")
+    parser.add_argument('--crm', nargs='+', help="файлы или маски файлов CRM")
+    parser.add_argument('--store', help="файл хранилища агрегатов для инкрементального режима (--ads/--crm - дельты)")
+    parser.add_argument('--ads-key', nargs='+', help="столбцы ключа строки рекламной дельты для исключения повторов")
+    parser.add_argument('--crm-key', nargs='+', help="столбцы ключа строки CRM-дельты для исключения повторов")
+    parser.add_argument('--manifest', help="CSV со столбцами account, ads, crm для пакетной обработки кабинетов")
+    parser.add_argument('--workers', type=int, default=None, help="число параллельных процессов (по умолчанию - число ядер)")
+    parser.add_argument('--timeout', type=float, default=None, help="ограничение времени на один кабинет, с")
+    parser.add_argument('--output-dir', default='.', help="папка для отчетов")
+    parser.add_argument('--prefix', default=None, help="начало имени файлов отчета")
+    parser.add_argument('--format', nargs='+', choices=OUTPUT_FORMATS, default=['xlsx'], dest='formats')
+    parser.add_argument('--excel-engine', choices=EXCEL_ENGINES, default='auto')
+    parser.add_argument('--cache-dir', default=INPUT_CACHE_DIR, help="каталог Parquet-кэша прочитанных входных файлов (нужен pyarrow)")
+    parser.add_argument('--last-days', type=int, default=None,
+                        help="дополнительно выгрузить метрики за последние N дней (если в файлах есть даты)")
+    parser.add_argument('--mapping-registry', default=MAPPING_REGISTRY_PATH,
+                        help="файл реестра подтвержденных сопоставлений столбцов")
+    parser.add_argument('--learn-mapping', action='store_true',
+                        help="сохранять в реестр столбцы, найденные по похожему названию")
+    parser.add_argument('--rules', default=None,
+                        help="файл правил рекомендаций (JSON или YAML) или имя встроенного набора ("
+                             + ', '.join(RULE_PRESET_TEXTS) + "); по умолчанию - default")
+    parser.add_argument('--id-pattern', action='append', default=None, metavar='NAME=REGEX',
+                        help="шаблон поиска ID объявления в источнике CRM с одной группой (можно несколько, "
+                             "заменяют встроенные: " + ', '.join(name for name, _ in ATTRIBUTION_PATTERNS) + ")")
+    parser.add_argument('--history', nargs='?', const=HISTORY_PATH, default=None,
+                        help=f"дописать результат в историю анализов (по умолчанию {HISTORY_PATH})")
+    parser.add_argument('--account', default=DEFAULT_ACCOUNT,
+                        help="название кабинета в истории (в пакетном режиме - столбец account манифеста)")
+    parser.add_argument('--no-cache', action='store_true', help="читать входные файлы без Parquet-кэша")
+    parser.add_argument('--verbose', action='store_true', help="писать в stderr JSON-записи по каждой стадии конвейера")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s', stream=sys.stderr)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    registry = MappingRegistry(args.mapping_registry)
+
+    rules_text = None
+    rules = None
+    if args.rules:
+        try:
+            if args.rules in RULE_PRESET_TEXTS:
+                rules_text = RULE_PRESET_TEXTS[args.rules]
+            else:
+                with open(args.rules, encoding='utf-8') as f:
+                    rules_text = f.read()
+            rules = compile_rule_set(rules_text)
+        except (OSError, RuleSetError) as e:
+            print(f"Ошибка в правилах рекомендаций: {e}", file=sys.stderr)
+            return 1
+
+    attribution_patterns = ATTRIBUTION_PATTERNS
+    if args.id_pattern:
+        try:
+            attribution_patterns = parse_id_patterns(args.id_pattern)
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            return 1
+
+    if args.manifest:
+        batch = run_batch(
+            read_manifest(args.manifest), args.output_dir, args.formats, args.workers, args.timeout, args.excel_engine,
+            cache_dir, registry, args.learn_mapping, rules_text, attribution_patterns, args.history
+        )
+        print(json.dumps({'rollup': batch['rollup'], 'rollup_file': batch['rollup_file']}, ensure_ascii=False, indent=2))
+        return 0 if all(r['status'] == 'ok' for r in batch['accounts']) else 1
+    if not args.store and (not args.ads or not args.crm):
+        parser.error("нужны --ads и --crm, --store или --manifest")
+
+    prefix = args.prefix or f"рекламный_анализ_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}"
+
+    try:
+        if args.store:
+            analysis = analyze_store(
+                args.store, args.ads, args.crm, args.ads_key, args.crm_key, args.excel_engine, registry, rules,
+                attribution_patterns
+            )
+        else:
+            analysis = analyze_files(
+                args.ads, args.crm, args.excel_engine, cache_dir, registry, args.learn_mapping, rules, attribution_patterns
+            )
+    except (FileNotFoundError, MissingColumnsError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+
+    if args.last_days and analysis.get('timeseries') is None:
+        print("В выгрузках нет дат - метрики за последние дни не рассчитаны", file=sys.stderr)
+    written = write_outputs(analysis, args.output_dir, prefix, args.formats, args.last_days)
+    history_run_id = None
+    if args.history:
+        analysis_key = history_analysis_key(analysis, args.ads, args.crm, rules_text, attribution_patterns, store=bool(args.store))
+        history_run_id = AnalysisHistory(args.history).record(analysis, args.account, analysis_key=analysis_key)
+    print(json.dumps({
+        'summary_stats': summary_to_json(analysis['summary_stats']),
+        'stage_seconds': stage_totals(analysis['profile']),
+        'baseline_stats': baseline_to_json(analysis['baseline_stats']),
+        'fuzzy_columns': fuzzy_columns(analysis) or None,
+        'attribution': attribution_to_json(analysis['attribution']),
+        'history_run_id': history_run_id,
+        'files': written
+    }, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
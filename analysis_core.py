@@ -0,0 +1,1026 @@
+# Ядро анализа эффективности рекламы: чтение, классификация, агрегация, рекомендации.
+# Модуль не зависит от streamlit и plotly и используется как приложением, так и пакетным режимом.
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from column_mapping import MAPPING_SAMPLE_ROWS, resolve_table_mapping
+from baseline_stats import baseline_statistics
+from confidence_intervals import INTERVAL_COLUMNS, confidence_intervals, order_value_moments
+from recommendation_rules import DEFAULT_RULE_SET
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Сопоставление столбцов входных файлов
+ads_columns_mapping = {
+    'id': ['ID объявления', 'ID', 'Ad ID', 'AdID', 'ID рекламы', 'ID кампании'],
+    'leads': ['Результат', 'Лиды', 'Leads', 'Клики', 'Clicks', 'Конверсии'],
+    'cost_per_lead': ['Цена за результат, ₽', 'Цена за результат', 'Cost per Result', 'CPL', 'Цена за лид'],
+    'spent': ['Потрачено всего, ₽', 'Потрачено', 'Затраты', 'Spent', 'Cost', 'Расходы'],
+    'date': ['Дата', 'День', 'Date', 'Day']
+}
+
+crm_columns_mapping = {
+    'clients': ['Клиенты', 'Клиент', 'Client', 'Customers', 'Заказчики'],
+    'id': ['ID объявления', 'ID', 'Ad ID', 'AdID', 'ID рекламы', 'Источник'],
+    'revenue': ['Сумма заказов', 'Сумма заказа', 'Сумма', 'Заказ', 'Revenue', 'Выручка', 'Amount'],
+    'date': ['Дата заказа', 'Дата создания', 'Дата', 'Date', 'Order Date', 'Created']
+}
+
+REQUIRED_ADS_COLUMNS = ['id', 'leads', 'spent']
+REQUIRED_CRM_COLUMNS = ['id', 'clients']
+
+DEFAULT_ANALYSIS_OPTIONS = {
+    'ads_columns_mapping': ads_columns_mapping,
+    'crm_columns_mapping': crm_columns_mapping
+}
+
+ANALYSIS_CACHE_SIZE = 8
+# Каталог кэша нормализованных входных таблиц в формате Parquet
+INPUT_CACHE_DIR = os.environ.get('ADS_ANALYSIS_CACHE_DIR', '.analysis_cache')
+CRM_CSV_CHUNK_SIZE = 200_000
+EXCEL_ENGINES = ['auto', 'calamine', 'openpyxl']
+
+# Столбцы, которые читаются как числа
+ADS_NUMERIC_COLUMNS = ('leads', 'cost_per_lead', 'spent')
+CRM_NUMERIC_COLUMNS = ('revenue',)
+
+def normalize_column_names(df):
+    rename_dict = {}
+    for col in df.columns:
+        clean_col = col.strip()
+        clean_col = re.sub(r'\s+', ' ', clean_col)
+        clean_col = re.sub(r'\s*,\s*', ', ', clean_col)
+        rename_dict[col] = clean_col
+    return df.rename(columns=rename_dict)
+
+def find_column(df, possible_names):
+    for name in possible_names:
+        if name in df.columns:
+            return name
+    return None
+
+# Классификация источников CRM
+SOURCE_TYPE_AD = 'Рекламное объявление'
+SOURCE_TYPE_OTHER = 'Другое'
+SOURCE_TYPES = pd.CategoricalDtype([SOURCE_TYPE_AD, SOURCE_TYPE_OTHER])
+
+# Источники, содержащие эти слова, никогда не считаются рекламными объявлениями
+ORGANIC_SOURCE_KEYWORDS = (
+    'organic', 'direct', 'none', 'null', 'undefined',
+    'сайт', 'site', 'прямой', 'рекомендация',
+    'recommendation', 'поиск', 'search', 'google', 'yandex',
+    'соцсети', 'social', 'vk', 'facebook', 'instagram',
+    'telegram', 'whatsapp', 'email', 'рассылка', 'unknown',
+    'не указано', 'другое', 'other'
+)
+
+@lru_cache(maxsize=None)
+def compile_keywords_pattern(keywords):
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+def classify_sources(sources, organic_keywords=ORGANIC_SOURCE_KEYWORDS):
+    # Классифицируются только уникальные значения, результат раскладывается обратно по кодам
+    codes, uniques = pd.factorize(sources, use_na_sentinel=True)
+    normalized = pd.Series(uniques, dtype=object).map(str).str.lower().str.strip()
+
+    is_ad = normalized.str.fullmatch(r'\d+')
+    if organic_keywords:
+        is_ad &= ~normalized.str.contains(compile_keywords_pattern(tuple(organic_keywords)))
+
+    unique_codes = np.where(is_ad.to_numpy(dtype=bool), 0, 1).astype(np.int8)
+    # Код -1 (пустое значение) попадает на последний элемент - 'Другое'
+    source_codes = np.append(unique_codes, np.int8(1))[codes]
+    return pd.Series(
+        pd.Categorical.from_codes(source_codes, dtype=SOURCE_TYPES),
+        index=sources.index,
+        name='Тип источника'
+    )
+
+# Категории рекомендаций: таблица результата -> действие правил, по которому объявление в нее попадает
+RECOMMENDATION_CATEGORIES = [
+    ('delete_ads', 'УДАЛИТЬ'),
+    ('scale_ads', 'МАСШТАБИРОВАТЬ'),
+    ('optimize_ads', 'ОПТИМИЗИРОВАТЬ')
+]
+
+def summary_rows(summary_stats):
+    rows = [
+        ("Всего лидов", summary_stats['total_leads']),
+        ("Заказов из рекламы", summary_stats['total_orders_reklama']),
+        ("Заказов из других источников", summary_stats['total_orders_drugoe']),
+        ("Общие затраты, ₽", summary_stats['total_spent']),
+        ("Конверсия, %", summary_stats['avg_conversion_reklama'])
+    ]
+    if summary_stats['has_revenue_data']:
+        rows += [
+            ("Общая выручка, ₽", summary_stats['total_revenue_reklama']),
+            ("Прибыль, ₽", summary_stats['total_profit_reklama']),
+            ("Общий ROI, %", summary_stats['overall_roi_reklama'])
+        ]
+    return rows
+
+def write_excel_sheet(workbook, sheet_name, df, header_format):
+    # В режиме constant_memory строки пишутся строго по порядку, по одной
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+def create_excel_report(result_sorted, delete_ads, scale_ads, optimize_ads, summary_stats):
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'nan_inf_to_errors': True})
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+
+    write_excel_sheet(workbook, 'Все объявления с рекомендациями', result_sorted, header_format)
+    if delete_ads is not None and not delete_ads.empty:
+        write_excel_sheet(workbook, 'УДАЛИТЬ', delete_ads, header_format)
+    if scale_ads is not None and not scale_ads.empty:
+        write_excel_sheet(workbook, 'МАСШТАБИРОВАТЬ', scale_ads, header_format)
+    if optimize_ads is not None and not optimize_ads.empty:
+        write_excel_sheet(workbook, 'ОПТИМИЗИРОВАТЬ', optimize_ads, header_format)
+    if summary_stats is not None:
+        summary = pd.DataFrame(summary_rows(summary_stats), columns=['Показатель', 'Значение'])
+        write_excel_sheet(workbook, 'Сводка', summary, header_format)
+
+    workbook.close()
+    output.seek(0)
+    return output
+
+# Таблицы результата и суффиксы файлов для CSV/Parquet
+REPORT_FRAMES = [
+    ('result_sorted', 'все_объявления'),
+    ('delete_ads', 'удалить'),
+    ('scale_ads', 'масштабировать'),
+    ('optimize_ads', 'оптимизировать')
+]
+
+def create_parquet_archive(result_sorted, delete_ads, scale_ads, optimize_ads, prefix='рекламный_анализ'):
+    # ZIP с таблицами результата в Parquet (требуется pyarrow); файлы уже сжаты, поэтому ZIP без сжатия
+    frames = dict(zip([key for key, _ in REPORT_FRAMES], [result_sorted, delete_ads, scale_ads, optimize_ads]))
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        for key, suffix in REPORT_FRAMES:
+            buffer = BytesIO()
+            frames[key].to_parquet(buffer, index=False)
+            archive.writestr(f"{prefix}_{suffix}.parquet", buffer.getvalue())
+    output.seek(0)
+    return output
+
+# Компактные типы данных
+INT32_MAX = np.iinfo(np.int32).max
+CRM_COMPACT_COLUMNS = CRM_NUMERIC_COLUMNS + ('Количество заказов', 'Общая выручка', 'Средний чек')
+# Агрегаты сумм заказов для доверительных интервалов ROI: число заказов с суммой, сумма и сумма квадратов.
+# Считаются при любом способе чтения CRM и убираются из таблицы после объединения
+ORDER_VALUE_COLUMNS = ['revenue_count', 'revenue_sum', 'revenue_sumsq']
+
+def to_int_key(ids):
+    # ID объявления как int64; None, если хотя бы одно значение не является целым числом
+    if pd.api.types.is_integer_dtype(ids):
+        return ids.astype('int64')
+    if pd.api.types.is_float_dtype(ids):
+        values = ids.to_numpy()
+        if np.isfinite(values).all() and (values == np.floor(values)).all():
+            return ids.astype('int64')
+        return None
+    text = ids.astype(str).str.strip()
+    if not text.str.fullmatch(r'\d+').all():
+        return None
+    try:
+        return text.astype('int64')
+    except (ValueError, OverflowError):
+        return None
+
+def normalize_id_keys(ads_ids, crm_ids):
+    # Общий ключ для объединения: int64, если это возможно для обеих таблиц, иначе строки
+    ads_key = to_int_key(ads_ids)
+    crm_key = to_int_key(crm_ids)
+    if ads_key is None or crm_key is None:
+        ads_key = ads_ids.astype(str).str.strip()
+        crm_key = crm_ids.astype(str).str.strip()
+    return ads_key, crm_key
+
+def canonical_ids(ids):
+    # Текстовый ID: '00123', ' 123 ', 123 и 123.0 дают один и тот же ключ
+    int_key = to_int_key(ids)
+    if int_key is not None:
+        return int_key.astype(str)
+    text = ids.astype(str).str.strip()
+    digits = text.str.fullmatch(r'\d+')
+    text[digits] = text[digits].str.lstrip('0').replace('', '0')
+    return text
+
+# Атрибуция источников CRM вида "utm_content=123456&utm_source=vk" или "vk_ad_123456": ID объявления
+# извлекается шаблонами и засчитывается, только если такое объявление есть в выгрузке кабинета.
+# В каждом шаблоне ровно одна группа - сам ID; при совпадении нескольких шаблонов побеждает стоящий раньше.
+# Число без метки не считается ID: телефоны, номера заказов и даты в источнике тоже состоят из цифр
+ATTRIBUTION_PATTERNS = [
+    ('utm_content', r'utm_content=(\d+)'),
+    ('utm_term', r'utm_term=(\d+)'),
+    ('utm_campaign', r'utm_campaign=(\d+)'),
+    ('ad_id', r'(?:^|[^a-z])ad(?:_?id)?[=_:-](\d+)'),
+    ('id', r'\bid[:=]?\s*(\d{5,})\b')
+]
+# Строки, в источнике которых не нашлось ни одного шаблона
+ATTRIBUTION_NO_PATTERN = 'нет шаблона'
+
+@lru_cache(maxsize=None)
+def compile_attribution_pattern(patterns):
+    # Один regex на все шаблоны - один проход str.extract. Каждая альтернатива ищет свой шаблон по всей строке
+    # (.*?), поэтому альтернативы проверяются в порядке приоритета, а не по позиции совпадения
+    for name, pattern in patterns:
+        if re.compile(pattern).groups != 1:
+            raise ValueError(f"Шаблон атрибуции '{name}' должен содержать ровно одну группу с ID объявления")
+    return re.compile(
+        '^(?:' + '|'.join(f'.*?(?:{pattern})' for _, pattern in patterns) + ')',
+        re.IGNORECASE | re.DOTALL
+    )
+
+def ad_id_index(ads_ids):
+    # Хэш-индекс ID объявлений выгрузки кабинета по каноническому тексту ID: поиск кандидата - O(1)
+    return pd.Index(pd.unique(canonical_ids(pd.Series(pd.unique(ads_ids.dropna()), dtype=object))))
+
+def attribution_candidates(sources, patterns=ATTRIBUTION_PATTERNS):
+    # Разбор уникальных значений источников шаблонами: коды строк (как у pd.factorize), номер сработавшего
+    # шаблона для каждого уникального значения (len(patterns) - ни один не подошел) и канонический ID-кандидат
+    codes, uniques = pd.factorize(sources)
+    extracted = pd.Series(uniques, dtype=object).astype(str).str.extract(compile_attribution_pattern(tuple(patterns)))
+    found = extracted.notna().to_numpy()
+    has_candidate = found.any(axis=1)
+    pattern_codes = np.where(has_candidate, found.argmax(axis=1), len(patterns))
+    candidates = pd.Series(extracted.to_numpy()[np.arange(len(uniques)), np.minimum(pattern_codes, len(patterns) - 1)], dtype=object)
+    if has_candidate.any():
+        candidates[has_candidate] = canonical_ids(candidates[has_candidate]).to_numpy()
+    return codes, pattern_codes, candidates
+
+def attribute_crm_sources(crm_data_clean, ad_index, patterns=ATTRIBUTION_PATTERNS):
+    # Источники, классифицированные как 'Другое', разбираются шаблонами (только уникальные значения);
+    # строки с найденным ID объявления получают этот ID и тип рекламного источника.
+    # Возвращает число строк и сопоставлений по шаблонам
+    pattern_names = [name for name, _ in patterns] + [ATTRIBUTION_NO_PATTERN]
+    attribution = pd.DataFrame({'rows': 0, 'matched': 0}, index=pd.Index(pattern_names, name='pattern'))
+    other = ((crm_data_clean['Тип источника'] == SOURCE_TYPE_OTHER) & crm_data_clean['id'].notna()).to_numpy()
+    if not patterns or not other.any():
+        return attribution
+
+    codes, pattern_codes, candidates = attribution_candidates(crm_data_clean['id'][other], patterns)
+    has_candidate = (pattern_codes < len(patterns))
+    positions = np.full(len(candidates), -1, dtype=np.int64)
+    if has_candidate.any():
+        positions[has_candidate] = ad_index.get_indexer(candidates[has_candidate])
+
+    row_patterns = pattern_codes[codes]
+    row_positions = positions[codes]
+    matched = row_positions >= 0
+    attribution['rows'] = np.bincount(row_patterns, minlength=len(pattern_names))
+    attribution['matched'] = np.bincount(row_patterns[matched], minlength=len(pattern_names))
+
+    if matched.any():
+        rows = np.flatnonzero(other)[matched]
+        ids = crm_data_clean['id'].astype(object)
+        ids.iloc[rows] = ad_index.to_numpy()[row_positions[matched]]
+        crm_data_clean['id'] = ids
+        source_types = crm_data_clean['Тип источника'].copy()
+        source_types.iloc[rows] = SOURCE_TYPE_AD
+        crm_data_clean['Тип источника'] = source_types
+    return attribution
+
+def attribution_report(attribution):
+    # Доля сопоставленных строк по каждому шаблону - для раздела "Информация" и вывода пакетного режима
+    if attribution is None:
+        return None
+    report = attribution.reset_index()
+    report['match_rate'] = (report['matched'] / report['rows'].where(report['rows'] > 0) * 100).round(1)
+    return report
+
+def downcast_numeric(values):
+    # Без потери точности: целые значения -> int32, если даже сумма всего столбца помещается в int32
+    # (тогда суммы по группам не переполняются). Дробные суммы в float32 теряют копейки - их не трогаем
+    if pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+        return values
+    array = values.to_numpy()
+    if not pd.api.types.is_integer_dtype(values):
+        if not (np.isfinite(array).all() and (array == np.floor(array)).all()):
+            return values
+    if np.abs(array).sum(dtype='float64') <= INT32_MAX:
+        return values.astype('int32')
+    return values
+
+def frame_memory(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def compact_frames(ads_data_clean, crm_data):
+    # Приведение ID к общему ключу и уменьшение числовых типов после классификации источников
+    memory = {'ads_before': frame_memory(ads_data_clean), 'crm_before': frame_memory(crm_data)}
+
+    # Строки без ID все равно отбрасываются при группировке
+    ads_data_clean = ads_data_clean[ads_data_clean['id'].notna()]
+    crm_data = crm_data[crm_data['id'].notna()].drop(columns='Тип источника', errors='ignore')
+
+    ads_key, crm_key = normalize_id_keys(ads_data_clean['id'], crm_data['id'])
+    ads_data_clean = ads_data_clean.assign(id=ads_key, **{
+        key: downcast_numeric(ads_data_clean[key]) for key in ADS_NUMERIC_COLUMNS if key in ads_data_clean.columns
+    })
+    crm_data = crm_data.assign(id=crm_key, **{
+        key: downcast_numeric(crm_data[key]) for key in CRM_COMPACT_COLUMNS if key in crm_data.columns
+    })
+    if 'clients' in crm_data.columns:
+        # Имена клиентов не нужны - для подсчета заказов достаточно признака заполненности
+        has_client = crm_data['clients'].notna()
+        crm_data['clients'] = has_client.astype('boolean').mask(~has_client)
+
+    memory['ads_after'] = frame_memory(ads_data_clean)
+    memory['crm_after'] = frame_memory(crm_data)
+    return ads_data_clean, crm_data, memory
+
+# Стадии конвейера в порядке выполнения и подписи для индикатора прогресса
+ANALYSIS_STAGES = [
+    ('read', "Чтение файлов..."),
+    ('normalize', "Обработка данных..."),
+    ('map_columns', "Поиск столбцов..."),
+    ('classify', "Классификация источников..."),
+    ('attribute', "Поиск ID объявлений в источниках..."),
+    ('compact', "Подготовка данных..."),
+    ('aggregate', "Анализ данных..."),
+    ('merge', "Объединение данных..."),
+    ('metrics', "Расчет метрик..."),
+    ('confidence', "Расчет доверительных интервалов..."),
+    ('stats', "Расчет базовых показателей..."),
+    ('recommend', "Формирование рекомендаций..."),
+    ('sort', "Сортировка..."),
+    ('timeseries', "Расчет динамики по датам..."),
+    ('charts', "Построение графиков..."),
+    ('export', "Формирование отчета...")
+]
+
+def current_rss():
+    # Текущий объем памяти процесса в байтах; None, если узнать нельзя
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class StageProfiler:
+    # Время и память по стадиям конвейера; прогресс сообщается на реальных границах стадий
+    def __init__(self, progress_callback=None, stages=ANALYSIS_STAGES):
+        self.progress_callback = progress_callback
+        self.stage_names = [name for name, label in stages]
+        self.stage_labels = dict(stages)
+        self.records = []
+        self.last_percent = 0
+
+    @contextmanager
+    def stage(self, name, detail=None):
+        if self.progress_callback is not None:
+            # Стадия может повторяться (чтение второго файла) - прогресс не должен идти назад
+            percent = int(self.stage_names.index(name) / len(self.stage_names) * 100)
+            self.last_percent = max(self.last_percent, percent)
+            self.progress_callback(self.last_percent, self.stage_labels[name])
+        rss_before = current_rss()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            rss_after = current_rss()
+            record = {
+                'stage': name,
+                'detail': detail,
+                'seconds': round(time.perf_counter() - started, 6),
+                'rss_mb': round(rss_after / 2**20, 1) if rss_after is not None else None,
+                'rss_delta_mb': round((rss_after - rss_before) / 2**20, 1) if rss_after is not None and rss_before is not None else None
+            }
+            self.records.append(record)
+            logger.info(json.dumps({'event': 'analysis_stage', **record}, ensure_ascii=False))
+
+    def finish(self, text="Анализ завершен!"):
+        if self.progress_callback is not None:
+            self.progress_callback(100, text)
+        return self.records
+
+def stage_totals(profile):
+    # Суммарное время по стадиям (стадия может встречаться несколько раз - для каждого файла)
+    totals = {}
+    for record in profile:
+        totals[record['stage']] = totals.get(record['stage'], 0) + record['seconds']
+    return totals
+
+class MissingColumnsError(ValueError):
+    # resolutions - найденные сопоставления по таблицам, чтобы пользователь мог их поправить
+    def __init__(self, message, resolutions=None):
+        super().__init__(message)
+        self.resolutions = resolutions
+
+@lru_cache(maxsize=None)
+def calamine_available():
+    return importlib.util.find_spec('python_calamine') is not None
+
+def resolve_excel_engine(file_name, preferred=None):
+    # calamine заметно быстрее openpyxl; если он не установлен - стандартный движок pandas
+    if file_name.endswith('.csv'):
+        return None
+    if preferred and preferred != 'auto':
+        return preferred
+    if calamine_available():
+        return 'calamine'
+    if file_name.endswith('.xlsx'):
+        return 'openpyxl'
+    return None
+
+@lru_cache(maxsize=None)
+def pyarrow_available():
+    return importlib.util.find_spec('pyarrow') is not None
+
+def read_table_header(file_bytes, file_name, excel_engine=None, nrows=0):
+    # Первая фаза: строка заголовков (и при необходимости первые строки для проверки содержимого столбцов)
+    if file_name.endswith('.csv'):
+        return pd.read_csv(BytesIO(file_bytes), nrows=nrows)
+    return pd.read_excel(BytesIO(file_bytes), nrows=nrows, engine=excel_engine)
+
+def header_column_names(header):
+    # Нормализованный заголовок и соответствие нормализованных имен исходным
+    normalized = normalize_column_names(header)
+    raw_columns = {}
+    for clean_col, raw_col in zip(normalized.columns, header.columns):
+        raw_columns.setdefault(clean_col, raw_col)
+    return normalized, raw_columns
+
+def coerce_numeric_columns(data, numeric_columns):
+    for key in numeric_columns:
+        if key in data.columns:
+            data[key] = pd.to_numeric(data[key], errors='coerce')
+    return data
+
+def read_table_columns(file_bytes, file_name, actual_columns, raw_columns, numeric_columns=(), excel_engine=None):
+    # Вторая фаза: читаются только сопоставленные столбцы, числовые приводятся явно
+    rename_dict = {raw_columns[v]: k for k, v in actual_columns.items()}
+    if file_name.endswith('.csv'):
+        data = pd.read_csv(BytesIO(file_bytes), usecols=list(rename_dict))
+    else:
+        data = pd.read_excel(BytesIO(file_bytes), usecols=list(rename_dict), engine=excel_engine)
+    data = data.rename(columns=rename_dict)
+    return coerce_numeric_columns(data, numeric_columns)
+
+def load_table(path, excel_engine=None, cache_dir=None):
+    # Полное чтение файла с диска (пакетный режим); с cache_dir - через кэш нормализованных таблиц
+    path = str(path)
+    if cache_dir is None:
+        if path.endswith('.csv'):
+            return pd.read_csv(path)
+        return pd.read_excel(path, engine=resolve_excel_engine(path, excel_engine))
+
+    with open(path, 'rb') as f:
+        file_bytes = f.read()
+
+    def read_normalized():
+        if path.endswith('.csv'):
+            return normalize_column_names(pd.read_csv(BytesIO(file_bytes)))
+        return normalize_column_names(pd.read_excel(BytesIO(file_bytes), engine=resolve_excel_engine(path, excel_engine)))
+
+    data, _ = cached_frame(cache_dir, input_cache_key(file_bytes, 'table'), read_normalized)
+    return data
+
+def input_cache_key(file_bytes, *parts):
+    # Ключ кэша входной таблицы: хэш содержимого файла + то, какие столбцы и как из него прочитаны
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(file_bytes)
+    hasher.update(json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+    return hasher.hexdigest()
+
+def parquet_safe_frame(data):
+    # Parquet не хранит столбцы со смешанными типами (числовые ID вместе с текстом).
+    # Непустые значения таких столбцов приводятся к строкам - классификация источников и ключи ID
+    # все равно работают со строковым представлением
+    if data.columns.has_duplicates:
+        return data
+    for col in data.columns[data.dtypes == object]:
+        values = data[col]
+        data[col] = values.where(values.isna(), values.astype(str))
+    return data
+
+def cached_frame(cache_dir, key, read_frame):
+    # Таблица из кэша (Parquet, чтение через memory map) или из read_frame() с сохранением в кэш.
+    # Возвращает (таблица, признак попадания в кэш); без pyarrow кэш не используется
+    if cache_dir is None or not pyarrow_available():
+        return read_frame(), False
+
+    path = os.path.join(cache_dir, f"{key}.parquet")
+    if os.path.exists(path):
+        try:
+            return pd.read_parquet(path, memory_map=True), True
+        except (OSError, ValueError) as e:
+            logger.warning("Поврежденный файл кэша %s: %s", path, e)
+
+    data = parquet_safe_frame(read_frame())
+    os.makedirs(cache_dir, exist_ok=True)
+    # Запись во временный файл и переименование: параллельные процессы не увидят недописанный файл
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        data.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except (OSError, ValueError, TypeError, NotImplementedError) as e:
+        logger.warning("Таблица не сохранена в кэш %s: %s", path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return data, False
+
+def read_cached_table_header(file_bytes, file_name, excel_engine=None, cache_dir=None, nrows=0):
+    # Для Excel даже чтение заголовка разбирает весь лист, поэтому заголовок тоже кэшируется
+    header, _ = cached_frame(
+        cache_dir, input_cache_key(file_bytes, 'header', nrows),
+        lambda: read_table_header(file_bytes, file_name, excel_engine, nrows)
+    )
+    return header
+
+def read_cached_table_columns(file_bytes, file_name, actual_columns, raw_columns, numeric_columns=(), excel_engine=None, cache_dir=None):
+    # Вторая фаза чтения через кэш: повторная загрузка того же файла не разбирает Excel/CSV заново
+    key = input_cache_key(file_bytes, 'columns', actual_columns, list(numeric_columns))
+    return cached_frame(
+        cache_dir, key,
+        lambda: read_table_columns(file_bytes, file_name, actual_columns, raw_columns, numeric_columns, excel_engine)
+    )
+
+def compute_analysis_key(ads_bytes, crm_bytes, ads_mapping, crm_mapping, options=None):
+    # Ключ кэша: содержимое обоих файлов + сопоставление столбцов + параметры анализа
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in (ads_bytes, crm_bytes):
+        hasher.update(len(part).to_bytes(8, 'little'))
+        hasher.update(part)
+    hasher.update(json.dumps([ads_mapping, crm_mapping, options or {}], ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+def aggregate_crm_csv(source, usecols_rename, has_revenue_data, chunksize=CRM_CSV_CHUNK_SIZE, ad_index=None, attribution_patterns=ATTRIBUTION_PATTERNS):
+    # Потоковое чтение CRM: в памяти держатся только частичные агрегаты по ID объявлений
+    id_column = next(raw for raw, key in usecols_rename.items() if key == 'id')
+    partial = None
+    attribution = None
+    crm_rows = 0
+    crm_reklama_rows = 0
+
+    reader = pd.read_csv(source, usecols=list(usecols_rename), dtype={id_column: str}, chunksize=chunksize)
+    for chunk in reader:
+        chunk = coerce_numeric_columns(chunk.rename(columns=usecols_rename), CRM_NUMERIC_COLUMNS)
+        chunk['Тип источника'] = classify_sources(chunk['id'])
+        if ad_index is not None:
+            chunk_attribution = attribute_crm_sources(chunk, ad_index, attribution_patterns)
+            attribution = chunk_attribution if attribution is None else attribution + chunk_attribution
+        is_ad = (chunk['Тип источника'] == SOURCE_TYPE_AD).to_numpy()
+        crm_rows += len(chunk)
+        crm_reklama_rows += int(is_ad.sum())
+
+        reklama = chunk[is_ad]
+        ad_ids = canonical_ids(reklama['id'])
+        if has_revenue_data:
+            part = pd.DataFrame({
+                'orders': reklama['clients'].notna(),
+                'revenue_sum': reklama['revenue'],
+                'revenue_count': reklama['revenue'].notna(),
+                'revenue_sumsq': reklama['revenue'] ** 2
+            }).groupby(ad_ids).sum()
+        else:
+            part = ad_ids.groupby(ad_ids).size().to_frame('orders')
+
+        partial = part if partial is None else partial.add(part, fill_value=0)
+
+    if partial is None:
+        partial = pd.DataFrame(columns=['orders'] + ORDER_VALUE_COLUMNS, dtype=float)
+
+    crm_reklama_agg = pd.DataFrame({'Количество заказов': partial['orders'].astype(int)})
+    if has_revenue_data:
+        crm_reklama_agg['Общая выручка'] = partial['revenue_sum'].round(2)
+        crm_reklama_agg['Средний чек'] = (partial['revenue_sum'] / partial['revenue_count'].replace(0, np.nan)).round(2)
+        crm_reklama_agg[ORDER_VALUE_COLUMNS] = partial[ORDER_VALUE_COLUMNS]
+
+    # Рекламные ID состоят только из цифр - приводим к числам, как при обычном чтении файла
+    try:
+        crm_reklama_agg.index = crm_reklama_agg.index.astype('int64')
+    except (ValueError, OverflowError):
+        pass
+    crm_reklama_agg = crm_reklama_agg.rename_axis('id').reset_index()
+
+    return {
+        'crm_reklama_agg': crm_reklama_agg,
+        'crm_rows': crm_rows,
+        'crm_reklama_rows': crm_reklama_rows,
+        'crm_drugoe_rows': crm_rows - crm_reklama_rows,
+        'attribution': attribution
+    }
+
+class AnalysisCache:
+    # Ограниченный LRU-кэш результатов анализа, общий для всех сессий процесса
+    def __init__(self, maxsize=ANALYSIS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+def resolve_columns(ads_header, crm_header, ads_mapping, crm_mapping, registry=None, overrides=None):
+    # Сопоставление столбцов обеих таблиц (см. column_mapping); возвращает подробности для показа пользователю
+    overrides = overrides or {}
+    resolutions = {
+        'ads': resolve_table_mapping(ads_header, ads_mapping, 'ads', registry, overrides.get('ads'), required=REQUIRED_ADS_COLUMNS),
+        'crm': resolve_table_mapping(crm_header, crm_mapping, 'crm', registry, overrides.get('crm'), required=REQUIRED_CRM_COLUMNS)
+    }
+
+    # Проверка обязательных столбцов
+    missing_ads = [col for col in REQUIRED_ADS_COLUMNS if col not in resolutions['ads']['columns']]
+    missing_crm = [col for col in REQUIRED_CRM_COLUMNS if col not in resolutions['crm']['columns']]
+
+    if missing_ads or missing_crm:
+        raise MissingColumnsError(f"Отсутствуют обязательные столбцы: {missing_ads + missing_crm}", resolutions)
+
+    return resolutions
+
+def select_columns(df, actual_columns, numeric_columns=()):
+    data = df[list(actual_columns.values())].rename(columns={v: k for k, v in actual_columns.items()})
+    return coerce_numeric_columns(data, numeric_columns)
+
+def split_crm_sources(crm_data_clean):
+    # Тип источника мог быть уже определен (и уточнен атрибуцией) - тогда классификация не повторяется
+    if 'Тип источника' not in crm_data_clean.columns:
+        crm_data_clean['Тип источника'] = classify_sources(crm_data_clean['id'])
+    crm_reklama = crm_data_clean[crm_data_clean['Тип источника'] == SOURCE_TYPE_AD].copy()
+    crm_drugoe = crm_data_clean[crm_data_clean['Тип источника'] == SOURCE_TYPE_OTHER].copy()
+    return crm_reklama, crm_drugoe
+
+def aggregate_crm(crm_reklama, has_revenue_data):
+    if has_revenue_data:
+        crm_reklama_agg = crm_reklama.groupby('id').agg({
+            'clients': 'count',
+            'revenue': ['sum', 'mean']
+        }).round(2)
+        crm_reklama_agg.columns = ['Количество заказов', 'Общая выручка', 'Средний чек']
+        revenue = crm_reklama['revenue'].astype(float)
+        crm_reklama_agg[ORDER_VALUE_COLUMNS] = pd.DataFrame({
+            'revenue_count': revenue.notna(),
+            'revenue_sum': revenue,
+            'revenue_sumsq': revenue ** 2
+        }).groupby(crm_reklama['id']).sum()
+        return crm_reklama_agg.reset_index()
+    return crm_reklama.groupby('id').size().reset_index(name='Количество заказов')
+
+def parse_dates(values):
+    # Даты выгрузок: ISO (2024-01-31) или русский формат (31.01.2024); разбираются только уникальные значения
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.normalize()
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    text = pd.Series(uniques, dtype=object).astype(str).str.strip()
+    parsed = pd.to_datetime(text, errors='coerce', format='ISO8601')
+    rest = parsed.isna()
+    if rest.any():
+        parsed[rest] = pd.to_datetime(text[rest], errors='coerce', dayfirst=True, format='mixed')
+    # Код -1 (пустое значение) попадает на добавленный NaT
+    dates = np.append(parsed.dt.normalize().to_numpy(), np.datetime64('NaT'))[codes]
+    return pd.Series(dates, index=values.index, name=values.name)
+
+def daily_aggregates(ads_data_clean, crm_reklama, has_revenue_data):
+    # Дневная таблица по объявлениям для режима динамики: по одному groupby по (день, ID) на выгрузку.
+    # Заказы считаются так же, как в aggregate_crm; строки без даты в динамику не попадают
+    ads_daily = ads_data_clean.assign(date=parse_dates(ads_data_clean['date'])).groupby(['date', 'id']).agg(
+        leads=('leads', 'sum'), spent=('spent', 'sum')
+    )
+    crm = crm_reklama.assign(date=parse_dates(crm_reklama['date']))
+    if has_revenue_data:
+        crm_daily = crm.groupby(['date', 'id']).agg(orders=('clients', 'count'), revenue=('revenue', 'sum'))
+        crm_daily.columns = ['Количество заказов', 'Общая выручка']
+    else:
+        crm_daily = crm.groupby(['date', 'id']).size().to_frame('Количество заказов')
+
+    daily = ads_daily.join(crm_daily, how='outer').fillna(0).reset_index()
+    # Как и в общем отчете, учитываются только объявления из рекламного кабинета
+    daily = daily[daily['id'].isin(ads_data_clean['id'])]
+    if daily.empty:
+        # Ни одна дата не распознана - режим динамики недоступен
+        return None
+    daily['Количество заказов'] = daily['Количество заказов'].astype('int64')
+    return daily.sort_values(['date', 'id'], kind='stable').reset_index(drop=True)
+
+# Названия столбцов в таблицах результата
+OUTPUT_COLUMNS_RENAME = {'id': 'ID объявления', 'leads': 'Лиды', 'spent': 'Затраты, ₽'}
+
+def add_metric_columns(merged_data, has_revenue_data):
+    # Метрики по суммам лидов, затрат, заказов и выручки - для всего периода и для отдельных окон
+    merged_data['Конверсия, %'] = (merged_data['Количество заказов'] / merged_data['leads'] * 100).round(2)
+    merged_data['CPO, ₽'] = (merged_data['spent'] / merged_data['Количество заказов'])
+    merged_data['CPO, ₽'] = merged_data['CPO, ₽'].replace([float('inf'), -float('inf')], 0).round(2)
+    merged_data['CPL, ₽'] = (merged_data['spent'] / merged_data['leads']).round(2)
+
+    if has_revenue_data:
+        merged_data['ROI, %'] = ((merged_data['Общая выручка'] - merged_data['spent']) / merged_data['spent'] * 100).round(2)
+        merged_data['Прибыль'] = (merged_data['Общая выручка'] - merged_data['spent']).round(2)
+        merged_data['ROMI'] = (merged_data['Общая выручка'] / merged_data['spent']).round(2)
+    return merged_data
+
+def build_analysis(ads_data_clean, crm_reklama_agg, crm_drugoe_rows, has_revenue_data, profiler=None, rules=None):
+    if profiler is None:
+        profiler = StageProfiler()
+    if rules is None:
+        rules = DEFAULT_RULE_SET
+
+    # Агрегация рекламных данных
+    with profiler.stage('aggregate', 'ads'):
+        agg_dict = {'leads': 'sum', 'spent': 'sum'}
+        if 'cost_per_lead' in ads_data_clean.columns:
+            agg_dict['cost_per_lead'] = 'mean'
+
+        ads_aggregated = ads_data_clean.groupby('id', as_index=False).agg(agg_dict)
+
+        # Расчет статистики
+        total_leads = ads_aggregated['leads'].sum()
+        total_orders_reklama = crm_reklama_agg['Количество заказов'].sum()
+        total_orders_drugoe = crm_drugoe_rows
+        total_spent = ads_aggregated['spent'].sum()
+
+        avg_conversion_reklama = (total_orders_reklama / total_leads * 100) if total_leads > 0 else 0
+
+        if has_revenue_data:
+            total_revenue_reklama = crm_reklama_agg['Общая выручка'].sum()
+            total_profit_reklama = total_revenue_reklama - total_spent
+            overall_roi_reklama = (total_profit_reklama / total_spent * 100) if total_spent > 0 else 0
+
+        summary_stats = {
+            'total_leads': total_leads,
+            'total_orders_reklama': total_orders_reklama,
+            'total_orders_drugoe': total_orders_drugoe,
+            'total_spent': total_spent,
+            'avg_conversion_reklama': avg_conversion_reklama,
+            'has_revenue_data': has_revenue_data,
+            'total_revenue_reklama': total_revenue_reklama if has_revenue_data else 0,
+            'total_profit_reklama': total_profit_reklama if has_revenue_data else 0,
+            'overall_roi_reklama': overall_roi_reklama if has_revenue_data else 0
+        }
+
+    # Объединение данных
+    with profiler.stage('merge'):
+        merged_data = pd.merge(ads_aggregated, crm_reklama_agg, on='id', how='left')
+
+        if has_revenue_data:
+            merged_data['Количество заказов'] = merged_data['Количество заказов'].fillna(0).astype('int32')
+            merged_data['Общая выручка'] = merged_data['Общая выручка'].fillna(0)
+            merged_data['Средний чек'] = merged_data['Средний чек'].fillna(0)
+            order_values = order_value_moments(*(merged_data.pop(column) for column in ORDER_VALUE_COLUMNS))
+        else:
+            merged_data['Количество заказов'] = merged_data['Количество заказов'].fillna(0).astype('int32')
+            order_values = None
+
+    # Расчет метрик
+    with profiler.stage('metrics'):
+        add_metric_columns(merged_data, has_revenue_data)
+
+        # Переименование для вывода
+        output_columns_rename = dict(OUTPUT_COLUMNS_RENAME)
+        if 'cost_per_lead' in ads_data_clean.columns:
+            output_columns_rename['cost_per_lead'] = 'Цена за лид, ₽'
+
+        merged_data_output = merged_data.rename(columns=output_columns_rename)
+
+    # Интервалы конверсии, CPO и ROI - для правил, которым нужна уверенность в метриках
+    with profiler.stage('confidence'):
+        intervals = confidence_intervals(
+            merged_data['leads'], merged_data['Количество заказов'], merged_data['spent'], order_values
+        )
+        for key, values in intervals.items():
+            merged_data_output[INTERVAL_COLUMNS[key]] = np.round(values, 2)
+
+    # Базовые показатели для порогов правил - все метрики за один проход
+    with profiler.stage('stats'):
+        baseline_stats = baseline_statistics(merged_data_output, has_revenue_data)
+
+    # Определение рекомендаций
+    with profiler.stage('recommend'):
+        recommendation_flags = rules.evaluate(merged_data_output, has_revenue_data, baseline_stats)
+        merged_data_output['Рекомендация'] = rules.recommendation_text(recommendation_flags)
+
+        # Создание категорий
+        category_flags = {key: rules.category_flags(action) for key, action in RECOMMENDATION_CATEGORIES}
+        delete_ads = merged_data_output[(recommendation_flags & category_flags['delete_ads']) != 0].copy()
+        scale_ads = merged_data_output[(recommendation_flags & category_flags['scale_ads']) != 0].copy()
+        optimize_ads = merged_data_output[(recommendation_flags & category_flags['optimize_ads']) != 0].copy()
+
+    # Сортировка
+    with profiler.stage('sort'):
+        if has_revenue_data:
+            sort_columns = ['ROI, %', 'Конверсия, %']
+        else:
+            sort_columns = ['Конверсия, %']
+
+        result_sorted = merged_data_output.sort_values(sort_columns, ascending=False)
+
+    frames = {'result_sorted': result_sorted, 'delete_ads': delete_ads, 'scale_ads': scale_ads, 'optimize_ads': optimize_ads}
+    return {
+        **frames,
+        'recommendation_flags': pd.Series(recommendation_flags, index=merged_data_output.index),
+        'category_flags': category_flags,
+        'summary_stats': summary_stats,
+        'baseline_stats': baseline_stats,
+        'category_totals': category_totals(frames, has_revenue_data)
+    }
+
+# Постраничный вывод таблиц результата
+TABLE_PAGE_SIZES = [50, 100, 250, 500]
+
+def category_totals(frames, has_revenue_data):
+    # Итоги по таблицам считаются один раз при анализе, а не при каждой перерисовке вкладок
+    totals = {}
+    for key, frame in frames.items():
+        totals[key] = {
+            'rows': len(frame),
+            'spent': float(frame['Затраты, ₽'].sum()),
+            'profit': float(frame['Прибыль'].sum()) if has_revenue_data else 0.0
+        }
+    return totals
+
+def table_sort_order(analysis, frame_key, sort_column, ascending, updating=None):
+    # Позиции строк в порядке сортировки по столбцу; вычисляются один раз и хранятся вместе с результатом.
+    # Для результата, общего для нескольких сессий, updating() - блокировка записи (AnalysisManager.updating):
+    # порядок считается без нее, а словарь заменяется копией - читатели без блокировки видят его целиком
+    key = (frame_key, sort_column, ascending)
+    order = analysis.get('sort_indices', {}).get(key)
+    if order is None:
+        values = analysis[frame_key][sort_column].reset_index(drop=True)
+        order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+        with updating() if updating is not None else nullcontext():
+            analysis['sort_indices'] = {**analysis.get('sort_indices', {}), key: order}
+    return order
+
+def table_page(analysis, frame_key, page, page_size, sort_column=None, ascending=True, updating=None):
+    # Только строки одной страницы (page считается с 0); без sort_column - порядок отчета
+    start = page * page_size
+    frame = analysis[frame_key]
+    if sort_column is None:
+        return frame.iloc[start:start + page_size]
+    return frame.iloc[table_sort_order(analysis, frame_key, sort_column, ascending, updating)[start:start + page_size]]
+
+def analyze_tables(profiler, ads_header, crm_header, ads_mapping, crm_mapping, read_ads, read_crm, stream_crm=None, registry=None, column_overrides=None, rules=None, attribution_patterns=ATTRIBUTION_PATTERNS):
+    # Общая часть анализа таблиц и загруженных файлов: поиск столбцов, классификация и агрегация CRM,
+    # метрики и рекомендации. read_ads/read_crm(actual_columns) возвращают (таблица, признак кэша);
+    # stream_crm(actual_columns, has_revenue_data, ad_index) - потоковая агрегация CRM вместо read_crm
+    with profiler.stage('map_columns'):
+        column_mapping = resolve_columns(ads_header, crm_header, ads_mapping, crm_mapping, registry, column_overrides)
+        ads_actual_columns = column_mapping['ads']['columns']
+        crm_actual_columns = column_mapping['crm']['columns']
+        has_revenue_data = 'revenue' in crm_actual_columns
+
+    # Чтение только нужных столбцов
+    input_cache = {'ads': False, 'crm': False}
+    with profiler.stage('read', 'ads: данные'):
+        ads_data_clean, input_cache['ads'] = read_ads(ads_actual_columns)
+
+    # Классификация источников и агрегация CRM
+    if stream_crm is not None:
+        with profiler.stage('classify', 'crm: потоковое чтение и агрегация'):
+            crm_stream = stream_crm(crm_actual_columns, has_revenue_data, ad_id_index(ads_data_clean['id']))
+        with profiler.stage('compact'):
+            ads_compact, crm_reklama_agg, memory = compact_frames(ads_data_clean, crm_stream['crm_reklama_agg'])
+        crm_rows = crm_stream['crm_rows']
+        crm_reklama_rows = crm_stream['crm_reklama_rows']
+        crm_drugoe_rows = crm_stream['crm_drugoe_rows']
+        attribution = crm_stream['attribution']
+    else:
+        with profiler.stage('read', 'crm: данные'):
+            crm_data_clean, input_cache['crm'] = read_crm(crm_actual_columns)
+        with profiler.stage('classify'):
+            crm_data_clean['Тип источника'] = classify_sources(crm_data_clean['id'])
+        with profiler.stage('attribute'):
+            attribution = attribute_crm_sources(crm_data_clean, ad_id_index(ads_data_clean['id']), attribution_patterns)
+            crm_reklama, crm_drugoe = split_crm_sources(crm_data_clean)
+        with profiler.stage('compact'):
+            ads_compact, crm_reklama, memory = compact_frames(ads_data_clean, crm_reklama)
+        with profiler.stage('aggregate', 'crm'):
+            crm_reklama_agg = aggregate_crm(crm_reklama, has_revenue_data)
+        crm_rows = len(crm_data_clean)
+        crm_reklama_rows = len(crm_reklama)
+        crm_drugoe_rows = len(crm_drugoe)
+
+    analysis = build_analysis(ads_compact, crm_reklama_agg, crm_drugoe_rows, has_revenue_data, profiler, rules)
+    analysis['attribution'] = attribution
+
+    # Динамика по датам - если даты есть в обеих выгрузках (при потоковом чтении CRM строки не сохраняются)
+    analysis['timeseries'] = None
+    if stream_crm is None and 'date' in ads_actual_columns and 'date' in crm_actual_columns:
+        with profiler.stage('timeseries'):
+            analysis['timeseries'] = daily_aggregates(ads_compact, crm_reklama, has_revenue_data)
+
+    # Сведения о загруженных данных для раздела "Информация"; вторая фаза читает все строки выгрузки,
+    # поэтому ads_rows - число строк исходного файла
+    analysis['data_info'] = {
+        'ads_count': len(ads_data_clean),
+        'ads_rows': len(ads_data_clean),
+        'ads_columns': len(ads_header.columns),
+        'crm_rows': crm_rows,
+        'crm_reklama_rows': crm_reklama_rows,
+        'crm_drugoe_rows': crm_drugoe_rows,
+        'memory': memory,
+        'input_cache': input_cache,
+        'column_mapping': column_mapping
+    }
+    return analysis
+
+def analyze(ads_df, crm_df, options=None, progress_callback=None, registry=None, rules=None):
+    # Анализ уже загруженных таблиц: основная точка входа для пакетного режима
+    options = {**DEFAULT_ANALYSIS_OPTIONS, **(options or {})}
+    profiler = StageProfiler(progress_callback)
+
+    # Нормализация названий столбцов
+    with profiler.stage('normalize'):
+        ads_data = normalize_column_names(ads_df)
+        crm_data = normalize_column_names(crm_df)
+
+    analysis = analyze_tables(
+        profiler, ads_data, crm_data, options['ads_columns_mapping'], options['crm_columns_mapping'],
+        lambda columns: (select_columns(ads_data, columns, ADS_NUMERIC_COLUMNS), False),
+        lambda columns: (select_columns(crm_data, columns, CRM_NUMERIC_COLUMNS), False),
+        registry=registry,
+        column_overrides=options.get('column_overrides'),
+        rules=rules,
+        attribution_patterns=options.get('attribution_patterns', ATTRIBUTION_PATTERNS)
+    )
+    # Строки исходной таблицы до выбора столбцов
+    analysis['data_info']['ads_rows'] = len(ads_data)
+    analysis['profile'] = profiler.finish()
+    return analysis
+
+def run_analysis_pipeline(ads_bytes, ads_name, crm_bytes, crm_name, ads_mapping, crm_mapping, crm_chunksize=None, excel_engine=None, cache_dir=None, registry=None, column_overrides=None, rules=None, attribution_patterns=ATTRIBUTION_PATTERNS, progress_callback=None):
+    # Анализ загруженных файлов: двухфазное чтение, при необходимости потоковая агрегация CRM
+    profiler = StageProfiler(progress_callback)
+    ads_engine = resolve_excel_engine(ads_name, excel_engine)
+    crm_engine = resolve_excel_engine(crm_name, excel_engine)
+
+    # Чтение заголовков (первая фаза)
+    with profiler.stage('read', 'ads: заголовок'):
+        ads_raw_header = read_cached_table_header(ads_bytes, ads_name, ads_engine, cache_dir, MAPPING_SAMPLE_ROWS)
+    with profiler.stage('read', 'crm: заголовок'):
+        crm_raw_header = read_cached_table_header(crm_bytes, crm_name, crm_engine, cache_dir, MAPPING_SAMPLE_ROWS)
+
+    with profiler.stage('normalize'):
+        ads_header, ads_raw_columns = header_column_names(ads_raw_header)
+        crm_header, crm_raw_columns = header_column_names(crm_raw_header)
+
+    # Вторая фаза - чтение сопоставленных столбцов
+    def read_ads(columns):
+        return read_cached_table_columns(ads_bytes, ads_name, columns, ads_raw_columns, ADS_NUMERIC_COLUMNS, ads_engine, cache_dir)
+
+    def read_crm(columns):
+        return read_cached_table_columns(crm_bytes, crm_name, columns, crm_raw_columns, CRM_NUMERIC_COLUMNS, crm_engine, cache_dir)
+
+    def stream_crm(columns, has_revenue_data, ad_index):
+        return aggregate_crm_csv(
+            BytesIO(crm_bytes),
+            {crm_raw_columns[v]: k for k, v in columns.items()},
+            has_revenue_data,
+            crm_chunksize,
+            ad_index,
+            attribution_patterns
+        )
+
+    crm_streaming = crm_chunksize is not None and crm_name.endswith('.csv')
+    analysis = analyze_tables(
+        profiler, ads_header, crm_header, ads_mapping, crm_mapping, read_ads, read_crm,
+        stream_crm if crm_streaming else None, registry, column_overrides, rules, attribution_patterns
+    )
+    analysis['data_info']['excel_engines'] = {'ads': ads_engine, 'crm': crm_engine}
+    analysis['profile'] = profiler.finish()
+    return analysis
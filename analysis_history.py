@@ -0,0 +1,315 @@
+# История анализов: каждый запуск (таблица результата и сводка) дописывается в локальную базу SQLite
+# с индексами по времени запуска, кабинету и ID объявления. Серии рекомендаций и смена рекомендаций
+# между соседними запусками считаются при записи, поэтому запросы по году ежедневных запусков
+# ("какие объявления получают УДАЛИТЬ три запуска подряд", динамика объявления, сводка по кабинетам)
+# идут по индексам и не требуют повторного чтения выгрузок:
+#   python analysis_history.py streaks --category delete_ads --min-runs 3
+#   python analysis_history.py trend 123456789 --account клиент_1
+#   python analysis_history.py rollup --period week --format csv
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+
+from analysis_core import RECOMMENDATION_CATEGORIES, canonical_ids
+from baseline_stats import METRIC_COLUMNS
+
+HISTORY_PATH = os.environ.get('ADS_ANALYSIS_HISTORY_PATH', 'analysis_history.sqlite')
+DEFAULT_ACCOUNT = 'default'
+
+# Категория рекомендаций -> бит в ad_results.actions
+CATEGORY_BITS = {key: 1 << position for position, (key, action) in enumerate(RECOMMENDATION_CATEGORIES)}
+SUMMARY_COLUMNS = (
+    'total_leads', 'total_orders_reklama', 'total_orders_drugoe', 'total_spent', 'avg_conversion_reklama',
+    'total_revenue_reklama', 'total_profit_reklama', 'overall_roi_reklama'
+)
+# Группировка сводки по кабинетам (формат strftime для времени запуска)
+ROLLUP_PERIODS = {'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+OUTPUT_FORMATS = ['table', 'csv', 'json']
+
+HISTORY_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    run_at TEXT NOT NULL,
+    account TEXT NOT NULL,
+    analysis_key TEXT,
+    has_revenue_data INTEGER NOT NULL,
+    {', '.join(f'{column} REAL' for column in SUMMARY_COLUMNS)},
+    ads INTEGER NOT NULL,
+    new_ads INTEGER,
+    dropped_ads INTEGER,
+    changed_ads INTEGER,
+    {', '.join(f'became_{key} INTEGER' for key in CATEGORY_BITS)},
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_account_time ON runs (account, run_at);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (analysis_key);
+CREATE TABLE IF NOT EXISTS recommendations (
+    recommendation_id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS ad_results (
+    run_id INTEGER NOT NULL,
+    ad_id TEXT NOT NULL,
+    {', '.join(f'{metric} REAL' for metric in METRIC_COLUMNS)},
+    actions INTEGER NOT NULL,
+    recommendation_id INTEGER NOT NULL,
+    {', '.join(f'streak_{key} INTEGER NOT NULL' for key in CATEGORY_BITS)},
+    PRIMARY KEY (run_id, ad_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ad_results_ad ON ad_results (ad_id, run_id);
+"""
+
+def action_bits(analysis, index):
+    # Битовая маска категорий рекомендаций для строк таблицы результата
+    flags = analysis['recommendation_flags'].reindex(index).to_numpy()
+    actions = np.zeros(len(index), dtype=np.int64)
+    for key, bit in CATEGORY_BITS.items():
+        actions[(flags & analysis['category_flags'][key]) != 0] |= bit
+    return actions
+
+def sql_value(value):
+    # NaN и бесконечности -> NULL, числа NumPy -> числа Python
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+class AnalysisHistory:
+    # Хранит только путь к файлу (как MappingRegistry): соединение открывается на каждую операцию,
+    # поэтому объект можно использовать из фоновых потоков и дочерних процессов
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.executescript(HISTORY_SCHEMA)
+        return conn
+
+    def query(self, sql, params=()):
+        conn = self.connect()
+        try:
+            return pd.read_sql_query(sql, conn, params=params)
+        finally:
+            conn.close()
+
+    def record(self, analysis, account=DEFAULT_ACCOUNT, run_at=None, analysis_key=None):
+        # Запуски одного кабинета ожидаются в порядке времени: серии считаются от последнего записанного запуска.
+        # Повторная запись того же анализа (тот же ключ и кабинет) не создает новый запуск
+        run_at = (run_at or datetime.datetime.now()).isoformat(timespec='seconds')
+        result = analysis['result_sorted']
+        ad_ids = canonical_ids(result['ID объявления'])
+        unique_rows = ~ad_ids.duplicated().to_numpy()
+        result = result[unique_rows]
+        ad_ids = ad_ids[unique_rows].to_numpy()
+        actions = action_bits(analysis, result.index)
+        summary_stats = analysis['summary_stats']
+
+        conn = self.connect()
+        try:
+            with conn:
+                if analysis_key is not None:
+                    row = conn.execute(
+                        "SELECT run_id FROM runs WHERE analysis_key = ? AND account = ?", (analysis_key, account)
+                    ).fetchone()
+                    if row is not None:
+                        return row[0]
+
+                previous_run = conn.execute(
+                    "SELECT run_id FROM runs WHERE account = ? AND run_at <= ? ORDER BY run_at DESC, run_id DESC LIMIT 1",
+                    (account, run_at)
+                ).fetchone()
+                previous = None
+                if previous_run is not None:
+                    previous = pd.read_sql_query(
+                        "SELECT ad_id, actions, " + ', '.join(f'streak_{key}' for key in CATEGORY_BITS)
+                        + " FROM ad_results WHERE run_id = ?", conn, params=(previous_run[0],), index_col='ad_id'
+                    )
+
+                # Серии: сколько запусков подряд (включая этот) объявление остается в категории
+                streaks = {}
+                churn = dict.fromkeys(['new_ads', 'dropped_ads', 'changed_ads'] + [f'became_{key}' for key in CATEGORY_BITS])
+                if previous is None:
+                    for key, bit in CATEGORY_BITS.items():
+                        streaks[key] = ((actions & bit) != 0).astype(np.int64)
+                else:
+                    matched = previous.reindex(ad_ids)
+                    seen = matched['actions'].notna().to_numpy()
+                    previous_actions = matched['actions'].fillna(0).to_numpy(dtype=np.int64)
+                    for key, bit in CATEGORY_BITS.items():
+                        streaks[key] = np.where(
+                            (actions & bit) != 0, matched[f'streak_{key}'].fillna(0).to_numpy(dtype=np.int64) + 1, 0
+                        )
+                        churn[f'became_{key}'] = int((((actions & bit) != 0) & ((previous_actions & bit) == 0)).sum())
+                    churn['new_ads'] = int((~seen).sum())
+                    churn['dropped_ads'] = int(len(previous) - seen.sum())
+                    churn['changed_ads'] = int((seen & (actions != previous_actions)).sum())
+
+                run_columns = (
+                    ['run_at', 'account', 'analysis_key', 'has_revenue_data'] + list(SUMMARY_COLUMNS) + ['ads']
+                    + list(churn) + ['summary']
+                )
+                run_values = (
+                    [run_at, account, analysis_key, int(bool(summary_stats['has_revenue_data']))]
+                    + [sql_value(summary_stats.get(column)) for column in SUMMARY_COLUMNS] + [len(ad_ids)]
+                    + list(churn.values())
+                    + [json.dumps({key: sql_value(value) for key, value in summary_stats.items()}, ensure_ascii=False)]
+                )
+                run_id = conn.execute(
+                    f"INSERT INTO runs ({', '.join(run_columns)}) VALUES ({', '.join('?' * len(run_columns))})", run_values
+                ).lastrowid
+
+                # Тексты рекомендаций повторяются от запуска к запуску - хранятся один раз
+                texts = result['Рекомендация'].astype(str)
+                conn.executemany("INSERT OR IGNORE INTO recommendations (text) VALUES (?)", ((text,) for text in texts.unique()))
+                text_ids = dict(conn.execute(
+                    f"SELECT text, recommendation_id FROM recommendations WHERE text IN ({', '.join('?' * texts.nunique())})",
+                    list(texts.unique())
+                ))
+
+                # NaN SQLite записывает как NULL; бесконечности (ROI при нулевых затратах) тоже не сохраняются
+                ad_rows = pd.DataFrame({'run_id': run_id, 'ad_id': ad_ids})
+                for metric, column in METRIC_COLUMNS.items():
+                    values = result[column].to_numpy(dtype=float) if column in result.columns else np.full(len(ad_ids), np.nan)
+                    ad_rows[metric] = np.where(np.isfinite(values), values, np.nan)
+                ad_rows['actions'] = actions
+                ad_rows['recommendation_id'] = texts.map(text_ids).to_numpy()
+                for key in CATEGORY_BITS:
+                    ad_rows[f'streak_{key}'] = streaks[key]
+                conn.executemany(
+                    f"INSERT INTO ad_results ({', '.join(ad_rows.columns)}) VALUES ({', '.join('?' * len(ad_rows.columns))})",
+                    ad_rows.itertuples(index=False, name=None)
+                )
+            return run_id
+        finally:
+            conn.close()
+
+    def runs(self, account=None, since=None):
+        where, params = self.run_filter(account, since)
+        return self.query(
+            "SELECT run_id, run_at, account, ads, has_revenue_data, " + ', '.join(SUMMARY_COLUMNS)
+            + f" FROM runs r {where} ORDER BY run_at", params
+        )
+
+    def ad_trend(self, ad_id, account=None, since=None):
+        # Метрики и рекомендация объявления по всем запускам - поиск по индексу (ad_id, run_id)
+        where, params = self.run_filter(account, since)
+        where = (where + " AND" if where else "WHERE") + " a.ad_id = ?"
+        trend = self.query(
+            "SELECT r.run_at, r.account, " + ', '.join(f'a.{metric}' for metric in METRIC_COLUMNS)
+            + ", rec.text AS recommendation FROM ad_results a JOIN runs r ON r.run_id = a.run_id "
+            "JOIN recommendations rec ON rec.recommendation_id = a.recommendation_id "
+            f"{where} ORDER BY r.run_at", params + [str(canonical_ids(pd.Series([ad_id])).iloc[0])]
+        )
+        return trend.rename(columns=METRIC_COLUMNS)
+
+    def streaks(self, category='delete_ads', min_runs=3, account=None):
+        # Объявления, которые в последнем запуске кабинета находятся в категории min_runs запусков подряд
+        if category not in CATEGORY_BITS:
+            raise ValueError(f"Неизвестная категория: {category}. Доступны: {', '.join(CATEGORY_BITS)}")
+        where, params = self.run_filter(account, None)
+        # Последний запуск каждого кабинета - по индексу (account, run_at); CROSS JOIN закрепляет порядок соединения,
+        # чтобы строки объявлений искались по первичному ключу запуска, а не перебором всей таблицы
+        streaks = self.query(
+            f"WITH latest_time AS (SELECT account, MAX(run_at) AS run_at FROM runs r {where} GROUP BY account), "
+            "latest AS ("
+            "  SELECT r.account, r.run_at, MAX(r.run_id) AS run_id FROM latest_time t"
+            "  JOIN runs r ON r.account = t.account AND r.run_at = t.run_at GROUP BY r.account"
+            ") "
+            f"SELECT l.account, l.run_at, a.ad_id, a.streak_{category} AS runs_in_row, a.spent, a.orders, a.roi, "
+            "rec.text AS recommendation FROM latest l CROSS JOIN ad_results a ON a.run_id = l.run_id "
+            "JOIN recommendations rec ON rec.recommendation_id = a.recommendation_id "
+            f"WHERE a.streak_{category} >= ? ORDER BY runs_in_row DESC, a.spent DESC", params + [min_runs]
+        )
+        return streaks.rename(columns=METRIC_COLUMNS)
+
+    def churn(self, account=None, since=None):
+        # Смена рекомендаций относительно предыдущего запуска того же кабинета (посчитана при записи)
+        where, params = self.run_filter(account, since)
+        return self.query(
+            "SELECT run_at, account, ads, new_ads, dropped_ads, changed_ads, "
+            + ', '.join(f'became_{key}' for key in CATEGORY_BITS) + f" FROM runs r {where} ORDER BY account, run_at",
+            params
+        )
+
+    def account_rollup(self, period=None, since=None):
+        # Суммы по запускам кабинета (при ежедневных выгрузках за день - итоги за период)
+        if period is not None and period not in ROLLUP_PERIODS:
+            raise ValueError(f"Неизвестный период: {period}. Доступны: {', '.join(ROLLUP_PERIODS)}")
+        where, params = self.run_filter(None, since)
+        group = "account" if period is None else f"account, strftime('{ROLLUP_PERIODS[period]}', run_at)"
+        period_column = "" if period is None else f"strftime('{ROLLUP_PERIODS[period]}', run_at) AS period, "
+        return self.query(
+            f"SELECT account, {period_column}COUNT(*) AS runs, MIN(run_at) AS first_run, MAX(run_at) AS last_run, "
+            "SUM(total_leads) AS leads, SUM(total_orders_reklama) AS orders, SUM(total_spent) AS spent, "
+            "SUM(total_revenue_reklama) AS revenue, SUM(total_profit_reklama) AS profit, "
+            "ROUND(SUM(total_profit_reklama) * 100.0 / NULLIF(SUM(CASE WHEN has_revenue_data THEN total_spent END), 0), 2) AS roi "
+            f"FROM runs r {where} GROUP BY {group} ORDER BY {group}", params
+        )
+
+    def run_filter(self, account, since):
+        conditions = []
+        params = []
+        if account is not None:
+            conditions.append("r.account = ?")
+            params.append(account)
+        if since is not None:
+            conditions.append("r.run_at >= ?")
+            params.append(pd.Timestamp(since).isoformat())
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+def build_parser():
+    # Общие параметры допускаются после названия запроса
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default=HISTORY_PATH, help="файл истории")
+    common.add_argument('--format', choices=OUTPUT_FORMATS, default='table', dest='output_format')
+    parser = argparse.ArgumentParser(description="Запросы к истории анализов")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    runs = commands.add_parser('runs', parents=[common], help="список запусков")
+    trend = commands.add_parser('trend', parents=[common], help="метрики и рекомендации объявления по запускам")
+    trend.add_argument('ad_id')
+    streaks = commands.add_parser('streaks', parents=[common], help="объявления в категории несколько запусков подряд")
+    streaks.add_argument('--category', choices=list(CATEGORY_BITS), default='delete_ads')
+    streaks.add_argument('--min-runs', type=int, default=3)
+    churn = commands.add_parser('churn', parents=[common], help="смена рекомендаций между соседними запусками")
+    rollup = commands.add_parser('rollup', parents=[common], help="сводка по кабинетам")
+    rollup.add_argument('--period', choices=list(ROLLUP_PERIODS), default=None)
+    for command in (runs, trend, streaks, churn):
+        command.add_argument('--account', default=None)
+    for command in (runs, trend, churn, rollup):
+        command.add_argument('--since', default=None, help="дата начала (YYYY-MM-DD)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    history = AnalysisHistory(args.db)
+    if args.command == 'runs':
+        table = history.runs(args.account, args.since)
+    elif args.command == 'trend':
+        table = history.ad_trend(args.ad_id, args.account, args.since)
+    elif args.command == 'streaks':
+        table = history.streaks(args.category, args.min_runs, args.account)
+    elif args.command == 'churn':
+        table = history.churn(args.account, args.since)
+    else:
+        table = history.account_rollup(args.period, args.since)
+
+    if args.output_format == 'csv':
+        table.to_csv(sys.stdout, index=False)
+    elif args.output_format == 'json':
+        print(table.to_json(orient='records', force_ascii=False, indent=2))
+    else:
+        print(table.to_string(index=False))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+# Серверный режим: один процесс приложения обслуживает много аналитиков. Менеджер общий для всех сессий:
+# - одновременно выполняется не больше max_running анализов, остальные ждут в очереди (FIFO) и видят свою позицию;
+# - результат хранится один раз на ключ анализа (compute_analysis_key) и разделяется сессиями; если такой же
+#   анализ уже считается для другой сессии, повторный запрос ждет его, а не запускает свой;
+# - память результатов вместе с оценкой памяти идущих расчетов держится в пределах бюджета: при нехватке
+#   вытесняются результаты, на которые не ссылается ни одна сессия, затем самые давно использованные;
+# - у каждой сессии свой бюджет: открытый ею результат и ее доля в резервах ее расчетов. Сессия, которая уже
+#   держит память, не может запустить новый расчет сверх бюджета (один расчет допускается всегда);
+# - сессии без активности дольше idle_seconds забываются, их результаты освобождаются.
+# Расчет выполняется в фоновом потоке (submit): сессия опрашивает состояние задачи по ее ID, может отменить ее
+# (задача останавливается, когда ее отменили все ждущие сессии) и после переподключения браузера снова
+# присоединиться к ней по ID. Поток, а не процесс: готовый результат остается
+# в памяти процесса и сразу попадает в общий кэш без копирования таблиц между процессами.
+import itertools
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from analysis_core import AnalysisCache
+
+MANAGER_MAX_RUNNING = int(os.environ.get('ADS_ANALYSIS_MAX_RUNNING', 2))
+MANAGER_MEMORY_BUDGET_MB = int(os.environ.get('ADS_ANALYSIS_MEMORY_BUDGET_MB', 4096))
+MANAGER_SESSION_BUDGET_MB = int(os.environ.get('ADS_ANALYSIS_SESSION_BUDGET_MB', 1024))
+MANAGER_IDLE_SECONDS = int(os.environ.get('ADS_ANALYSIS_IDLE_SECONDS', 1800))
+# Оценка пиковой памяти расчета: во столько раз больше суммарного размера входных файлов
+MEMORY_PER_INPUT_BYTE = 10
+# Как часто ожидающий расчет проверяет, не освободилось ли место
+QUEUE_POLL_SECONDS = 0.5
+
+# Состояния задачи
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+JOB_CANCELLED = 'cancelled'
+JOB_FINISHED = (JOB_DONE, JOB_ERROR, JOB_CANCELLED)
+
+class AnalysisCancelled(Exception):
+    pass
+
+class SessionMemoryExceeded(Exception):
+    pass
+
+def leaf_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        # У массива объектов (строковые ID) строки лежат отдельно от массива указателей
+        return int(pd.Series(value.ravel()).memory_usage(deep=True, index=False))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    # Фигура plotly: данные точек и оформление
+    return analysis_nbytes(value.to_plotly_json())
+
+# Таблицы, массивы, файлы и фигуры после создания не меняются - их размер запоминается по самому объекту
+LEAF_TYPES = (pd.DataFrame, pd.Series, pd.Index, np.ndarray, bytes, bytearray)
+
+def is_leaf(value):
+    return isinstance(value, LEAF_TYPES) or hasattr(value, 'to_plotly_json')
+
+def analysis_nbytes(value, sizes=None, previous=None):
+    # Память результата целиком: таблицы, массивы, готовые отчеты, фигуры, кэши окон и сортировок.
+    # Контейнеры обходятся заново при каждом подсчете (в них добавляются значения), размеры таблиц,
+    # массивов и фигур берутся из previous ({id: (объект, размер)} прошлого подсчета) и записываются в sizes
+    if sizes is None:
+        sizes = {}
+    if is_leaf(value):
+        if id(value) in sizes:
+            # Один и тот же объект в нескольких местах результата занимает память один раз
+            return 0
+        cached = (previous or {}).get(id(value))
+        nbytes = cached[1] if cached is not None and cached[0] is value else leaf_nbytes(value)
+        sizes[id(value)] = (value, nbytes)
+        return nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(analysis_nbytes(item, sizes, previous) for item in value.values())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(analysis_nbytes(item, sizes, previous) for item in value)
+    if isinstance(value, AnalysisCache):
+        return analysis_nbytes(value.values(), sizes, previous)
+    return sys.getsizeof(value)
+
+class AnalysisManager:
+    def __init__(self, max_running=MANAGER_MAX_RUNNING, memory_budget_mb=MANAGER_MEMORY_BUDGET_MB, idle_seconds=MANAGER_IDLE_SECONDS, session_budget_mb=MANAGER_SESSION_BUDGET_MB):
+        self.max_running = max(1, max_running)
+        self.memory_budget = memory_budget_mb * 2**20
+        self.session_budget = session_budget_mb * 2**20
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Condition()
+        # ключ -> {'analysis', 'nbytes', 'last_used'}; порядок - от давно использованных к недавним
+        self._entries = OrderedDict()
+        # ключ -> идущая задача; ID -> задача (и завершенные - пока их не заберут или не истечет idle_seconds)
+        self._jobs = {}
+        self._jobs_by_id = {}
+        self._queue = []
+        self._tickets = itertools.count()
+        # сессия -> {'last_seen', 'key'}: сессия видит один результат - последний открытый
+        self._sessions = {}
+
+    def touch(self, session_id):
+        # Вызывается при каждом запуске скрипта сессии
+        now = time.monotonic()
+        with self._lock:
+            self._sessions.setdefault(session_id, {'last_seen': now, 'key': None})['last_seen'] = now
+            self._evict_idle(now)
+
+    def get(self, key, session_id):
+        with self._lock:
+            return self._attach(key, session_id)
+
+    def release(self, session_id):
+        # Сессия закрыла результат (новый анализ): он остается в кэше, но может быть вытеснен первым
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id]['key'] = None
+
+    @contextmanager
+    def updating(self, key):
+        # Запись в общий результат из потока сессии (готовые отчеты, порядки сортировки): под блокировкой
+        # менеджера, после нее память результата пересчитывается. Тяжелые вычисления - до входа в блок
+        with self._lock:
+            yield
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._measure(entry)
+                self._make_room(0)
+
+    def refresh(self, key):
+        # Пересчет памяти результата после добавлений в него (файлы отчетов, фигуры, окна и сортировки таблиц)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._measure(entry)
+                self._make_room(0)
+
+    def submit(self, key, session_id, compute, input_bytes=0):
+        # compute(progress_callback) выполняется в фоновом потоке. Если такой же анализ уже идет,
+        # сессия присоединяется к нему. Возвращает ID задачи; SessionMemoryExceeded - если сессия
+        # уже держит память и новый расчет не укладывается в ее бюджет
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or session_id not in job['sessions']:
+                # Новый анализ заменяет открытый в сессии результат - он больше не считается за сессией
+                session = self._sessions.setdefault(session_id, {'last_seen': time.monotonic(), 'key': None})
+                session['key'] = None
+                held = self._session_bytes(session_id)
+                share = job['reserved'] / (len(job['sessions']) + 1) if job else input_bytes * MEMORY_PER_INPUT_BYTE
+                if held and held + share > self.session_budget:
+                    raise SessionMemoryExceeded(
+                        f"Сессия уже использует {held / 2**20:.0f} МБ из {self.session_budget / 2**20:.0f} МБ: "
+                        f"дождитесь окончания текущего анализа или отмените его"
+                    )
+            if job is None:
+                job = {
+                    'id': uuid.uuid4().hex, 'key': key, 'status': JOB_QUEUED, 'percent': 0, 'text': "",
+                    'position': None, 'error': None, 'reserved': input_bytes * MEMORY_PER_INPUT_BYTE,
+                    'started': False, 'finished_at': None, 'sessions': set(), 'cancel_votes': set(),
+                    'cancel': threading.Event(), 'done': threading.Event()
+                }
+                self._jobs[key] = job
+                self._jobs_by_id[job['id']] = job
+                threading.Thread(target=self._execute, args=(job, compute), name=f"analysis-{job['id'][:8]}", daemon=True).start()
+            job['sessions'].add(session_id)
+            return job['id']
+
+    def job_status(self, job_id):
+        # Снимок состояния задачи для отображения; None - задача неизвестна (например, процесс перезапущен)
+        with self._lock:
+            job = self._jobs_by_id.get(job_id)
+            if job is None:
+                return None
+            return {name: job[name] for name in ('id', 'key', 'status', 'percent', 'text', 'position', 'error')}
+
+    def join(self, job_id, session_id):
+        # Сессия, открытая по ссылке на задачу (после переподключения браузера), ждет ее наравне с остальными
+        with self._lock:
+            job = self._jobs_by_id.get(job_id)
+            if job is not None and job['status'] not in JOB_FINISHED:
+                job['sessions'].add(session_id)
+
+    def cancel(self, job_id, session_id):
+        # Задача отменяется, когда ее отменили все ждущие сессии; до тех пор она выполняется для остальных.
+        # Возвращает True, если задача действительно отменена
+        with self._lock:
+            job = self._jobs_by_id.get(job_id)
+            if job is None or job['status'] in JOB_FINISHED or session_id not in job['sessions']:
+                return False
+            job['cancel_votes'].add(session_id)
+            return self._cancel_unwanted(job)
+
+    def _cancel_unwanted(self, job):
+        # Задачу без голосов за отмену (все ждавшие сессии забыты) не трогаем - ее результат попадет в кэш
+        if job['cancel'].is_set() or not job['cancel_votes'] or not job['sessions'] <= job['cancel_votes']:
+            return False
+        job['cancel'].set()
+        self._lock.notify_all()
+        return True
+
+    def wait(self, job_id, timeout=None):
+        # Ожидание задачи вне приложения (скрипты, проверки): результат или исключение расчета
+        with self._lock:
+            job = self._jobs_by_id[job_id]
+        job['done'].wait(timeout)
+        if job['status'] == JOB_ERROR:
+            raise job['error']
+        if job['status'] == JOB_CANCELLED:
+            raise AnalysisCancelled(f"Задача {job_id} отменена")
+        with self._lock:
+            entry = self._entries.get(job['key'])
+            return entry['analysis'] if entry else None
+
+    def _execute(self, job, compute):
+        analysis = None
+        try:
+            self._admit(job)
+            analysis = compute(lambda percent, text: self._progress(job, percent, text))
+        except AnalysisCancelled:
+            job['status'] = JOB_CANCELLED
+        except Exception as error:
+            job['status'] = JOB_ERROR
+            job['error'] = error
+        finally:
+            # Первый подсчет памяти обходит все таблицы - до блокировки, пока результат виден только этому потоку
+            sizes = {}
+            nbytes = analysis_nbytes(analysis, sizes) if analysis is not None else 0
+            with self._lock:
+                del self._jobs[job['key']]
+                if analysis is not None:
+                    now = time.monotonic()
+                    self._entries[job['key']] = {'analysis': analysis, 'nbytes': nbytes, 'sizes': sizes, 'last_used': now}
+                    # Результат сразу закрепляется за сессиями, которые его ждут, чтобы не быть вытесненным до показа
+                    for session_id in job['sessions']:
+                        self._attach(job['key'], session_id)
+                    self._make_room(0)
+                    job['status'] = JOB_DONE
+                    job['percent'] = 100
+                elif job['status'] not in JOB_FINISHED:
+                    job['status'] = JOB_CANCELLED
+                job['finished_at'] = time.monotonic()
+                job['done'].set()
+                self._lock.notify_all()
+
+    def _progress(self, job, percent, text):
+        # Вызывается конвейером на границах стадий - здесь же расчет прерывается при отмене
+        if job['cancel'].is_set():
+            raise AnalysisCancelled()
+        job['percent'] = percent
+        job['text'] = text
+
+    def session_memory(self, session_id):
+        with self._lock:
+            return self._session_bytes(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': sum(job['started'] for job in self._jobs.values()),
+                'queued': len(self._queue),
+                'max_running': self.max_running,
+                'sessions': len(self._sessions),
+                'results': len(self._entries),
+                'memory_mb': round(self._used_memory() / 2**20, 1),
+                'budget_mb': round(self.memory_budget / 2**20, 1),
+                'session_budget_mb': round(self.session_budget / 2**20, 1)
+            }
+
+    def _attach(self, key, session_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        entry['last_used'] = now
+        self._entries.move_to_end(key)
+        session = self._sessions.setdefault(session_id, {'last_seen': now, 'key': None})
+        session['last_seen'] = now
+        session['key'] = key
+        return entry['analysis']
+
+    def _measure(self, entry):
+        sizes = {}
+        entry['nbytes'] = analysis_nbytes(entry['analysis'], sizes, entry['sizes'])
+        entry['sizes'] = sizes
+
+    def _session_bytes(self, session_id):
+        # Память, за которую отвечает сессия: открытый ею результат и ее доля в резервах ждущих и идущих
+        # расчетов (расчет, который ждут несколько сессий, делится между ними поровну)
+        session = self._sessions.get(session_id)
+        entry = self._entries.get(session['key']) if session and session['key'] is not None else None
+        reserved = sum(job['reserved'] / len(job['sessions']) for job in self._jobs.values() if session_id in job['sessions'])
+        return (entry['nbytes'] if entry else 0) + reserved
+
+    def _used_memory(self):
+        return (
+            sum(entry['nbytes'] for entry in self._entries.values())
+            + sum(job['reserved'] for job in self._jobs.values() if job['started'])
+        )
+
+    def _evict_idle(self, now):
+        for session_id in [sid for sid, session in self._sessions.items() if now - session['last_seen'] > self.idle_seconds]:
+            del self._sessions[session_id]
+            # Забытая сессия больше не ждет задач; задача, которую ждала только она и отменившие, отменяется
+            for job in self._jobs.values():
+                if session_id in job['sessions']:
+                    job['sessions'].discard(session_id)
+                    job['cancel_votes'].discard(session_id)
+                    self._cancel_unwanted(job)
+        referenced = {session['key'] for session in self._sessions.values()}
+        for key in [key for key, entry in self._entries.items() if key not in referenced and now - entry['last_used'] > self.idle_seconds]:
+            del self._entries[key]
+        for job_id in [job_id for job_id, job in self._jobs_by_id.items() if job['finished_at'] is not None and now - job['finished_at'] > self.idle_seconds]:
+            del self._jobs_by_id[job_id]
+
+    def _make_room(self, need):
+        # Вытеснение давно использованных результатов, пока результаты и резервы не уместятся в бюджет вместе
+        # с need. Результаты, открытые в живых сессиях, не вытесняются: сессия продолжает работать с ними,
+        # и память все равно не освободилась бы - до их освобождения новые расчеты ждут в очереди
+        self._evict_idle(time.monotonic())
+        referenced = {session['key'] for session in self._sessions.values()}
+        for key in [key for key in self._entries if key not in referenced]:
+            if self._used_memory() + need <= self.memory_budget:
+                break
+            del self._entries[key]
+        return self._used_memory() + need <= self.memory_budget
+
+    def _can_start(self, ticket, reserved):
+        running = sum(job['started'] for job in self._jobs.values())
+        if running >= self.max_running or self._queue[0] != ticket:
+            return False
+        # Один расчет допускается всегда, даже если его оценка больше бюджета
+        return self._make_room(reserved) or running == 0
+
+    def _admit(self, job):
+        ticket = next(self._tickets)
+        with self._lock:
+            self._queue.append(ticket)
+            try:
+                while not self._can_start(ticket, job['reserved']):
+                    if job['cancel'].is_set():
+                        raise AnalysisCancelled()
+                    job['position'] = self._queue.index(ticket) + 1
+                    self._lock.wait(QUEUE_POLL_SECONDS)
+                job['started'] = True
+                job['status'] = JOB_RUNNING
+                job['position'] = None
+            finally:
+                self._queue.remove(ticket)
+                self._lock.notify_all()
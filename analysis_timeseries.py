@@ -0,0 +1,82 @@
+# Режим динамики: метрики по объявлениям за произвольное окно дат, по дням/неделям/месяцам
+# и скользящие суммы. Все считается по дневной таблице analysis['timeseries'] (см. daily_aggregates),
+# сырые строки выгрузок повторно не агрегируются; результаты окон кэшируются вместе с анализом
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+from analysis_core import OUTPUT_COLUMNS_RENAME, AnalysisCache, add_metric_columns, category_totals
+
+TIMESERIES_FREQUENCIES = {'D': 'День', 'W': 'Неделя', 'M': 'Месяц'}
+TIMESERIES_WINDOW_CACHE_SIZE = 32
+
+def timeseries_date_range(daily):
+    return daily['date'].iloc[0], daily['date'].iloc[-1]
+
+def daily_slice(daily, start=None, end=None):
+    # Дневная таблица отсортирована по дате - окно вырезается двоичным поиском, без фильтрации всех строк
+    dates = daily['date'].to_numpy()
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), side='left')
+    last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), side='right')
+    return daily.iloc[first:last]
+
+def window_metrics(sums, has_revenue_data):
+    metrics = add_metric_columns(sums.reset_index(), has_revenue_data)
+    return metrics.rename(columns={**OUTPUT_COLUMNS_RENAME, 'period': 'Период'})
+
+def compute_window(daily, has_revenue_data, start=None, end=None, freq='D', rolling_days=None):
+    part = daily_slice(daily, start, end)
+    value_columns = [col for col in part.columns if col not in ('date', 'id')]
+
+    # Итоги по объявлениям за все окно
+    ads = window_metrics(part.groupby('id')[value_columns].sum(), has_revenue_data)
+    sort_columns = ['ROI, %', 'Конверсия, %'] if has_revenue_data else ['Конверсия, %']
+    ads = ads.sort_values(sort_columns, ascending=False)
+
+    # Метрики по объявлениям и периодам - один groupby по (период, ID)
+    period = part['date'].dt.to_period(freq).dt.start_time.rename('period')
+    periods = window_metrics(part.groupby([period, part['id']])[value_columns].sum(), has_revenue_data)
+
+    # Общая динамика по всем объявлениям; скользящее окно считается по непрерывному ряду дней
+    if rolling_days:
+        totals = part.groupby('date')[value_columns].sum()
+        if not totals.empty:
+            totals = totals.asfreq('D', fill_value=0)
+        totals = totals.rolling(rolling_days, min_periods=1).sum().rename_axis('period')
+    else:
+        totals = part.groupby(period)[value_columns].sum()
+    trend = window_metrics(totals, has_revenue_data)
+
+    return {
+        'window_ads': ads,
+        'window_periods': periods,
+        'trend': trend,
+        'category_totals': category_totals({'window_ads': ads, 'window_periods': periods}, has_revenue_data)
+    }
+
+def timeseries_window(analysis, start=None, end=None, freq='D', rolling_days=None, updating=None):
+    # Результат окна кэшируется: повторный выбор того же диапазона на слайдере ничего не пересчитывает.
+    # updating() - блокировка записи в общий результат (см. table_sort_order), у самого кэша окон своя
+    windows = analysis.get('timeseries_windows')
+    if windows is None:
+        with updating() if updating is not None else nullcontext():
+            windows = analysis.setdefault('timeseries_windows', AnalysisCache(TIMESERIES_WINDOW_CACHE_SIZE))
+    key = (
+        None if start is None else pd.Timestamp(start),
+        None if end is None else pd.Timestamp(end),
+        freq,
+        rolling_days or None
+    )
+    window = windows.get(key)
+    if window is None:
+        window = compute_window(
+            analysis['timeseries'], analysis['summary_stats']['has_revenue_data'], start, end, freq, rolling_days
+        )
+        windows.put(key, window)
+    return window
+
+def last_days_window(analysis, days, freq='D'):
+    # Последние N дней до самой поздней даты в выгрузках
+    _, last_date = timeseries_date_range(analysis['timeseries'])
+    return timeseries_window(analysis, last_date - pd.Timedelta(days=days - 1), last_date, freq)
@@ -0,0 +1,148 @@
+# Базовые показатели выгрузки для порогов рекомендаций: среднее, медиана, усеченное среднее, квантили,
+# MAD и взвешенные по затратам среднее и медиана - для всех метрик за один проход по таблице результата.
+# Медианы и квантили находятся выбором (np.partition) без сортировки, поэтому стадия остается O(n)
+import numpy as np
+import pandas as pd
+
+# Метрика объявления -> столбец таблицы результата
+METRIC_COLUMNS = {
+    'orders': 'Количество заказов',
+    'leads': 'Лиды',
+    'spent': 'Затраты, ₽',
+    'conversion': 'Конверсия, %',
+    'cpo': 'CPO, ₽',
+    'cpl': 'CPL, ₽',
+    'revenue': 'Общая выручка',
+    'avg_check': 'Средний чек',
+    'roi': 'ROI, %',
+    'profit': 'Прибыль',
+    'romi': 'ROMI'
+}
+# Метрики, у которых 0 означает "не определено" (CPO объявления без заказов записывается как 0)
+ZERO_AS_MISSING = ('cpo',)
+
+BASELINE_QUANTILES = (0.1, 0.25, 0.75, 0.9)
+# Доля значений, отбрасываемых с каждого края для усеченного среднего
+TRIM_SHARE = 0.1
+BASELINE_STATS = (
+    ['count', 'mean', 'median', 'trimmed']
+    + [f'q{round(level * 100)}' for level in BASELINE_QUANTILES]
+    + ['mad', 'wmean', 'wmedian']
+)
+# Подписи показателей (для таблицы в приложении)
+BASELINE_STAT_LABELS = {
+    'count': "Объявлений",
+    'mean': "Среднее",
+    'median': "Медиана",
+    'trimmed': f"Усеченное среднее ({TRIM_SHARE:.0%})",
+    **{f'q{round(level * 100)}': f"Квантиль {level:.0%}" for level in BASELINE_QUANTILES},
+    'mad': "MAD",
+    'wmean': "Среднее, взвеш. по затратам",
+    'wmedian': "Медиана, взвеш. по затратам"
+}
+
+# Средние с тем же отбором значений, что и в прежних правилах, - на них ссылается встроенный набор правил
+LEGACY_AVERAGES = ('avg_conversion', 'avg_roi', 'avg_cpo', 'avg_leads')
+
+# Все имена показателей, доступные в условиях правил: <показатель>_<метрика> и прежние средние
+BASELINE_VARIABLES = LEGACY_AVERAGES + tuple(
+    f'{stat}_{metric}' for metric in METRIC_COLUMNS for stat in BASELINE_STATS
+)
+
+def order_statistics(values):
+    # Медиана, квантили (линейная интерполяция, как в np.quantile) и усеченное среднее - одним np.partition
+    n = len(values)
+    trim = int(n * TRIM_SHARE)
+    positions = np.array((0.5,) + BASELINE_QUANTILES) * (n - 1)
+    low = np.floor(positions).astype(int)
+    high = np.ceil(positions).astype(int)
+    part = np.partition(values, np.unique(np.concatenate([low, high, [trim, n - trim - 1]])))
+    levels = part[low] + (part[high] - part[low]) * (positions - low)
+    return levels[0], levels[1:], part[trim:n - trim].mean()
+
+def weighted_median(values, weights):
+    # Нижняя взвешенная медиана выбором по опорному элементу: каждый шаг отбрасывает не меньше половины значений
+    target = weights.sum() / 2
+    if not target > 0:
+        return np.nan
+    while len(values) > 1:
+        pivot = np.median(values)
+        below = values < pivot
+        below_weight = weights[below].sum()
+        if below_weight >= target:
+            values, weights = values[below], weights[below]
+            continue
+        equal = values == pivot
+        equal_weight = weights[equal].sum()
+        if below_weight + equal_weight >= target:
+            return pivot
+        target -= below_weight + equal_weight
+        above = values > pivot
+        values, weights = values[above], weights[above]
+    return values[0] if len(values) else np.nan
+
+def metric_statistics(values, weights):
+    stats = dict.fromkeys(BASELINE_STATS, np.nan)
+    stats['count'] = len(values)
+    if len(values) == 0:
+        return stats
+
+    median, quantiles, trimmed = order_statistics(values)
+    stats['mean'] = values.mean()
+    stats['median'] = median
+    stats['trimmed'] = trimmed
+    for level, value in zip(BASELINE_QUANTILES, quantiles):
+        stats[f'q{round(level * 100)}'] = value
+    stats['mad'] = np.median(np.abs(values - median))
+
+    positive = weights > 0
+    if positive.any():
+        stats['wmean'] = np.average(values[positive], weights=weights[positive])
+        stats['wmedian'] = weighted_median(values[positive], weights[positive])
+    return stats
+
+def masked_mean(values, mask):
+    values = values[mask & ~np.isnan(values)]
+    return values.mean() if len(values) else np.nan
+
+def legacy_averages(df, has_revenue_data):
+    # Отбор как раньше: ROI и конверсия без нулей, CPO без нулей и не больше 100000
+    conversion = df['Конверсия, %'].to_numpy(dtype=float)
+    cpo = df['CPO, ₽'].to_numpy(dtype=float)
+    leads = df['Лиды'].to_numpy(dtype=float)
+    if has_revenue_data:
+        roi = df['ROI, %'].to_numpy(dtype=float)
+        avg_roi = masked_mean(roi, roi != 0)
+    else:
+        avg_roi = 0
+    return {
+        'avg_conversion': masked_mean(conversion, conversion != 0),
+        'avg_roi': avg_roi,
+        'avg_cpo': masked_mean(cpo, (cpo != 0) & (cpo < 100000)),
+        'avg_leads': masked_mean(leads, np.ones(len(leads), dtype=bool))
+    }
+
+def baseline_statistics(df, has_revenue_data):
+    # Плоский словарь {<показатель>_<метрика>: значение} + прежние средние; пропуски и бесконечности не учитываются
+    spent = df['Затраты, ₽'].to_numpy(dtype=float)
+    stats = {}
+    with np.errstate(all='ignore'):
+        for metric, column in METRIC_COLUMNS.items():
+            if column not in df.columns:
+                continue
+            values = df[column].to_numpy(dtype=float)
+            valid = np.isfinite(values) & np.isfinite(spent)
+            if metric in ZERO_AS_MISSING:
+                valid &= values != 0
+            for stat, value in metric_statistics(values[valid], spent[valid]).items():
+                stats[f'{stat}_{metric}'] = value
+        stats.update(legacy_averages(df, has_revenue_data))
+    return stats
+
+def baseline_table(stats):
+    # Таблица "метрика x показатель" для вывода
+    rows = {
+        column: [stats.get(f'{stat}_{metric}') for stat in BASELINE_STATS]
+        for metric, column in METRIC_COLUMNS.items() if f'count_{metric}' in stats
+    }
+    return pd.DataFrame.from_dict(rows, orient='index', columns=[BASELINE_STAT_LABELS[stat] for stat in BASELINE_STATS])
@@ -0,0 +1,227 @@
+# Нагрузочные замеры конвейера на синтетических выгрузках (synthetic_exports) с базовой линией в JSON:
+#   python benchmark.py --scales 1k 100k --formats csv xlsx --repeat 3 --save-baseline
+#   python benchmark.py --scales 1k 100k --formats csv xlsx --repeat 3
+# Второй запуск сравнивает время и память каждой стадии с базовой линией и завершается с кодом 1,
+# если какая-то стадия стала медленнее порога
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analysis_charts import analysis_figures
+from analysis_core import (
+    CRM_CSV_CHUNK_SIZE,
+    StageProfiler,
+    ads_columns_mapping,
+    create_excel_report,
+    create_parquet_archive,
+    crm_columns_mapping,
+    pyarrow_available,
+    run_analysis_pipeline
+)
+from synthetic_exports import SYNTHETIC_FORMATS, SYNTHETIC_SCALES, parse_scale, write_exports
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARK_BASELINE_PATH = 'benchmark_baseline.json'
+BENCHMARK_DATA_DIR = '.benchmark_data'
+# Допустимое замедление стадии и рост пиковой памяти относительно базовой линии
+REGRESSION_THRESHOLD = 0.25
+MEMORY_REGRESSION_THRESHOLD = 0.25
+# Стадии короче этого не проверяются: их время - в основном шум
+MIN_STAGE_SECONDS = 0.05
+# Прогоны без замера перед основными: первый прогон включает ленивые импорты (plotly, pyarrow)
+WARMUP_RUNS = 1
+
+def case_name(scale, file_format, revenue=True, streaming=False):
+    return f"{scale}-{file_format}" + ('' if revenue else '-norev') + ('-stream' if streaming else '')
+
+def stage_key(record):
+    # Стадия с деталями (read: ads, export: xlsx) замеряется отдельно
+    return record['stage'] if not record['detail'] else f"{record['stage']}: {record['detail']}"
+
+def peak_rss_mb():
+    # Пиковая память процесса (в Linux ru_maxrss в КБ, в macOS - в байтах)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+def run_pipeline_once(ads_path, crm_path, streaming=False):
+    # Один прогон: чтение, анализ, графики и отчеты - как в приложении, без кэша входных файлов
+    with open(ads_path, 'rb') as f:
+        ads_bytes = f.read()
+    with open(crm_path, 'rb') as f:
+        crm_bytes = f.read()
+    analysis = run_analysis_pipeline(
+        ads_bytes, os.path.basename(ads_path), crm_bytes, os.path.basename(crm_path),
+        ads_columns_mapping, crm_columns_mapping,
+        crm_chunksize=CRM_CSV_CHUNK_SIZE if streaming else None
+    )
+    analysis_figures(analysis)
+
+    profiler = StageProfiler()
+    frames = (analysis['result_sorted'], analysis['delete_ads'], analysis['scale_ads'], analysis['optimize_ads'])
+    with profiler.stage('export', 'xlsx'):
+        create_excel_report(*frames, analysis['summary_stats'])
+    if pyarrow_available():
+        with profiler.stage('export', 'parquet'):
+            create_parquet_archive(*frames)
+    return analysis['profile'] + profiler.records
+
+def run_case(task):
+    # Выполняется в отдельном процессе, чтобы пиковая память относилась только к этому набору
+    for _ in range(task['warmup']):
+        run_pipeline_once(task['ads'], task['crm'], task['streaming'])
+    runs = [run_pipeline_once(task['ads'], task['crm'], task['streaming']) for _ in range(task['repeat'])]
+
+    seconds = {}
+    rss_delta = {}
+    for records in runs:
+        totals = {}
+        for record in records:
+            key = stage_key(record)
+            totals[key] = totals.get(key, 0) + record['seconds']
+            if record['rss_delta_mb'] is not None:
+                rss_delta[key] = max(rss_delta.get(key, 0), record['rss_delta_mb'])
+        for key, value in totals.items():
+            seconds.setdefault(key, []).append(value)
+
+    # Медиана по повторам устойчивее к случайным задержкам, чем среднее
+    stages = {key: round(statistics.median(values), 6) for key, values in seconds.items()}
+    return {
+        'case': task['case'],
+        'rows': task['rows'],
+        'repeat': task['repeat'],
+        'stages': stages,
+        'total_seconds': round(sum(stages.values()), 6),
+        'stage_rss_delta_mb': rss_delta,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def benchmark_tasks(scales, formats, data_dir, repeat=3, seed=0, revenue=True, streaming=False, warmup=WARMUP_RUNS):
+    tasks = []
+    for scale in scales:
+        rows = parse_scale(scale)
+        for file_format in formats:
+            try:
+                ads_path, crm_path = write_exports(data_dir, rows, file_format, seed, revenue)
+            except ValueError as e:
+                print(f"Пропущено ({scale}, {file_format}): {e}", file=sys.stderr)
+                continue
+            tasks.append({
+                'case': case_name(scale, file_format, revenue, streaming and file_format == 'csv'),
+                'rows': rows, 'ads': ads_path, 'crm': crm_path, 'repeat': repeat, 'warmup': warmup,
+                'streaming': streaming and file_format == 'csv'
+            })
+    return tasks
+
+def run_benchmarks(tasks):
+    # Наборы замеряются по очереди, каждый в новом процессе: параллельные прогоны мешали бы друг другу
+    results = {}
+    for task in tasks:
+        print(f"{task['case']}: {task['repeat']} прогон(а)...", file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[task['case']] = executor.submit(run_case, task).result()
+    return results
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds')
+    }
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_baseline(path, results, baseline=None):
+    # Обновляются только замеренные наборы; остальные наборы базовой линии сохраняются
+    cases = dict((baseline or {}).get('cases', {}))
+    cases.update(results)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment_info(), 'cases': cases}, f, ensure_ascii=False, indent=2)
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD, memory_threshold=MEMORY_REGRESSION_THRESHOLD, min_seconds=MIN_STAGE_SECONDS):
+    # Строки сравнения по всем стадиям; regression=True - стадия стала медленнее порога
+    rows = []
+    for case, result in results.items():
+        base = baseline['cases'].get(case) if baseline else None
+        if base is None:
+            continue
+        for stage, seconds in result['stages'].items():
+            base_seconds = base['stages'].get(stage)
+            if base_seconds is None:
+                continue
+            rows.append({
+                'case': case, 'stage': stage, 'metric': 'seconds', 'baseline': base_seconds, 'current': seconds,
+                'change': round(seconds / base_seconds - 1, 3) if base_seconds > 0 else None,
+                'regression': seconds > base_seconds * (1 + threshold) and seconds - base_seconds > min_seconds
+            })
+        if result['peak_rss_mb'] is not None and base.get('peak_rss_mb'):
+            rows.append({
+                'case': case, 'stage': 'peak_rss', 'metric': 'mb', 'baseline': base['peak_rss_mb'],
+                'current': result['peak_rss_mb'], 'change': round(result['peak_rss_mb'] / base['peak_rss_mb'] - 1, 3),
+                'regression': result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + memory_threshold)
+            })
+    return rows
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Замеры времени и памяти стадий анализа на синтетических выгрузках")
+    parser.add_argument('--scales', nargs='+', default=['1k', '100k'],
+                        help=f"размеры наборов (строк CRM): {', '.join(SYNTHETIC_SCALES)} или число")
+    parser.add_argument('--formats', nargs='+', choices=SYNTHETIC_FORMATS, default=['csv'])
+    parser.add_argument('--repeat', type=int, default=3, help="прогонов на набор (берется медиана)")
+    parser.add_argument('--warmup', type=int, default=WARMUP_RUNS, help="прогонов без замера перед основными")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-revenue', action='store_true', help="наборы без суммы заказов")
+    parser.add_argument('--streaming', action='store_true', help="потоковое чтение CRM для CSV")
+    parser.add_argument('--data-dir', default=BENCHMARK_DATA_DIR, help="каталог сгенерированных выгрузок")
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH, help="файл базовой линии")
+    parser.add_argument('--save-baseline', action='store_true', help="записать результаты как базовую линию")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="допустимое замедление стадии (0.25 - на 25%%)")
+    parser.add_argument('--memory-threshold', type=float, default=MEMORY_REGRESSION_THRESHOLD,
+                        help="допустимый рост пиковой памяти")
+    parser.add_argument('--min-seconds', type=float, default=MIN_STAGE_SECONDS,
+                        help="стадии, изменившиеся меньше чем на столько секунд, не считаются замедлившимися")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    tasks = benchmark_tasks(
+        args.scales, args.formats, args.data_dir, args.repeat, args.seed, not args.no_revenue, args.streaming,
+        args.warmup
+    )
+    results = run_benchmarks(tasks)
+    baseline = load_baseline(args.baseline)
+    comparison = compare_to_baseline(results, baseline, args.threshold, args.memory_threshold, args.min_seconds)
+    regressions = [row for row in comparison if row['regression']]
+
+    if comparison:
+        print(pd.DataFrame(comparison).to_string(index=False), file=sys.stderr)
+    elif not args.save_baseline:
+        print(f"Базовая линия для этих наборов не найдена ({args.baseline}) - сравнение пропущено", file=sys.stderr)
+    if args.save_baseline:
+        save_baseline(args.baseline, results, baseline)
+
+    print(json.dumps({'results': results, 'regressions': regressions}, ensure_ascii=False, indent=2))
+    return 1 if regressions and not args.save_baseline else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
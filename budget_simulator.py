@@ -0,0 +1,154 @@
+# Симулятор перераспределения бюджета: затраты объявлений УДАЛИТЬ (и изменение общего бюджета) переносятся
+# на объявления МАСШТАБИРОВАТЬ. Отдача объявления убывает с ростом затрат: при затратах x вместо текущих s
+# ожидаемая выручка (без данных о выручке - заказы) равна value * (x / s) ** elasticity, а затраты объявления
+# ограничены max_multiplier * s - дальше этого модель текущие данные не экстраполирует.
+# Сценарий - пара (наклон, бюджет кандидатов): бюджет делится пропорционально s * окупаемость ** наклон.
+# Наклон 0 - пропорционально текущим затратам, большие наклоны сосредотачивают бюджет на самых окупаемых
+# объявлениях; объявления, упершиеся в предел, отдают остаток остальным. При любом наклоне предела первыми
+# достигают самые окупаемые объявления, поэтому после одной сортировки все сценарии считаются матрицами
+# объявления x наклоны: итог каждого бюджета находится по накопленным суммам двоичным поиском, без цикла по объявлениям
+import numpy as np
+import pandas as pd
+
+DEFAULT_ELASTICITY = 0.7
+MAX_SPEND_MULTIPLIER = 3.0
+TILT_LEVELS = np.linspace(0, 4, 41)
+# Число уровней бюджета кандидатов (от 0 до всего доступного бюджета)
+BUDGET_LEVELS = 101
+
+def budget_inputs(analysis):
+    # Массивы по объявлениям выбираются из таблицы результата один раз и хранятся вместе с анализом
+    inputs = analysis.get('budget_inputs')
+    if inputs is None:
+        frame = analysis['result_sorted']
+        has_revenue_data = analysis['summary_stats']['has_revenue_data']
+        value_column = 'Общая выручка' if has_revenue_data else 'Количество заказов'
+        inputs = analysis['budget_inputs'] = {
+            'ids': frame['ID объявления'].to_numpy(),
+            'recommendation': frame['Рекомендация'].to_numpy(),
+            'spent': np.nan_to_num(frame['Затраты, ₽'].to_numpy(dtype=float)),
+            'value': np.nan_to_num(frame[value_column].to_numpy(dtype=float)),
+            'delete': frame.index.isin(analysis['delete_ads'].index),
+            'scale': frame.index.isin(analysis['scale_ads'].index),
+            'has_revenue_data': has_revenue_data
+        }
+    return inputs
+
+def fill_levels(spent, value, efficiency, amounts, tilts, elasticity, max_multiplier):
+    # Кандидаты отсортированы по убыванию efficiency. Для наклона t объявление получает min(λ * u, предел),
+    # u = s * efficiency ** t; первые j объявлений уже уперлись в предел. Возвращает матрицы наклоны x уровни:
+    # номер первого не упершегося объявления, λ, затраты и ожидаемую отдачу кандидатов
+    n = len(spent)
+    power = efficiency[:, None] ** tilts[None, :]
+    weights = spent[:, None] * power
+    caps = max_multiplier * spent
+    capped_spend = np.concatenate([[0.0], np.cumsum(caps)])
+    capped_value = np.concatenate([[0.0], np.cumsum(value * max_multiplier ** elasticity)])
+    zeros = np.zeros((1, len(tilts)))
+    free_weight = np.vstack([np.cumsum(weights[::-1], axis=0)[::-1], zeros])
+    free_value = np.vstack([np.cumsum((value[:, None] * power ** elasticity)[::-1], axis=0)[::-1], zeros])
+    # Бюджет, при котором объявление j упирается в предел (λ = max_multiplier / efficiency ** t); по строкам не убывает
+    breakpoints = capped_spend[:-1, None] + max_multiplier / power * free_weight[:-1]
+
+    capped = np.empty((len(tilts), len(amounts)), dtype=np.int64)
+    for column in range(len(tilts)):
+        capped[column] = np.searchsorted(breakpoints[:, column], amounts, side='right')
+    columns = np.arange(len(tilts))[:, None]
+    weight_left = free_weight[capped, columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(capped < n, (amounts[None, :] - capped_spend[capped]) / weight_left, 0.0)
+    spend = np.broadcast_to(np.minimum(amounts, capped_spend[-1]), capped.shape)
+    result = capped_value[capped] + scale ** elasticity * free_value[capped, columns]
+    return capped, scale, spend, result
+
+def simulate_budget(inputs, budget=None, elasticity=DEFAULT_ELASTICITY, max_multiplier=MAX_SPEND_MULTIPLIER, drop_delete=True, scale_only=True, tilts=TILT_LEVELS, budget_levels=BUDGET_LEVELS):
+    # budget - общий бюджет всех объявлений (по умолчанию текущие затраты). Объявления, которые не удаляются
+    # и не получают бюджет, остаются с текущими затратами; остаток бюджета делится между кандидатами.
+    # Лучший сценарий - с наибольшей прибылью (без выручки - с наибольшим числом заказов)
+    tilts = np.asarray(tilts, dtype=float)
+    spent = inputs['spent']
+    value = inputs['value']
+    has_revenue_data = inputs['has_revenue_data']
+    removed = inputs['delete'] if drop_delete else np.zeros(len(spent), dtype=bool)
+    receives = (inputs['scale'] if scale_only else np.ones(len(spent), dtype=bool)) & ~removed & (spent > 0) & (value > 0)
+    fixed = ~removed & ~receives
+
+    current_spend = float(spent.sum())
+    current_value = float(value.sum())
+    budget = current_spend if budget is None else float(budget)
+    fixed_spend = float(spent[fixed].sum())
+    fixed_value = float(value[fixed].sum())
+    amounts = max(budget - fixed_spend, 0.0) * np.linspace(0, 1, budget_levels)
+
+    # Окупаемость нормируется средней по кандидатам, чтобы степени не уходили за пределы float
+    candidates = np.flatnonzero(receives)
+    efficiency = value[candidates] / spent[candidates]
+    order = np.argsort(-efficiency, kind='stable')
+    candidates = candidates[order]
+    efficiency = efficiency[order] / (value[candidates].sum() / spent[candidates].sum() if len(candidates) else 1.0)
+    capped, scale, spend, result = fill_levels(
+        spent[candidates], value[candidates], efficiency, amounts, tilts, elasticity, max_multiplier
+    )
+
+    total_spend = fixed_spend + spend
+    total_value = fixed_value + result
+    objective = total_value - total_spend if has_revenue_data else total_value
+    best_tilt, best_level = np.unravel_index(np.argmax(objective), objective.shape)
+
+    # Распределение лучшего сценария по объявлениям
+    new_spent = spent.copy()
+    new_spent[removed] = 0.0
+    weights = spent[candidates] * efficiency ** tilts[best_tilt]
+    caps = max_multiplier * spent[candidates]
+    new_spent[candidates] = np.where(
+        np.arange(len(candidates)) < capped[best_tilt, best_level], caps,
+        np.minimum(scale[best_tilt, best_level] * weights, caps)
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_value = np.where(spent > 0, value * np.power(new_spent / spent, elasticity), value)
+    changed = removed | receives
+
+    value_label = 'Выручка' if has_revenue_data else 'Заказы'
+    allocation = pd.DataFrame({
+        'ID объявления': inputs['ids'][changed],
+        'Рекомендация': inputs['recommendation'][changed],
+        'Затраты, ₽': spent[changed],
+        'Затраты после перераспределения, ₽': new_spent[changed].round(2),
+        'Изменение затрат, ₽': (new_spent - spent)[changed].round(2),
+        f'{value_label}, ожидается': new_value[changed].round(2)
+    }).sort_values('Изменение затрат, ₽', ascending=False, kind='stable', ignore_index=True)
+
+    # Граница: лучший наклон для каждого уровня бюджета кандидатов
+    frontier_tilt = objective.argmax(axis=0)
+    levels = np.arange(len(amounts))
+    frontier = pd.DataFrame({
+        'Затраты, ₽': total_spend[frontier_tilt, levels].round(2),
+        value_label: total_value[frontier_tilt, levels].round(2)
+    })
+    if has_revenue_data:
+        frontier['Прибыль'] = (frontier[value_label] - frontier['Затраты, ₽']).round(2)
+
+    best_spend = float(total_spend[best_tilt, best_level])
+    best_value = float(total_value[best_tilt, best_level])
+    return {
+        'has_revenue_data': has_revenue_data,
+        'value_label': value_label,
+        'budget': budget,
+        'scenarios': objective.size,
+        'candidates': len(candidates),
+        'removed': int(removed.sum()),
+        'current': {
+            'spend': current_spend,
+            'value': current_value,
+            'profit': current_value - current_spend if has_revenue_data else None
+        },
+        'best': {
+            'tilt': float(tilts[best_tilt]),
+            'spend': best_spend,
+            'value': best_value,
+            'profit': best_value - best_spend if has_revenue_data else None,
+            'moved': float(np.clip(new_spent - spent, 0, None)[receives].sum())
+        },
+        'frontier': frontier,
+        'allocation': allocation
+    }
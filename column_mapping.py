@@ -0,0 +1,223 @@
+# Сопоставление столбцов выгрузок с ключами анализа: ручные исправления, реестр подтвержденных
+# сопоставлений, точные совпадения и нечеткий поиск по словам в названиях с проверкой содержимого
+import difflib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import pandas as pd
+
+MAPPING_REGISTRY_PATH = os.environ.get('ADS_ANALYSIS_MAPPING_REGISTRY', 'column_mappings.sqlite')
+# Сколько строк читается вместе с заголовком для проверки содержимого столбцов
+MAPPING_SAMPLE_ROWS = 200
+FUZZY_MATCH_THRESHOLD = 0.6
+
+# Ожидаемое содержимое столбцов; несовпадение сильно снижает оценку нечеткого совпадения
+COLUMN_PROFILES = {
+    'id': 'id',
+    'leads': 'numeric',
+    'cost_per_lead': 'numeric',
+    'spent': 'numeric',
+    'revenue': 'numeric',
+    'date': 'date',
+    'clients': 'any'
+}
+PROFILE_MISMATCH_PENALTY = 0.5
+
+# Единицы измерения не отличают один столбец от другого
+UNIT_TOKENS = {'₽', 'р', 'руб', 'rub', 'rur', 'шт', 'ед'}
+
+# Подписи ключей для показа пользователю
+COLUMN_LABELS = {
+    'id': "ID объявления / источник",
+    'leads': "Лиды",
+    'cost_per_lead': "Цена за лид",
+    'spent': "Затраты",
+    'clients': "Клиенты",
+    'revenue': "Сумма заказов",
+    'date': "Дата"
+}
+
+# Способы сопоставления (для показа пользователю)
+MAPPING_METHODS = {
+    'override': "задано вручную",
+    'registry': "из реестра",
+    'exact': "точное совпадение",
+    'fuzzy': "похожее название",
+    'suggested': "похожее название, не используется до подтверждения"
+}
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS column_mappings (
+    signature TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    columns TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+def source_signature(kind, headers):
+    # Подпись источника - набор заголовков выгрузки (порядок столбцов не важен)
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(json.dumps([kind, sorted(str(header) for header in headers)], ensure_ascii=False).encode('utf-8'))
+    return hasher.hexdigest()
+
+class MappingRegistry:
+    # Подтвержденные сопоставления по подписи источника. Хранит только путь к файлу,
+    # поэтому объект можно передавать в дочерние процессы пакетного режима
+    def __init__(self, path=MAPPING_REGISTRY_PATH):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(REGISTRY_SCHEMA)
+        return conn
+
+    def get(self, signature):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT columns FROM column_mappings WHERE signature = ?", (signature,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def put(self, signature, kind, headers, columns):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO column_mappings (signature, kind, headers, columns, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(signature) DO UPDATE SET columns = excluded.columns, updated_at = excluded.updated_at",
+                    (signature, kind, json.dumps([str(h) for h in headers], ensure_ascii=False),
+                     json.dumps(columns, ensure_ascii=False), time.time())
+                )
+        finally:
+            conn.close()
+
+    def remember(self, resolution):
+        # Запоминание - это подтверждение, поэтому предложенные необязательные столбцы тоже сохраняются
+        self.put(resolution['signature'], resolution['kind'], resolution['headers'], {**resolution['suggested'], **resolution['columns']})
+
+def header_tokens(name):
+    text = str(name).lower().replace('ё', 'е')
+    return [token for token in re.findall(r'\w+|₽', text) if token not in UNIT_TOKENS]
+
+def tokens_match(a, b):
+    # Совпадение слов с точностью до окончания: "затраты" ~ "затрат", "клиенты" ~ "клиента"
+    if a == b:
+        return True
+    return min(len(a), len(b)) >= 4 and difflib.SequenceMatcher(None, a, b).ratio() >= 0.8
+
+def name_similarity(header, candidate):
+    header_words = header_tokens(header)
+    candidate_words = header_tokens(candidate)
+    if not header_words or not candidate_words:
+        return 0.0
+    candidate_coverage = sum(any(tokens_match(w, h) for h in header_words) for w in candidate_words) / len(candidate_words)
+    header_coverage = sum(any(tokens_match(h, w) for w in candidate_words) for h in header_words) / len(header_words)
+    ratio = difflib.SequenceMatcher(None, ' '.join(header_words), ' '.join(candidate_words)).ratio()
+    return 0.5 * candidate_coverage + 0.2 * header_coverage + 0.3 * ratio
+
+def matches_profile(values, profile):
+    # Проверка по образцу строк; пустой образец (только заголовок) ничего не отвергает
+    values = values.dropna()
+    if profile == 'any' or values.empty:
+        return True
+    if profile == 'numeric':
+        return pd.to_numeric(values, errors='coerce').notna().mean() >= 0.8
+    text = values.astype(str).str.strip()
+    if profile == 'id':
+        # Числовые ID (в CRM вперемешку с названиями источников), но не дробные суммы
+        return text.str.fullmatch(r'\d+(\.0)?').mean() >= 0.2
+    if profile == 'date':
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return True
+        iso = pd.to_datetime(text, errors='coerce', format='ISO8601')
+        dayfirst = pd.to_datetime(text, errors='coerce', dayfirst=True, format='mixed')
+        return (iso.notna() | dayfirst.notna()).mean() >= 0.8
+    return True
+
+def resolve_table_mapping(sample, mapping, kind, registry=None, overrides=None, fuzzy=True, required=None):
+    # sample - таблица с нормализованными названиями столбцов (заголовок и, по возможности, первые строки).
+    # Порядок: ручные исправления -> реестр -> точные совпадения -> нечеткий поиск для оставшихся ключей.
+    # Точные совпадения проверяются и при записи в реестре: в старой записи может не быть нового ключа.
+    # Нечеткое совпадение используется без подтверждения только для ключей из required (если он задан):
+    # для необязательных (выручка, дата) ошибка незаметно меняет результат, поэтому они лишь предлагаются
+    headers = list(sample.columns)
+    signature = source_signature(kind, headers)
+    columns = {}
+    methods = {}
+    scores = {}
+    suggested = {}
+
+    for key, header in (overrides or {}).items():
+        if key in mapping and header in headers:
+            columns[key] = header
+            methods[key] = 'override'
+
+    registered = registry.get(signature) if registry is not None else None
+    if registered is not None:
+        for key, header in registered.items():
+            if key in mapping and key not in columns and header in headers:
+                columns[key] = header
+                methods[key] = 'registry'
+
+    for key, possible_names in mapping.items():
+        if key in columns:
+            continue
+        found_col = next((name for name in possible_names if name in headers), None)
+        if found_col is not None and found_col not in columns.values():
+            columns[key] = found_col
+            methods[key] = 'exact'
+
+    # Запись реестра уже подтверждена пользователем - нечеткий поиск ее не дополняет
+    if fuzzy and registered is None:
+        used = set(columns.values())
+        candidates = []
+        for key, possible_names in mapping.items():
+            if key in columns:
+                continue
+            for header in headers:
+                if header in used:
+                    continue
+                score = max((name_similarity(header, name) for name in possible_names), default=0.0)
+                if score < FUZZY_MATCH_THRESHOLD:
+                    continue
+                if not matches_profile(sample[header], COLUMN_PROFILES.get(key, 'any')):
+                    score *= PROFILE_MISMATCH_PENALTY
+                candidates.append((score, key, header))
+
+        # Жадное назначение: сначала самые уверенные пары, каждый столбец используется один раз
+        for score, key, header in sorted(candidates, key=lambda item: item[0], reverse=True):
+            if score < FUZZY_MATCH_THRESHOLD or key in columns or key in suggested or header in used:
+                continue
+            if required is None or key in required:
+                columns[key] = header
+                methods[key] = 'fuzzy'
+            else:
+                suggested[key] = header
+            scores[key] = round(score, 3)
+            used.add(header)
+
+    return {
+        'kind': kind,
+        'signature': signature,
+        'headers': headers,
+        'columns': columns,
+        'methods': methods,
+        'scores': scores,
+        'suggested': suggested,
+        # Запись реестра, по которой сопоставлены столбцы: результат с другой записью устарел
+        'registered': registered
+    }
+
+def needs_confirmation(resolution):
+    return bool(resolution['suggested']) or any(method == 'fuzzy' for method in resolution['methods'].values())
+
+def registry_changed(resolution, registry):
+    # Для этих заголовков в реестре подтверждено другое сопоставление, чем при анализе
+    return registry is not None and registry.get(resolution['signature']) != resolution['registered']
@@ -0,0 +1,136 @@
+# Доверительные интервалы метрик объявления: у объявления с 3 лидами и 1 заказом та же конверсия, что у объявления
+# с 3000 лидов и 1000 заказов, но уверенности в ней намного меньше.
+# - Конверсия: бета-биномиальная модель. Априорное распределение - Beta со средним, равным общей конверсии выгрузки,
+#   и весом CONVERSION_PRIOR_LEADS лидов; апостериорное - Beta(a + заказы, b + лиды без заказа). Его среднее -
+#   конверсия, сглаженная к общей: чем меньше лидов у объявления, тем сильнее.
+# - Средний чек: бутстреп сумм заказов CRM, сгруппированных по объявлениям. Распределение бутстреп-среднего
+#   n заказов имеет то же среднее и дисперсию s^2 / n (s^2 - дисперсия сумм заказов) и сэмплируется как нормальное:
+#   нужны только число, сумма и сумма квадратов сумм заказов объявления. Они есть при любом способе чтения
+#   CRM (целиком, потоково, из хранилища агрегатов), поэтому интервалы от способа чтения не зависят.
+# - CPO и ROI: по выборкам конверсии и среднего чека, ожидаемые заказы = лиды * конверсия.
+# Все объявления считаются сразу массивами объявления x повторы, пачками не больше CONFIDENCE_CHUNK_CELLS ячеек.
+# Случайные величины повторов общие для всех объявлений (у каждого объявления выборка по-прежнему независимая):
+# генерация не растет с числом объявлений, а конверсия считается один раз на каждую пару (заказы, лиды)
+import numpy as np
+
+CONFIDENCE_LEVEL = 0.9
+CONFIDENCE_RESAMPLES = 1000
+CONVERSION_PRIOR_LEADS = 20
+# Формы гамма-распределения меньше этой сэмплируются через Gamma(k + 1) (см. gamma_samples)
+GAMMA_BOOST_SHAPE = 3
+CONFIDENCE_CHUNK_CELLS = 1_000_000
+# Фиксированное зерно: одинаковые данные дают одинаковые интервалы и рекомендации
+CONFIDENCE_SEED = 0
+
+# Переменная правил -> столбец таблицы результата
+INTERVAL_COLUMNS = {
+    'conversion_post': 'Конверсия (сглаж.), %',
+    'conversion_low': 'Конверсия, нижн. граница, %',
+    'conversion_high': 'Конверсия, верхн. граница, %',
+    'cpo_low': 'CPO, нижн. граница, ₽',
+    'cpo_high': 'CPO, верхн. граница, ₽',
+    'roi_low': 'ROI, нижн. граница, %',
+    'roi_high': 'ROI, верхн. граница, %'
+}
+
+def order_value_moments(counts, sums, sumsqs):
+    # Число заказов с суммой, средний чек и разброс сумм заказов по объявлениям
+    counts = np.nan_to_num(np.asarray(counts, dtype=float))
+    sums = np.nan_to_num(np.asarray(sums, dtype=float))
+    sumsqs = np.nan_to_num(np.asarray(sumsqs, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / counts
+        variance = sumsqs / counts - mean ** 2
+    return {'counts': counts, 'mean': mean, 'std': np.sqrt(np.maximum(variance, 0))}
+
+def resample_draws(rng, resamples):
+    # Случайные величины повторов, общие для всех объявлений: по строке на каждое использование
+    return {
+        'normal_a': rng.standard_normal(resamples, dtype=np.float32),
+        'uniform_a': rng.random(resamples, dtype=np.float32),
+        'normal_b': rng.standard_normal(resamples, dtype=np.float32),
+        'uniform_b': rng.random(resamples, dtype=np.float32),
+        'normal_check': rng.standard_normal(resamples, dtype=np.float32)
+    }
+
+def gamma_samples(shape, normals, uniforms):
+    # Gamma(shape) для формы, своей в каждой строке (shape - столбец): приближение Уилсона-Хилферти по нормальной
+    # величине. Для малых форм приближение грубое, поэтому они сэмплируются как Gamma(k) = Gamma(k + 1) * U ** (1 / k)
+    boost = shape < GAMMA_BOOST_SHAPE
+    k = np.where(boost, shape + 1, shape)
+    c = 1 / (9 * k)
+    draws = np.maximum(1 - c + normals * np.sqrt(c), 0)
+    draws = k * draws * draws * draws
+    rows = np.flatnonzero(boost[:, 0])
+    if len(rows):
+        draws[rows] *= uniforms ** (1 / shape[rows])
+    return draws
+
+def conversion_samples(alpha, beta, draws):
+    # Beta(alpha, beta) = Ga / (Ga + Gb)
+    gamma_a = gamma_samples(alpha[:, None].astype(np.float32), draws['normal_a'], draws['uniform_a'])
+    gamma_b = gamma_samples(beta[:, None].astype(np.float32), draws['normal_b'], draws['uniform_b'])
+    return gamma_a / (gamma_a + gamma_b)
+
+def check_samples(moments, part, draws):
+    # Бутстреп-среднее чека объявлений part (у каждого есть заказы с суммой) в каждом повторе; чек не бывает отрицательным
+    scale = (moments['std'][part] / np.sqrt(moments['counts'][part])).astype(np.float32)
+    samples = moments['mean'][part, None].astype(np.float32) + scale[:, None] * draws['normal_check']
+    return np.maximum(samples, 0)
+
+def sample_bounds(samples, ranks):
+    low, high = np.partition(samples, ranks, axis=1)[:, ranks].T
+    return low.astype(float), high.astype(float)
+
+def confidence_intervals(leads, orders, spent, order_values=None, level=CONFIDENCE_LEVEL, resamples=CONFIDENCE_RESAMPLES, prior_leads=CONVERSION_PRIOR_LEADS, seed=CONFIDENCE_SEED):
+    # Возвращает массивы по ключам INTERVAL_COLUMNS. order_values - результат order_value_moments;
+    # None - нет данных о выручке, ROI не считается.
+    # Заказов может быть больше, чем лидов (заказы из CRM без лида в кабинете) - тогда лидами считаются заказы
+    leads = np.nan_to_num(np.asarray(leads, dtype=float))
+    orders = np.nan_to_num(np.asarray(orders, dtype=float))
+    spent = np.asarray(spent, dtype=float)
+    trials = np.maximum(leads, orders)
+    prior_mean = (orders.sum() + 0.5) / (trials.sum() + 1)
+    alpha = prior_mean * prior_leads + orders
+    beta = (1 - prior_mean) * prior_leads + trials - orders
+
+    tail = (1 - level) / 2
+    ranks = [int(np.floor(tail * (resamples - 1))), int(np.ceil((1 - tail) * (resamples - 1)))]
+    result = {'conversion_post': alpha / (alpha + beta) * 100}
+    draws = resample_draws(np.random.default_rng(seed), resamples)
+    rows = max(1, CONFIDENCE_CHUNK_CELLS // resamples)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Границы конверсии зависят только от пары (заказы, лиды)
+        pairs, inverse = np.unique(np.column_stack([orders, trials]), axis=0, return_inverse=True)
+        pair_alpha = prior_mean * prior_leads + pairs[:, 0]
+        pair_beta = (1 - prior_mean) * prior_leads + pairs[:, 1] - pairs[:, 0]
+        pair_low = np.empty(len(pairs))
+        pair_high = np.empty(len(pairs))
+        for start in range(0, len(pairs), rows):
+            part = slice(start, start + rows)
+            pair_low[part], pair_high[part] = sample_bounds(conversion_samples(pair_alpha[part], pair_beta[part], draws), ranks)
+        low = pair_low[inverse.ravel()]
+        high = pair_high[inverse.ravel()]
+        result['conversion_low'] = low * 100
+        result['conversion_high'] = high * 100
+
+        # CPO убывает с ростом конверсии - его нижняя граница соответствует верхней границе конверсии
+        has_trials = trials > 0
+        result['cpo_low'] = np.where(has_trials, spent / (trials * high), np.nan)
+        result['cpo_high'] = np.where(has_trials, spent / (trials * low), np.nan)
+
+        if order_values is not None:
+            # ROI = выручка на лид * лиды / затраты - 1 возрастает с выручкой на лид, поэтому границы считаются
+            # для выручки на лид. Только у объявлений с заказами с суммой: у остальных фактический ROI -100%,
+            # а интервал по чеку других объявлений был бы намного выше него - границы не определены (NaN)
+            revenue_low = np.full(len(orders), np.nan)
+            revenue_high = np.full(len(orders), np.nan)
+            sampled = np.flatnonzero((order_values['counts'] > 0) & (orders > 0))
+            for start in range(0, len(sampled), rows):
+                part = sampled[start:start + rows]
+                revenue = conversion_samples(alpha[part], beta[part], draws) * check_samples(order_values, part, draws)
+                revenue_low[part], revenue_high[part] = sample_bounds(revenue, ranks)
+            has_spent = spent > 0
+            result['roi_low'] = np.where(has_spent, (trials * revenue_low / spent - 1) * 100, np.nan)
+            result['roi_high'] = np.where(has_spent, (trials * revenue_high / spent - 1) * 100, np.nan)
+    return result
@@ -0,0 +1,306 @@
+# Инкрементальный режим: агрегаты по объявлениям хранятся в локальной базе SQLite,
+# ежедневные выгрузки (дельты) добавляются к ним без повторного чтения всей истории.
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from analysis_core import (
+    ADS_NUMERIC_COLUMNS,
+    ATTRIBUTION_PATTERNS,
+    CRM_NUMERIC_COLUMNS,
+    ORDER_VALUE_COLUMNS,
+    REQUIRED_ADS_COLUMNS,
+    REQUIRED_CRM_COLUMNS,
+    MissingColumnsError,
+    StageProfiler,
+    ad_id_index,
+    ads_columns_mapping,
+    attribute_crm_sources,
+    attribution_candidates,
+    build_analysis,
+    canonical_ids,
+    classify_sources,
+    compact_frames,
+    crm_columns_mapping,
+    normalize_column_names,
+    select_columns,
+    split_crm_sources
+)
+from column_mapping import resolve_table_mapping
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ads_agg (
+    id TEXT PRIMARY KEY,
+    leads REAL NOT NULL,
+    spent REAL NOT NULL,
+    cpl_sum REAL NOT NULL,
+    cpl_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS crm_agg (
+    id TEXT PRIMARY KEY,
+    orders INTEGER NOT NULL,
+    revenue_sum REAL NOT NULL,
+    revenue_count INTEGER NOT NULL,
+    revenue_sumsq REAL NOT NULL DEFAULT 0,
+    order_rows INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS crm_pending (
+    id TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL,
+    orders INTEGER NOT NULL,
+    revenue_sum REAL NOT NULL,
+    revenue_count INTEGER NOT NULL,
+    revenue_sumsq REAL NOT NULL,
+    order_rows INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS seen_keys (
+    source TEXT NOT NULL,
+    key_hash INTEGER NOT NULL,
+    PRIMARY KEY (source, key_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Счетчики и признаки в таблице meta
+META_DEFAULTS = {
+    'ads_rows': 0,
+    'crm_rows': 0,
+    'crm_reklama_rows': 0,
+    'crm_drugoe_rows': 0,
+    'has_revenue_data': 0,
+    'has_cost_per_lead': 0
+}
+
+# Суммы по заказам, которые накапливаются для каждого объявления
+CRM_SUM_COLUMNS = ['orders', 'revenue_sum', 'revenue_count', 'revenue_sumsq', 'order_rows']
+
+def row_key_hashes(df, row_key):
+    # 64-битные хэши ключа строки для дедупликации повторно загруженных строк
+    hashes = pd.util.hash_pandas_object(df[row_key].astype(str), index=False).to_numpy()
+    return hashes.view(np.int64)
+
+def crm_sums(crm_rows, has_revenue_data):
+    # Слагаемые агрегатов CRM для каждой строки. Копятся оба определения числа заказов, как в aggregate_crm:
+    # строки с клиентом (orders, есть выручка) и все строки (order_rows, выручки нет). Какое показать, решает
+    # признак выручки всего хранилища - дельты с выручкой и без нее считаются так же, как все строки сразу
+    if has_revenue_data:
+        revenue = crm_rows['revenue'].astype(float)
+    else:
+        revenue = pd.Series(np.nan, index=crm_rows.index)
+    return pd.DataFrame({
+        'orders': crm_rows['clients'].notna().astype(int),
+        'revenue_sum': revenue.fillna(0),
+        'revenue_count': revenue.notna().astype(int),
+        'revenue_sumsq': (revenue ** 2).fillna(0),
+        'order_rows': 1
+    }, index=crm_rows.index)
+
+class IncrementalStore:
+    def __init__(self, path, ads_mapping=None, crm_mapping=None, registry=None, attribution_patterns=ATTRIBUTION_PATTERNS):
+        self.path = path
+        self.attribution_patterns = attribution_patterns
+        self.ads_mapping = ads_mapping or ads_columns_mapping
+        self.crm_mapping = crm_mapping or crm_columns_mapping
+        self.registry = registry
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        # Хранилища, созданные до появления суммы квадратов: для уже накопленных заказов разброс чека
+        # неизвестен и считается нулевым, новые дельты учитываются полностью
+        if 'revenue_sumsq' not in {row[1] for row in self.conn.execute("PRAGMA table_info(crm_agg)")}:
+            self.conn.execute("ALTER TABLE crm_agg ADD COLUMN revenue_sumsq REAL NOT NULL DEFAULT 0")
+        # Хранилища, где копилось одно число заказов: оно же считается и числом строк
+        for table, rows in (('crm_agg', 'orders'), ('crm_pending', 'rows')):
+            if 'order_rows' not in {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN order_rows INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute(f"UPDATE {table} SET order_rows = {rows}")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", META_DEFAULTS.items()
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def meta(self):
+        return dict(self.conn.execute("SELECT key, value FROM meta"))
+
+    def add_meta(self, **deltas):
+        self.conn.executemany(
+            "UPDATE meta SET value = value + ? WHERE key = ?", [(value, key) for key, value in deltas.items()]
+        )
+
+    def set_flag(self, key):
+        self.conn.execute("UPDATE meta SET value = 1 WHERE key = ?", (key,))
+
+    def drop_seen_rows(self, df, source, row_key):
+        # Строки, ключ которых уже встречался в прошлых дельтах (или повторяется внутри дельты), отбрасываются
+        if not row_key:
+            return df
+        missing = [col for col in row_key if col not in df.columns]
+        if missing:
+            raise MissingColumnsError(f"Отсутствуют столбцы ключа строки: {missing}")
+
+        hashes = row_key_hashes(df, row_key)
+        first_in_delta = ~pd.Series(hashes).duplicated().to_numpy()
+
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS delta_keys (key_hash INTEGER PRIMARY KEY)")
+        self.conn.execute("DELETE FROM delta_keys")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO delta_keys (key_hash) VALUES (?)", ((int(h),) for h in hashes)
+        )
+        seen = np.fromiter(
+            (row[0] for row in self.conn.execute(
+                "SELECT d.key_hash FROM delta_keys d "
+                "JOIN seen_keys s ON s.source = ? AND s.key_hash = d.key_hash", (source,)
+            )),
+            dtype=np.int64
+        )
+        keep = first_in_delta & ~np.isin(hashes, seen)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO seen_keys (source, key_hash) VALUES (?, ?)",
+            ((source, int(h)) for h in hashes[keep])
+        )
+        return df[keep]
+
+    def fold_ads(self, ads_df, row_key=None):
+        ads_data = normalize_column_names(ads_df)
+        actual_columns = resolve_table_mapping(ads_data, self.ads_mapping, 'ads', self.registry, required=REQUIRED_ADS_COLUMNS)['columns']
+        missing = [col for col in REQUIRED_ADS_COLUMNS if col not in actual_columns]
+        if missing:
+            raise MissingColumnsError(f"Отсутствуют обязательные столбцы: {missing}")
+
+        ads_data = self.drop_seen_rows(ads_data, 'ads', row_key)
+        ads = select_columns(ads_data, actual_columns, ADS_NUMERIC_COLUMNS)
+        ads = ads[ads['id'].notna()]
+        if 'cost_per_lead' not in ads.columns:
+            ads = ads.assign(cost_per_lead=np.nan)
+        else:
+            self.set_flag('has_cost_per_lead')
+
+        delta = ads.groupby(canonical_ids(ads['id'])).agg(
+            leads=('leads', 'sum'),
+            spent=('spent', 'sum'),
+            cpl_sum=('cost_per_lead', 'sum'),
+            cpl_count=('cost_per_lead', 'count')
+        )
+        self.conn.executemany(
+            "INSERT INTO ads_agg (id, leads, spent, cpl_sum, cpl_count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET leads = leads + excluded.leads, spent = spent + excluded.spent, "
+            "cpl_sum = cpl_sum + excluded.cpl_sum, cpl_count = cpl_count + excluded.cpl_count",
+            delta.reset_index().itertuples(index=False, name=None)
+        )
+        self.add_meta(ads_rows=len(ads))
+        self.attribute_pending()
+        self.conn.commit()
+        return len(ads)
+
+    def attribute_pending(self):
+        # Заказы CRM, ID из источника которых появился в хранилище только теперь: порядок дельт
+        # (сначала объявления или сначала CRM) не влияет на результат
+        pending = " FROM crm_pending WHERE id IN (SELECT id FROM ads_agg)"
+        columns = ', '.join(CRM_SUM_COLUMNS)
+        rows = self.conn.execute("SELECT COALESCE(SUM(rows), 0)" + pending).fetchone()[0]
+        if not rows:
+            return
+        self.conn.execute(
+            f"INSERT INTO crm_agg (id, {columns}) SELECT id, {columns}" + pending + " "
+            "ON CONFLICT(id) DO UPDATE SET " + ', '.join(f"{c} = {c} + excluded.{c}" for c in CRM_SUM_COLUMNS)
+        )
+        self.conn.execute("DELETE" + pending)
+        self.add_meta(crm_reklama_rows=rows, crm_drugoe_rows=-rows)
+
+    def fold_crm(self, crm_df, row_key=None):
+        crm_data = normalize_column_names(crm_df)
+        actual_columns = resolve_table_mapping(crm_data, self.crm_mapping, 'crm', self.registry, required=REQUIRED_CRM_COLUMNS)['columns']
+        missing = [col for col in REQUIRED_CRM_COLUMNS if col not in actual_columns]
+        if missing:
+            raise MissingColumnsError(f"Отсутствуют обязательные столбцы: {missing}")
+        has_revenue_data = 'revenue' in actual_columns
+
+        crm_data = self.drop_seen_rows(crm_data, 'crm', row_key)
+        crm_data_clean = select_columns(crm_data, actual_columns, CRM_NUMERIC_COLUMNS)
+        crm_data_clean['Тип источника'] = classify_sources(crm_data_clean['id'])
+        # ID в источниках вида utm_content=... ищутся среди объявлений, уже накопленных в хранилище
+        ads_ids = pd.Series([row[0] for row in self.conn.execute("SELECT id FROM ads_agg")], dtype=object)
+        attribute_crm_sources(crm_data_clean, ad_id_index(ads_ids), self.attribution_patterns)
+        crm_reklama, crm_drugoe = split_crm_sources(crm_data_clean)
+        if has_revenue_data:
+            self.set_flag('has_revenue_data')
+
+        delta = crm_sums(crm_reklama, has_revenue_data).groupby(canonical_ids(crm_reklama['id'])).sum()
+        self.conn.executemany(
+            f"INSERT INTO crm_agg (id, {', '.join(CRM_SUM_COLUMNS)}) VALUES (?{', ?' * len(CRM_SUM_COLUMNS)}) "
+            "ON CONFLICT(id) DO UPDATE SET " + ', '.join(f"{c} = {c} + excluded.{c}" for c in CRM_SUM_COLUMNS),
+            delta[CRM_SUM_COLUMNS].reset_index().itertuples(index=False, name=None)
+        )
+
+        # Источники с ID объявления, которого еще нет в хранилище, ждут его дельты в crm_pending
+        crm_tagged = crm_drugoe[crm_drugoe['id'].notna()]
+        if self.attribution_patterns and len(crm_tagged):
+            codes, pattern_codes, candidates = attribution_candidates(crm_tagged['id'], self.attribution_patterns)
+            candidate_ids = candidates.to_numpy()[codes]
+            has_candidate = pattern_codes[codes] < len(self.attribution_patterns)
+            pending = crm_sums(crm_tagged[has_candidate], has_revenue_data).assign(rows=1)
+            pending = pending.groupby(candidate_ids[has_candidate]).sum()[CRM_SUM_COLUMNS + ['rows']]
+            self.conn.executemany(
+                f"INSERT INTO crm_pending (id, {', '.join(CRM_SUM_COLUMNS)}, rows) VALUES (?{', ?' * (len(CRM_SUM_COLUMNS) + 1)}) "
+                "ON CONFLICT(id) DO UPDATE SET " + ', '.join(f"{c} = {c} + excluded.{c}" for c in CRM_SUM_COLUMNS + ['rows']),
+                pending.reset_index().itertuples(index=False, name=None)
+            )
+        self.add_meta(crm_rows=len(crm_data), crm_reklama_rows=len(crm_reklama), crm_drugoe_rows=len(crm_drugoe))
+        self.conn.commit()
+        return len(crm_data)
+
+    def analysis(self, progress_callback=None, rules=None):
+        # Метрики, средние и рекомендации пересчитываются по агрегатам - сырые строки не нужны
+        profiler = StageProfiler(progress_callback)
+        meta = self.meta()
+        has_revenue_data = bool(meta['has_revenue_data'])
+
+        with profiler.stage('read', 'хранилище агрегатов'):
+            ads = pd.read_sql_query(
+                "SELECT id, leads, spent, cpl_sum, cpl_count FROM ads_agg", self.conn,
+                dtype={'id': object, 'leads': 'float64', 'spent': 'float64', 'cpl_sum': 'float64', 'cpl_count': 'int64'}
+            )
+            crm = pd.read_sql_query(
+                "SELECT id, orders, revenue_sum, revenue_count, revenue_sumsq, order_rows FROM crm_agg", self.conn,
+                dtype={'id': object, 'orders': 'int64', 'revenue_sum': 'float64', 'revenue_count': 'int64', 'revenue_sumsq': 'float64', 'order_rows': 'int64'}
+            )
+
+        ads_data_clean = ads[['id', 'leads', 'spent']]
+        if meta['has_cost_per_lead']:
+            ads_data_clean = ads_data_clean.assign(cost_per_lead=ads['cpl_sum'] / ads['cpl_count'].replace(0, np.nan))
+
+        crm_reklama_agg = pd.DataFrame({'id': crm['id'], 'Количество заказов': crm['orders'] if has_revenue_data else crm['order_rows']})
+        if has_revenue_data:
+            crm_reklama_agg['Общая выручка'] = crm['revenue_sum'].round(2)
+            crm_reklama_agg['Средний чек'] = (crm['revenue_sum'] / crm['revenue_count'].replace(0, np.nan)).round(2)
+            crm_reklama_agg[ORDER_VALUE_COLUMNS] = crm[ORDER_VALUE_COLUMNS]
+
+        with profiler.stage('compact'):
+            ads_compact, crm_reklama_agg, memory = compact_frames(ads_data_clean, crm_reklama_agg)
+
+        analysis = build_analysis(ads_compact, crm_reklama_agg, meta['crm_drugoe_rows'], has_revenue_data, profiler, rules)
+        # Атрибуция выполняется при добавлении дельт, отчет по шаблонам в хранилище не ведется
+        analysis['attribution'] = None
+        analysis['data_info'] = {
+            'ads_count': len(ads),
+            'ads_rows': meta['ads_rows'],
+            'ads_columns': len(ads_data_clean.columns),
+            'crm_rows': meta['crm_rows'],
+            'crm_reklama_rows': meta['crm_reklama_rows'],
+            'crm_drugoe_rows': meta['crm_drugoe_rows'],
+            'memory': memory
+        }
+        analysis['profile'] = profiler.finish()
+        return analysis
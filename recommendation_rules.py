@@ -0,0 +1,298 @@
+# Правила рекомендаций в виде данных (JSON или YAML): условие над метриками объявления и базовыми
+# показателями выгрузки (baseline_stats), действие и подпись. Набор правил разбирается один раз и компилируется в выражения
+# над массивами NumPy - каждое правило считается одной маской сразу для всех объявлений
+import ast
+import json
+from functools import lru_cache
+
+import numpy as np
+
+from baseline_stats import BASELINE_STATS, BASELINE_VARIABLES, LEGACY_AVERAGES, METRIC_COLUMNS
+from confidence_intervals import INTERVAL_COLUMNS
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Переменные условий: метрики объявления (столбцы таблицы результата), границы их доверительных интервалов
+# и базовые показатели выгрузки
+RULE_METRICS = {**METRIC_COLUMNS, **INTERVAL_COLUMNS}
+RULE_STATS = BASELINE_VARIABLES
+
+# Для каких данных правило применяется: только с выручкой или только без нее
+RULE_REQUIRES = ('revenue', 'no_revenue')
+RULE_KEYS = {'name', 'when', 'action', 'label', 'requires', 'exclusive', 'default'}
+# Каждое правило - отдельный бит маски
+MAX_RULES = 64
+
+# Набор по умолчанию - та же логика, что у прежней функции determine_recommendation (low_data в ней
+# не срабатывает никогда: объявления без заказов раньше получают УДАЛИТЬ). exclusive - для сработавших
+# объявлений остальные правила не применяются, default - правило для объявлений, на которых не сработало ни одно другое
+DEFAULT_RULES = [
+    {'name': 'no_orders', 'when': 'orders == 0', 'action': 'УДАЛИТЬ', 'label': 'нет заказов', 'exclusive': True},
+    {'name': 'negative_roi', 'when': 'roi < 0', 'action': 'УДАЛИТЬ', 'label': 'отрицательный ROI', 'requires': 'revenue'},
+    {'name': 'low_roi', 'when': '0 <= roi < 50', 'action': 'ОПТИМИЗИРОВАТЬ', 'label': 'низкий ROI', 'requires': 'revenue'},
+    {'name': 'high_roi', 'when': 'roi > 150', 'action': 'МАСШТАБИРОВАТЬ', 'label': 'высокий ROI', 'requires': 'revenue'},
+    {'name': 'high_profit_roi', 'when': 'profit > 10000 and roi > 100', 'action': 'МАСШТАБИРОВАТЬ',
+     'label': 'высокая прибыль и ROI', 'requires': 'revenue'},
+    {'name': 'zero_conversion', 'when': 'conversion == 0', 'action': 'УДАЛИТЬ', 'label': 'нулевая конверсия',
+     'requires': 'no_revenue'},
+    {'name': 'low_conversion', 'when': 'conversion != 0 and conversion < avg_conversion * 0.5', 'action': 'ОПТИМИЗИРОВАТЬ',
+     'label': 'конверсия ниже среднего', 'requires': 'no_revenue'},
+    {'name': 'high_conversion', 'when': 'conversion > 30', 'action': 'МАСШТАБИРОВАТЬ', 'label': 'высокая конверсия',
+     'requires': 'no_revenue'},
+    {'name': 'many_leads', 'when': 'leads > avg_leads * 2 and conversion > avg_conversion', 'action': 'МАСШТАБИРОВАТЬ',
+     'label': 'много лидов и хорошая конверсия', 'requires': 'no_revenue'},
+    {'name': 'high_cpo', 'when': 'cpo > avg_cpo * 3 and cpo > 0', 'action': 'ОПТИМИЗИРОВАТЬ', 'label': 'высокая стоимость заказа'},
+    {'name': 'low_data', 'when': 'leads < 10 and orders == 0', 'action': 'ТЕСТИРОВАТЬ', 'label': 'мало данных'},
+    {'name': 'stable', 'default': True, 'action': 'НАБЛЮДАТЬ', 'label': 'стабильные показатели'}
+]
+
+# Устойчивый вариант: порог стоимости заказа - от медианы CPO, а не от среднего с отсечкой cpo < 100000
+# (avg_cpo сохранен в наборе по умолчанию, чтобы рекомендации совпадали с прежними)
+ROBUST_RULES = [
+    {**rule, 'when': 'cpo > median_cpo * 3 and cpo > 0'} if rule['name'] == 'high_cpo' else rule
+    for rule in DEFAULT_RULES
+]
+
+# Границы доверительных интервалов отделяют выводы по нескольким лидам от уверенных: объявление без заказов,
+# у которого верхняя граница конверсии не ниже медианной (с нулями), еще тестируется, а масштабируются
+# объявления с уверенно высокими метриками
+CONFIDENCE_CONDITIONS = {
+    'high_roi': 'roi > 150 and roi_low > 0',
+    'high_conversion': 'conversion > 30 and conversion_low > avg_conversion'
+}
+CONFIDENCE_RULES = [
+    {'name': 'low_data', 'when': 'orders == 0 and conversion_high >= median_conversion', 'action': 'ТЕСТИРОВАТЬ',
+     'label': 'мало данных', 'exclusive': True}
+] + [
+    {**rule, 'when': CONFIDENCE_CONDITIONS[rule['name']]} if rule['name'] in CONFIDENCE_CONDITIONS else rule
+    for rule in DEFAULT_RULES if rule['name'] != 'low_data'
+]
+
+# Встроенные наборы: имя -> подпись, чем рекомендации отличаются от набора по умолчанию, правила
+RULE_PRESETS = {
+    'default': ("По умолчанию", None, DEFAULT_RULES),
+    'robust': (
+        "Устойчивые пороги", "высокая стоимость заказа - CPO больше трех медиан, а не трех средних с отсечкой 100 000 ₽",
+        ROBUST_RULES
+    ),
+    'confidence': (
+        "С доверительными интервалами",
+        "объявления без заказов с широким интервалом конверсии - ТЕСТИРОВАТЬ вместо УДАЛИТЬ; высокий ROI и высокая "
+        "конверсия - только если нижняя граница интервала выше нуля и средней конверсии",
+        CONFIDENCE_RULES
+    )
+}
+
+def rules_json(rules):
+    return json.dumps({'rules': rules}, ensure_ascii=False, indent=2)
+
+RULE_PRESET_TEXTS = {name: rules_json(rules) for name, (label, change, rules) in RULE_PRESETS.items()}
+DEFAULT_RULES_TEXT = RULE_PRESET_TEXTS['default']
+
+# Допустимые конструкции условий: арифметика, сравнения, and/or/not, числа и переменные
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Compare,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Name, ast.Load, ast.Constant
+)
+
+class RuleSetError(ValueError):
+    pass
+
+class MaskExpression(ast.NodeTransformer):
+    # and/or/not и цепочки сравнений над массивами: and -> &, or -> |, not -> ~, a < b < c -> (a < b) & (b < c)
+    def combine(self, values, op):
+        result = values[0]
+        for value in values[1:]:
+            result = ast.BinOp(left=result, op=op, right=value)
+        return result
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        return self.combine(node.values, ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr())
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        parts = [
+            ast.Compare(left=left, ops=[op], comparators=[right])
+            for left, op, right in zip(operands, node.ops, operands[1:])
+        ]
+        return self.combine(parts, ast.BitAnd())
+
+def compile_condition(text, name):
+    try:
+        tree = ast.parse(str(text).strip(), mode='eval')
+    except SyntaxError as error:
+        raise RuleSetError(f"Правило '{name}': ошибка в условии '{text}': {error.msg}") from None
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise RuleSetError(f"Правило '{name}': недопустимая конструкция {type(node).__name__} в условии '{text}'")
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+            raise RuleSetError(f"Правило '{name}': в условии допустимы только числа, а не {node.value!r}")
+        if isinstance(node, ast.Name) and node.id not in RULE_METRICS and node.id not in RULE_STATS:
+            raise RuleSetError(
+                f"Правило '{name}': неизвестная переменная '{node.id}'. Доступны метрики {', '.join(RULE_METRICS)}, "
+                f"средние {', '.join(LEGACY_AVERAGES)} и показатели <показатель>_<метрика> "
+                f"({', '.join(BASELINE_STATS)}), например median_cpo"
+            )
+
+    names = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)})
+    tree = ast.fix_missing_locations(MaskExpression().visit(tree))
+    return compile(tree, f'<правило {name}>', 'eval'), names
+
+def parse_rules(text):
+    # JSON - всегда; YAML - если установлен PyYAML. Верхний уровень - список правил или {"rules": [...]}
+    stripped = text.strip()
+    if not stripped:
+        raise RuleSetError("Набор правил пуст")
+    if stripped[0] in '[{':
+        try:
+            data = json.loads(stripped)
+        except json.JSONDecodeError as error:
+            raise RuleSetError(f"Ошибка в JSON правил: {error}") from None
+    elif yaml is None:
+        raise RuleSetError("Для правил в формате YAML нужен пакет PyYAML; используйте JSON")
+    else:
+        try:
+            data = yaml.safe_load(stripped)
+        except yaml.YAMLError as error:
+            raise RuleSetError(f"Ошибка в YAML правил: {error}") from None
+
+    if isinstance(data, dict):
+        data = data.get('rules')
+    if not isinstance(data, list) or not data:
+        raise RuleSetError("Ожидается непустой список правил (или объект с ключом 'rules')")
+    return data
+
+class RuleSet:
+    def __init__(self, rules):
+        if len(rules) > MAX_RULES:
+            raise RuleSetError(f"Слишком много правил: {len(rules)}, допустимо не больше {MAX_RULES}")
+        # Маска - наименьший беззнаковый тип, в который помещаются биты всех правил
+        self.dtype = next(dtype for dtype, bits in ((np.uint16, 16), (np.uint32, 32), (np.uint64, 64)) if len(rules) <= bits)
+        self.rules = []
+        seen_names = set()
+
+        for position, rule in enumerate(rules):
+            if not isinstance(rule, dict):
+                raise RuleSetError(f"Правило №{position + 1}: ожидается объект с полями {sorted(RULE_KEYS)}")
+            name = str(rule.get('name') or f'rule_{position + 1}')
+            unknown = set(rule) - RULE_KEYS
+            if unknown:
+                raise RuleSetError(f"Правило '{name}': неизвестные поля {sorted(unknown)}")
+            if name in seen_names:
+                raise RuleSetError(f"Правило '{name}' объявлено дважды")
+            seen_names.add(name)
+            if not rule.get('action') or not rule.get('label'):
+                raise RuleSetError(f"Правило '{name}': поля 'action' и 'label' обязательны")
+            requires = rule.get('requires')
+            if requires is not None and requires not in RULE_REQUIRES:
+                raise RuleSetError(f"Правило '{name}': requires может быть {' или '.join(RULE_REQUIRES)}")
+
+            default = bool(rule.get('default', False))
+            if default:
+                code, names = None, []
+            elif rule.get('when') is None:
+                raise RuleSetError(f"Правило '{name}': нет условия 'when'")
+            else:
+                code, names = compile_condition(rule['when'], name)
+
+            action = str(rule['action']).strip().upper()
+            self.rules.append({
+                'name': name,
+                'flag': self.dtype(1 << position),
+                'action': action,
+                'text': f"{action} - {str(rule['label']).strip()}",
+                'requires': requires,
+                'exclusive': bool(rule.get('exclusive', False)),
+                'default': default,
+                'code': code,
+                'names': names
+            })
+
+        self.default_flags = self.dtype(0)
+        for rule in self.rules:
+            if rule['default']:
+                self.default_flags |= rule['flag']
+
+    def category_flags(self, action):
+        flags = self.dtype(0)
+        for rule in self.rules:
+            if rule['action'] == action:
+                flags |= rule['flag']
+        return flags
+
+    def variables(self, df, stats):
+        # Только переменные, которые есть в данных: правило с метрикой, которой нет (например, ROI без выручки), пропускается
+        namespace = {}
+        for name, column in RULE_METRICS.items():
+            if column in df.columns:
+                namespace[name] = df[column].to_numpy(dtype=float)
+        for name in RULE_STATS:
+            if name in stats:
+                namespace[name] = np.float64(stats[name])
+        return namespace
+
+    def applies(self, rule, has_revenue_data, namespace):
+        if rule['default']:
+            return False
+        if rule['requires'] == 'revenue' and not has_revenue_data:
+            return False
+        if rule['requires'] == 'no_revenue' and has_revenue_data:
+            return False
+        return all(name in namespace for name in rule['names'])
+
+    def evaluate(self, df, has_revenue_data, stats):
+        # NaN в сравнениях дает False
+        namespace = self.variables(df, stats)
+        size = len(df)
+        flags = np.zeros(size, dtype=self.dtype)
+        exclusive = np.zeros(size, dtype=bool)
+        exclusive_flags = np.zeros(size, dtype=self.dtype)
+
+        with np.errstate(all='ignore'):
+            for rule in self.rules:
+                if not self.applies(rule, has_revenue_data, namespace):
+                    continue
+                mask = np.broadcast_to(np.asarray(eval(rule['code'], {'__builtins__': {}}, namespace), dtype=bool), (size,))
+                flags[mask] |= rule['flag']
+                if rule['exclusive']:
+                    # Из нескольких исключающих правил действует первое по порядку
+                    first = mask & ~exclusive
+                    exclusive_flags[first] = rule['flag']
+                    exclusive |= mask
+
+        flags[exclusive] = exclusive_flags[exclusive]
+        flags[flags == 0] = self.default_flags
+        return flags
+
+    def recommendation_text(self, flags):
+        # Текст собирается один раз на каждую уникальную комбинацию правил; порядок - как в наборе
+        unique_flags, inverse = np.unique(flags, return_inverse=True)
+        texts = np.array([
+            "; ".join(rule['text'] for rule in self.rules if value & rule['flag'])
+            for value in unique_flags
+        ], dtype=object)
+        return texts[inverse]
+
+@lru_cache(maxsize=32)
+def compile_rule_set(text):
+    # Один и тот же текст правил разбирается и компилируется один раз
+    return RuleSet(parse_rules(text))
+
+def load_rule_set(path):
+    with open(path, encoding='utf-8') as f:
+        return compile_rule_set(f.read())
+
+DEFAULT_RULE_SET = RuleSet(DEFAULT_RULES)
@@ -0,0 +1,194 @@
+# Генератор синтетических выгрузок рекламного кабинета и CRM для нагрузочных замеров:
+#   python synthetic_exports.py --rows 1m --format csv xlsx --output-dir .benchmark_data
+# Заголовки берутся из ads_columns_mapping/crm_columns_mapping; источники CRM - смесь ID объявлений,
+# органики и мусорных значений; число заказов на объявление распределено с тяжелым хвостом
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from analysis_core import ORGANIC_SOURCE_KEYWORDS, ads_columns_mapping, crm_columns_mapping
+
+# Размеры наборов - число строк выгрузки CRM
+SYNTHETIC_SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+SYNTHETIC_FORMATS = ['csv', 'xlsx']
+# Строк на листе xlsx не больше, чем позволяет формат (одна строка - заголовок)
+EXCEL_MAX_ROWS = 1_048_575
+GENERATION_CHUNK_ROWS = 1_000_000
+
+# Форма данных
+CRM_ROWS_PER_AD = 20
+ADS_DAYS = 7
+ORGANIC_SHARE = 0.2
+# Доля ID объявлений, записанных с пробелами по краям (как при ручном вводе в CRM)
+PADDED_ID_SHARE = 0.01
+MISSING_REVENUE_SHARE = 0.05
+# Показатель степени в весах объявлений 1 / ранг^s: чем больше, тем сильнее перекос заказов
+ORDERS_SKEW = 1.1
+START_DATE = '2024-01-01'
+# Значения источника, которые встречаются в реальных выгрузках помимо органики
+JUNK_SOURCES = ['', ' ', '-', '12ab', 'utm_campaign=spring', None]
+
+def parse_scale(text):
+    # '100k', '1m' или просто число строк
+    return SYNTHETIC_SCALES.get(str(text).lower()) or int(text)
+
+def synthetic_headers(mapping, variant=0):
+    # variant выбирает вариант названия из сопоставления - проверка поиска столбцов на разных заголовках
+    return {key: names[variant % len(names)] for key, names in mapping.items()}
+
+def synthetic_ad_ids(n_ads, rng):
+    ids = np.unique(rng.integers(100_000_000, 999_999_999, int(n_ads * 1.1) + 10))[:n_ads]
+    return rng.permutation(ids)
+
+def ads_export(ids, rng, headers, dates=True, days=ADS_DAYS):
+    # Строка на объявление и день: лиды по Пуассону с разной частотой у объявлений, своя цена лида у каждого
+    n_ads = len(ids)
+    rate = rng.lognormal(1.0, 1.2, n_ads)
+    cpl = rng.lognormal(np.log(300), 0.6, n_ads)
+    leads = rng.poisson(np.repeat(rate, days))
+    spent = (np.maximum(leads, rng.random(len(leads)) < 0.3) * np.repeat(cpl, days) * rng.uniform(0.8, 1.2, len(leads))).round(2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost_per_lead = np.where(leads > 0, (spent / leads).round(2), np.nan)
+
+    ads = {
+        headers['id']: np.repeat(ids, days),
+        headers['leads']: leads,
+        headers['cost_per_lead']: cost_per_lead,
+        headers['spent']: spent
+    }
+    if dates:
+        day_offsets = np.tile(np.arange(days), n_ads)
+        ads[headers['date']] = (pd.Timestamp(START_DATE) + pd.to_timedelta(day_offsets, unit='D')).strftime('%d.%m.%Y')
+    return pd.DataFrame(ads)
+
+def order_weights(n_ads, rng):
+    # Вес объявления ~ 1 / ранг^ORDERS_SKEW, ранги перемешаны: немногие объявления дают большую часть заказов
+    weights = 1.0 / np.arange(1, n_ads + 1) ** ORDERS_SKEW
+    weights = rng.permutation(weights)
+    return weights / weights.sum()
+
+def crm_export_chunks(ids, rows, rng, headers, revenue=True, dates=True, days=ADS_DAYS, chunk_rows=GENERATION_CHUNK_ROWS):
+    weights = order_weights(len(ids), rng)
+    other_sources = np.array(list(ORGANIC_SOURCE_KEYWORDS) + JUNK_SOURCES, dtype=object)
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+        sources = ids[rng.choice(len(ids), n, p=weights)].astype(str).astype(object)
+        padded = rng.random(n) < PADDED_ID_SHARE
+        sources[padded] = ' ' + sources[padded] + ' '
+        organic = rng.random(n) < ORGANIC_SHARE
+        sources[organic] = other_sources[rng.integers(0, len(other_sources), organic.sum())]
+
+        crm = {
+            headers['clients']: 'Клиент ' + pd.Series(np.arange(start, start + n)).astype(str),
+            headers['id']: sources
+        }
+        if revenue:
+            amounts = rng.lognormal(np.log(5000), 0.8, n).round(2)
+            amounts[rng.random(n) < MISSING_REVENUE_SHARE] = np.nan
+            crm[headers['revenue']] = amounts
+        if dates:
+            day_offsets = rng.integers(0, days, n)
+            crm[headers['date']] = (pd.Timestamp(START_DATE) + pd.to_timedelta(day_offsets, unit='D')).strftime('%Y-%m-%d')
+        yield pd.DataFrame(crm)
+
+def generate_exports(rows, seed=0, revenue=True, dates=True, header_variant=0):
+    # Обе выгрузки целиком в памяти - для небольших наборов и замеров внутри процесса
+    rng = np.random.default_rng(seed)
+    ids = synthetic_ad_ids(max(1, rows // CRM_ROWS_PER_AD), rng)
+    ads = ads_export(ids, rng, synthetic_headers(ads_columns_mapping, header_variant), dates)
+    crm = pd.concat(
+        crm_export_chunks(ids, rows, rng, synthetic_headers(crm_columns_mapping, header_variant), revenue, dates),
+        ignore_index=True
+    )
+    return ads, crm
+
+def write_xlsx(path, frames):
+    # Построчная запись в режиме constant_memory: память не растет с размером листа
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    row_index = 0
+    for frame in frames:
+        if row_index == 0:
+            worksheet.write_row(0, 0, list(frame.columns))
+            row_index = 1
+        values = frame.astype(object).where(frame.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            worksheet.write_row(row_index, 0, row)
+            row_index += 1
+    workbook.close()
+
+def write_frames(path, frames, file_format):
+    if file_format == 'xlsx':
+        write_xlsx(path, frames)
+        return
+    for position, frame in enumerate(frames):
+        frame.to_csv(path, index=False, mode='w' if position == 0 else 'a', header=position == 0)
+
+def export_file_names(rows, file_format, seed=0, revenue=True, dates=True, header_variant=0):
+    suffix = f"{rows}_s{seed}{'' if revenue else '_norev'}{'' if dates else '_nodates'}_h{header_variant}.{file_format}"
+    return f"ads_{suffix}", f"crm_{suffix}"
+
+def write_exports(output_dir, rows, file_format='csv', seed=0, revenue=True, dates=True, header_variant=0, overwrite=False):
+    # Уже созданные файлы с теми же параметрами переиспользуются: генерация больших наборов занимает время
+    if file_format not in SYNTHETIC_FORMATS:
+        raise ValueError(f"Неизвестный формат: {file_format}")
+    if file_format == 'xlsx' and rows > EXCEL_MAX_ROWS:
+        raise ValueError(f"В xlsx помещается не больше {EXCEL_MAX_ROWS} строк, запрошено {rows}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    ads_path, crm_path = (
+        os.path.join(output_dir, name)
+        for name in export_file_names(rows, file_format, seed, revenue, dates, header_variant)
+    )
+    if not overwrite and os.path.exists(ads_path) and os.path.exists(crm_path):
+        return ads_path, crm_path
+
+    rng = np.random.default_rng(seed)
+    ids = synthetic_ad_ids(max(1, rows // CRM_ROWS_PER_AD), rng)
+    # Запись во временные файлы: прерванная генерация не оставляет неполных наборов
+    write_frames(ads_path + '.tmp', [ads_export(ids, rng, synthetic_headers(ads_columns_mapping, header_variant), dates)], file_format)
+    write_frames(
+        crm_path + '.tmp',
+        crm_export_chunks(ids, rows, rng, synthetic_headers(crm_columns_mapping, header_variant), revenue, dates),
+        file_format
+    )
+    os.replace(ads_path + '.tmp', ads_path)
+    os.replace(crm_path + '.tmp', crm_path)
+    return ads_path, crm_path
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Синтетические выгрузки рекламного кабинета и CRM")
+    parser.add_argument('--rows', nargs='+', default=['1k'],
+                        help=f"число строк CRM: {', '.join(SYNTHETIC_SCALES)} или число")
+    parser.add_argument('--format', nargs='+', choices=SYNTHETIC_FORMATS, default=['csv'], dest='formats')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-revenue', action='store_true', help="без столбца суммы заказов")
+    parser.add_argument('--no-dates', action='store_true', help="без столбцов дат")
+    parser.add_argument('--header-variant', type=int, default=0,
+                        help="номер варианта названий столбцов из сопоставления (0 - основные названия)")
+    parser.add_argument('--overwrite', action='store_true', help="пересоздать уже существующие файлы")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    written = []
+    for rows in args.rows:
+        for file_format in args.formats:
+            try:
+                written.extend(write_exports(
+                    args.output_dir, parse_scale(rows), file_format, args.seed, not args.no_revenue,
+                    not args.no_dates, args.header_variant, args.overwrite
+                ))
+            except ValueError as e:
+                print(f"Пропущено ({rows}, {file_format}): {e}", file=sys.stderr)
+    print(json.dumps(written, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import sqlite3
+
+from analysis_cli import main
+from synthetic_exports import generate_exports
+
+def history_runs(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT analysis_key FROM runs ORDER BY run_id").fetchall()
+    finally:
+        conn.close()
+
+def test_rerun_does_not_duplicate_history(tmp_path, capsys):
+    ads, crm = generate_exports(2000, seed=5, dates=False)
+    ads.to_csv(tmp_path / 'ads.csv', index=False)
+    crm.to_csv(tmp_path / 'crm.csv', index=False)
+    history = str(tmp_path / 'history.sqlite')
+    args = [
+        '--ads', str(tmp_path / 'ads.csv'), '--crm', str(tmp_path / 'crm.csv'), '--output-dir', str(tmp_path / 'out'),
+        '--history', history, '--no-cache', '--mapping-registry', str(tmp_path / 'registry.sqlite')
+    ]
+
+    assert main(args) == 0
+    assert main(args) == 0
+    assert len(history_runs(history)) == 1
+    assert main(args + ['--rules', 'robust']) == 0
+    runs = history_runs(history)
+    assert len(runs) == 2 and None not in {key for key, in runs}
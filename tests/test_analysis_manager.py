@@ -0,0 +1,108 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis_core import AnalysisCache, table_page
+from analysis_manager import JOB_CANCELLED, JOB_DONE, AnalysisCancelled, AnalysisManager, SessionMemoryExceeded, analysis_nbytes
+
+def blocking_compute(release):
+    # Расчет идет, пока не разрешат завершиться; на каждом шаге проверяется отмена
+    def compute(progress_callback):
+        while not release.wait(0.01):
+            progress_callback(50, "расчет")
+        return {'result_sorted': pd.DataFrame({'a': range(10)})}
+    return compute
+
+def test_cancel_waits_for_every_session():
+    manager = AnalysisManager(max_running=1)
+    release = threading.Event()
+    job_id = manager.submit('key', 'first', blocking_compute(release))
+    assert manager.submit('key', 'second', blocking_compute(release)) == job_id
+
+    assert not manager.cancel(job_id, 'first')
+    assert not manager.cancel(job_id, 'outsider')
+    assert manager.cancel(job_id, 'second')
+    with pytest.raises(AnalysisCancelled):
+        manager.wait(job_id, timeout=5)
+    assert manager.job_status(job_id)['status'] == JOB_CANCELLED
+
+def test_reattached_session_can_cancel():
+    manager = AnalysisManager(max_running=1)
+    release = threading.Event()
+    job_id = manager.submit('key', 'before_reload', blocking_compute(release))
+    # Браузер переподключился: та же задача открыта из новой сессии, старая отменила ее раньше
+    assert not manager.cancel(job_id, 'after_reload')
+    manager.join(job_id, 'after_reload')
+    assert not manager.cancel(job_id, 'before_reload')
+    assert manager.cancel(job_id, 'after_reload')
+    with pytest.raises(AnalysisCancelled):
+        manager.wait(job_id, timeout=5)
+
+def test_cancel_of_finished_job_reports_false():
+    manager = AnalysisManager(max_running=1)
+    release = threading.Event()
+    release.set()
+    job_id = manager.submit('key', 'session', blocking_compute(release))
+    assert manager.wait(job_id, timeout=5) is not None
+    assert manager.job_status(job_id)['status'] == JOB_DONE
+    assert not manager.cancel(job_id, 'session')
+
+def test_nbytes_counts_late_additions():
+    frame = pd.DataFrame({'a': np.arange(1000, dtype='int64')})
+    analysis = {'result_sorted': frame, 'delete_ads': frame}
+    base = analysis_nbytes(analysis)
+    assert 8000 <= base < 2 * 8000
+
+    windows = AnalysisCache()
+    windows.put('w', {'window_ads': pd.DataFrame({'b': np.zeros(1000)})})
+    analysis.update({
+        'excel_report': b'x' * 5000,
+        'sort_indices': {('result_sorted', 'a', True): np.arange(1000)},
+        'budget_inputs': {'ids': np.array([str(i) * 20 for i in range(1000)], dtype=object)},
+        'timeseries_windows': windows
+    })
+    assert analysis_nbytes(analysis) > base + 5000 + 8000 + 20 * 1000 + 8000
+
+def test_referenced_results_are_not_evicted():
+    manager = AnalysisManager(max_running=1, memory_budget_mb=1)
+    big = lambda progress_callback: {'result_sorted': pd.DataFrame({'a': np.zeros(100_000)})}
+    manager.wait(manager.submit('open', 'first', big), timeout=5)
+    manager.wait(manager.submit('closed', 'second', big), timeout=5)
+    manager.release('second')
+    manager.wait(manager.submit('new', 'third', big), timeout=5)
+
+    assert manager.get('open', 'first') is not None
+    assert manager.get('new', 'third') is not None
+    assert manager.get('closed', 'second') is None
+
+def test_sort_orders_are_stored_through_manager():
+    manager = AnalysisManager(max_running=1)
+    frame = pd.DataFrame({'a': np.random.default_rng(0).random(200_000)})
+    analysis = manager.wait(manager.submit('key', 'session', lambda progress_callback: {'result_sorted': frame}), timeout=5)
+    before = manager.stats()['memory_mb']
+
+    page = table_page(analysis, 'result_sorted', 0, 10, 'a', True, lambda: manager.updating('key'))
+    assert (page['a'].to_numpy() == np.sort(frame['a'].to_numpy())[:10]).all()
+    assert ('result_sorted', 'a', True) in analysis['sort_indices']
+    assert manager.stats()['memory_mb'] >= before + 1.5
+
+def test_session_budget_limits_new_analyses():
+    manager = AnalysisManager(max_running=2, session_budget_mb=1)
+    release = threading.Event()
+    # Один расчет допускается даже сверх бюджета сессии
+    job_id = manager.submit('first', 'session', blocking_compute(release), input_bytes=2**20)
+    assert manager.session_memory('session') == 10 * 2**20
+    with pytest.raises(SessionMemoryExceeded):
+        manager.submit('second', 'session', blocking_compute(release), input_bytes=2**20)
+    # Другая сессия с тем же анализом делит его резерв, свой бюджет не расходует
+    assert manager.submit('first', 'other', blocking_compute(release)) == job_id
+    assert manager.session_memory('session') == manager.session_memory('other') == 5 * 2**20
+
+    release.set()
+    manager.wait(job_id, timeout=5)
+    # Новый анализ заменяет открытый результат: он больше не считается за сессией
+    assert manager.session_memory('session') > 0
+    manager.wait(manager.submit('second', 'session', blocking_compute(release), input_bytes=2**20), timeout=5)
+    assert manager.stats()['session_budget_mb'] == 1
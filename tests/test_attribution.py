@@ -0,0 +1,32 @@
+import pandas as pd
+
+from analysis_core import analyze
+from incremental_store import IncrementalStore
+
+def exports():
+    # ID объявления совпадает с цифрами телефона и номера заказа в источниках CRM
+    ads = pd.DataFrame({'ID объявления': [9123456789, 100001], 'Результат': [50, 40], 'Потрачено всего, ₽': [5000.0, 4000.0]})
+    crm = pd.DataFrame({
+        'Клиенты': ['Иванов', 'Петров', 'Сидоров', 'Козлов'],
+        'ID объявления': ['Звонок +7 9123456789', 'Заказ 100001 от 2024-05-01', 'id=9123456789', 'vk id:100001'],
+        'Сумма заказов': [1000.0, 2000.0, 3000.0, 4000.0]
+    })
+    return ads, crm
+
+def test_numbers_without_label_are_not_ad_ids():
+    ads, crm = exports()
+    analysis = analyze(ads, crm)
+    attribution = analysis['attribution']
+    assert attribution['matched'].sum() == 2
+    assert attribution.loc['id', 'matched'] == 2
+    assert analysis['data_info']['crm_drugoe_rows'] == 2
+    orders = analysis['result_sorted'].set_index('ID объявления')['Количество заказов']
+    assert orders.to_dict() == {9123456789: 1, 100001: 1}
+
+def test_phone_numbers_do_not_wait_for_ads(tmp_path):
+    ads, crm = exports()
+    with IncrementalStore(str(tmp_path / 'store.sqlite')) as store:
+        store.fold_crm(crm)
+        assert store.conn.execute("SELECT COALESCE(SUM(rows), 0) FROM crm_pending").fetchone()[0] == 2
+        store.fold_ads(ads)
+        assert store.analysis()['data_info']['crm_drugoe_rows'] == 2
@@ -0,0 +1,54 @@
+import pandas as pd
+
+from analysis_core import REQUIRED_CRM_COLUMNS, analyze, crm_columns_mapping
+from column_mapping import MappingRegistry, needs_confirmation, registry_changed, resolve_table_mapping
+from synthetic_exports import generate_exports
+
+def crm_sample():
+    # Все заголовки отличаются от ожидаемых - сопоставляются только нечетким поиском
+    return pd.DataFrame({
+        'Клиент (ФИО)': ['Иванов', 'Петров'],
+        'Источник заказа': ['100001', '100002'],
+        'Сумма заказа, руб': [1000.0, 2500.0]
+    })
+
+def test_optional_fuzzy_columns_are_only_suggested():
+    resolution = resolve_table_mapping(crm_sample(), crm_columns_mapping, 'crm', required=REQUIRED_CRM_COLUMNS)
+    assert resolution['columns'] == {'clients': 'Клиент (ФИО)', 'id': 'Источник заказа'}
+    assert resolution['suggested'] == {'revenue': 'Сумма заказа, руб'}
+    assert needs_confirmation(resolution)
+
+    confirmed = resolve_table_mapping(
+        crm_sample(), crm_columns_mapping, 'crm', overrides={'revenue': 'Сумма заказа, руб'}, required=REQUIRED_CRM_COLUMNS
+    )
+    assert confirmed['columns']['revenue'] == 'Сумма заказа, руб'
+    assert confirmed['suggested'] == {}
+
+def test_analysis_without_confirmed_revenue_has_no_revenue_data():
+    ads, crm = generate_exports(2000, seed=4, dates=False)
+    analysis = analyze(ads, crm.rename(columns={'Сумма заказов': 'Сумма заказа, руб'}))
+    assert not analysis['summary_stats']['has_revenue_data']
+    assert analysis['data_info']['column_mapping']['crm']['suggested'] == {'revenue': 'Сумма заказа, руб'}
+
+def test_registry_change_for_other_headers_keeps_result(tmp_path):
+    registry = MappingRegistry(str(tmp_path / 'registry.sqlite'))
+    resolution = resolve_table_mapping(crm_sample(), crm_columns_mapping, 'crm', registry, required=REQUIRED_CRM_COLUMNS)
+    other = resolve_table_mapping(crm_sample().rename(columns={'Источник заказа': 'Источник'}), crm_columns_mapping, 'crm', registry)
+
+    registry.remember(other)
+    assert not registry_changed(resolution, registry)
+    registry.remember(resolution)
+    assert registry_changed(resolution, registry)
+    assert resolve_table_mapping(crm_sample(), crm_columns_mapping, 'crm', registry)['columns']['revenue'] == 'Сумма заказа, руб'
+
+def test_registry_entry_without_key_keeps_exact_match(tmp_path):
+    # Запись сохранена до появления столбца выручки в сопоставлении: точный заголовок все равно находится
+    registry = MappingRegistry(str(tmp_path / 'registry.sqlite'))
+    sample = pd.DataFrame({'Клиент (ФИО)': ['Иванов'], 'Источник заказа': ['100001'], 'Сумма заказов': [1000.0], 'Итог': [1.0]})
+    resolution = resolve_table_mapping(sample, crm_columns_mapping, 'crm', required=REQUIRED_CRM_COLUMNS)
+    registry.put(resolution['signature'], 'crm', resolution['headers'], {'clients': 'Клиент (ФИО)', 'id': 'Источник заказа'})
+
+    resolved = resolve_table_mapping(sample, crm_columns_mapping, 'crm', registry, required=REQUIRED_CRM_COLUMNS)
+    assert resolved['columns'] == {'clients': 'Клиент (ФИО)', 'id': 'Источник заказа', 'revenue': 'Сумма заказов'}
+    assert resolved['methods'] == {'clients': 'registry', 'id': 'registry', 'revenue': 'exact'}
+    assert resolved['suggested'] == {}
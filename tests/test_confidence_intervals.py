@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from analysis_core import ads_columns_mapping, analyze, crm_columns_mapping, run_analysis_pipeline
+from confidence_intervals import INTERVAL_COLUMNS, confidence_intervals, order_value_moments
+from incremental_store import IncrementalStore
+from recommendation_rules import RULE_PRESET_TEXTS, compile_rule_set
+from synthetic_exports import generate_exports
+
+def test_zero_order_ads_have_no_roi_bounds():
+    # Объявление без заказов: фактический ROI -100%, границы ROI не определены, конверсия - определена
+    leads = np.array([10.0, 100.0])
+    orders = np.array([0.0, 10.0])
+    spent = np.array([1000.0, 1000.0])
+    values = order_value_moments([0, 10], [0, 50000], [0, 10 * 5000.0 ** 2 + 10 * 1000.0 ** 2])
+    result = confidence_intervals(leads, orders, spent, values)
+
+    assert np.isnan(result['roi_low'][0]) and np.isnan(result['roi_high'][0])
+    assert np.isfinite(result['conversion_high'][0])
+    roi = (orders[1] * 5000 / spent[1] - 1) * 100
+    assert result['roi_low'][1] < roi < result['roi_high'][1]
+    assert (result['conversion_low'] <= result['conversion_post']).all()
+    assert (result['conversion_post'] <= result['conversion_high']).all()
+
+def test_no_revenue_data_has_no_roi_bounds():
+    result = confidence_intervals([10.0, 100.0], [1.0, 10.0], [1000.0, 1000.0])
+    assert 'roi_low' not in result and 'roi_high' not in result
+
+def interval_frame(analysis):
+    columns = ['ID объявления'] + [column for column in INTERVAL_COLUMNS.values() if column in analysis['result_sorted']]
+    return analysis['result_sorted'][columns].sort_values('ID объявления', ignore_index=True)
+
+def test_intervals_do_not_depend_on_ingestion_path(tmp_path):
+    ads, crm = generate_exports(10_000, seed=1, dates=False)
+    ads_bytes = ads.to_csv(index=False).encode('utf-8')
+    crm_bytes = crm.to_csv(index=False).encode('utf-8')
+    args = (ads_bytes, 'ads.csv', crm_bytes, 'crm.csv', ads_columns_mapping, crm_columns_mapping)
+    batch = run_analysis_pipeline(*args)
+    streaming = run_analysis_pipeline(*args, crm_chunksize=1000)
+    pd.testing.assert_frame_equal(interval_frame(batch), interval_frame(streaming))
+
+    with IncrementalStore(str(tmp_path / 'store.sqlite')) as store:
+        store.fold_ads(ads)
+        store.fold_crm(crm)
+        incremental = store.analysis()
+    # В хранилище ID - текст; суммы накапливаются в другом порядке - расхождение в пределах округления
+    expected = interval_frame(batch)
+    actual = interval_frame(incremental)
+    actual['ID объявления'] = actual['ID объявления'].astype('int64')
+    pd.testing.assert_frame_equal(expected, actual.sort_values('ID объявления', ignore_index=True), atol=0.011, check_dtype=False)
+
+def test_confidence_preset_tests_ads_with_little_data():
+    ads = pd.DataFrame({'ID объявления': [1, 2, 3, 4], 'Результат': [2, 200, 100, 50], 'Потрачено всего, ₽': [100, 5000, 3000, 1000]})
+    crm = pd.DataFrame({'Клиенты': ['Клиент'] * 30, 'Сумма заказов': [1000.0] * 30, 'ID объявления': ['3'] * 20 + ['4'] * 10})
+    rules = compile_rule_set(RULE_PRESET_TEXTS['confidence'])
+    recommendations = analyze(ads, crm, rules=rules)['result_sorted'].set_index('ID объявления')['Рекомендация']
+    assert recommendations[1] == "ТЕСТИРОВАТЬ - мало данных"
+    assert recommendations[2] == "УДАЛИТЬ - нет заказов"
@@ -0,0 +1,29 @@
+from io import BytesIO
+
+import pandas as pd
+
+from analysis_core import ads_columns_mapping, crm_columns_mapping, run_analysis_pipeline
+from synthetic_exports import generate_exports
+
+def csv_bytes(df):
+    buffer = BytesIO()
+    df.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+def test_streaming_matches_full_read_on_text_revenue():
+    # Текст в столбце выручки ("1 200", "—", "n/a") не должен ломать потоковую агрегацию
+    ads, crm = generate_exports(3000, seed=6, dates=False)
+    revenue = crm['Сумма заказов'].astype(object)
+    revenue.iloc[::7] = '1 200'
+    revenue.iloc[1::11] = '—'
+    revenue.iloc[2::13] = 'n/a'
+    crm['Сумма заказов'] = revenue
+    ads_bytes, crm_bytes = csv_bytes(ads), csv_bytes(crm)
+
+    results = [
+        run_analysis_pipeline(ads_bytes, 'ads.csv', crm_bytes, 'crm.csv', ads_columns_mapping, crm_columns_mapping, crm_chunksize=chunksize)
+        for chunksize in (None, 500)
+    ]
+    assert all(result['summary_stats']['has_revenue_data'] for result in results)
+    pd.testing.assert_frame_equal(results[0]['result_sorted'], results[1]['result_sorted'], check_dtype=False)
+    assert results[0]['summary_stats'] == results[1]['summary_stats']
@@ -0,0 +1,84 @@
+import pandas as pd
+
+from analysis_core import analyze
+from incremental_store import IncrementalStore
+from synthetic_exports import generate_exports
+
+def tagged_exports():
+    # Часть заказов CRM ссылается на объявления через метки в источнике
+    ads, crm = generate_exports(4000, seed=2, dates=False)
+    ad_ids = ads['ID объявления'].drop_duplicates().to_numpy()
+    tagged = pd.DataFrame({
+        'Клиенты': ['Клиент'] * 5,
+        'ID объявления': [f'utm_content={ad_ids[0]}&utm_source=vk', f'vk_ad_{ad_ids[1]}', f'vk_ad_{ad_ids[1]}', 'utm_content=999999999', 'сайт'],
+        'Сумма заказов': [1000.0, 2000.0, 3000.0, 4000.0, 5000.0]
+    })
+    return ads, pd.concat([crm, tagged], ignore_index=True)
+
+def store_frame(analysis):
+    frame = analysis['result_sorted'].assign(**{'ID объявления': lambda df: df['ID объявления'].astype('int64')})
+    return frame.sort_values('ID объявления', ignore_index=True)
+
+def test_fold_order_does_not_change_result(tmp_path):
+    ads, crm = tagged_exports()
+    half = len(ads) // 2
+    results = {}
+    for order in ('ads_first', 'crm_first'):
+        with IncrementalStore(str(tmp_path / f'{order}.sqlite')) as store:
+            if order == 'ads_first':
+                store.fold_ads(ads.iloc[:half])
+                store.fold_ads(ads.iloc[half:])
+                store.fold_crm(crm)
+            else:
+                store.fold_crm(crm)
+                store.fold_ads(ads.iloc[:half])
+                store.fold_ads(ads.iloc[half:])
+            results[order] = store.analysis()
+
+    pd.testing.assert_frame_equal(store_frame(results['ads_first']), store_frame(results['crm_first']))
+    batch = analyze(ads, crm)
+    for result in results.values():
+        for key in ('crm_rows', 'crm_reklama_rows', 'crm_drugoe_rows'):
+            assert result['data_info'][key] == batch['data_info'][key]
+        assert result['summary_stats']['total_orders_reklama'] == batch['summary_stats']['total_orders_reklama']
+
+def test_ads_count_is_number_of_ads(tmp_path):
+    ads, crm = generate_exports(2000, seed=3, dates=False)
+    with IncrementalStore(str(tmp_path / 'store.sqlite')) as store:
+        store.fold_ads(ads)
+        store.fold_ads(ads)
+        store.fold_crm(crm)
+        data_info = store.analysis()['data_info']
+    assert data_info['ads_count'] == ads['ID объявления'].nunique()
+    assert data_info['ads_rows'] == 2 * len(ads)
+
+def test_deltas_with_and_without_revenue_match_full_run(tmp_path):
+    # Часть дельт CRM без столбца выручки, в них есть строки без клиента: число заказов считается
+    # так же, как при анализе всех строк сразу
+    ads, crm = generate_exports(4000, seed=7, dates=False)
+    crm.loc[crm.index[::9], 'Клиенты'] = None
+    half = len(crm) // 2
+    deltas = [crm.iloc[:half].drop(columns=['Сумма заказов']), crm.iloc[half:]]
+    batch = store_frame(analyze(ads, pd.concat(deltas, ignore_index=True)))
+
+    for name, order in (('revenue_last', deltas), ('revenue_first', deltas[::-1])):
+        with IncrementalStore(str(tmp_path / f'{name}.sqlite')) as store:
+            store.fold_ads(ads)
+            for delta in order:
+                store.fold_crm(delta)
+            result = store_frame(store.analysis())
+        pd.testing.assert_frame_equal(
+            result[['ID объявления', 'Количество заказов', 'Общая выручка']],
+            batch[['ID объявления', 'Количество заказов', 'Общая выручка']],
+            check_dtype=False
+        )
+
+    # Без выручки во всех дельтах заказом считается каждая строка
+    no_revenue = [delta.drop(columns=['Сумма заказов'], errors='ignore') for delta in deltas]
+    with IncrementalStore(str(tmp_path / 'no_revenue.sqlite')) as store:
+        store.fold_ads(ads)
+        for delta in no_revenue:
+            store.fold_crm(delta)
+        result = store_frame(store.analysis())
+    expected = store_frame(analyze(ads, pd.concat(no_revenue, ignore_index=True)))
+    pd.testing.assert_series_equal(result['Количество заказов'], expected['Количество заказов'], check_dtype=False)
@@ -0,0 +1,104 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis_core import analyze
+from baseline_stats import baseline_statistics
+from recommendation_rules import DEFAULT_RULE_SET
+from synthetic_exports import generate_exports
+
+# Прежняя построчная функция рекомендаций - эталон для набора правил по умолчанию
+def determine_recommendation(row, has_revenue_data, avg_conversion, avg_roi, avg_cpo, avg_leads):
+    recommendations = []
+
+    if row['Количество заказов'] == 0:
+        recommendations.append("УДАЛИТЬ - нет заказов")
+        return "; ".join(recommendations)
+
+    if has_revenue_data:
+        if row['ROI, %'] < 0:
+            recommendations.append("УДАЛИТЬ - отрицательный ROI")
+        elif row['ROI, %'] < 50:
+            recommendations.append("ОПТИМИЗИРОВАТЬ - низкий ROI")
+
+        if row['ROI, %'] > 150:
+            recommendations.append("МАСШТАБИРОВАТЬ - высокий ROI")
+
+        if row['Прибыль'] > 10000 and row['ROI, %'] > 100:
+            recommendations.append("МАСШТАБИРОВАТЬ - высокая прибыль и ROI")
+    else:
+        if row['Конверсия, %'] == 0:
+            recommendations.append("УДАЛИТЬ - нулевая конверсия")
+        elif row['Конверсия, %'] < avg_conversion * 0.5:
+            recommendations.append("ОПТИМИЗИРОВАТЬ - конверсия ниже среднего")
+
+        if row['Конверсия, %'] > 30:
+            recommendations.append("МАСШТАБИРОВАТЬ - высокая конверсия")
+
+        if row['Лиды'] > avg_leads * 2 and row['Конверсия, %'] > avg_conversion:
+            recommendations.append("МАСШТАБИРОВАТЬ - много лидов и хорошая конверсия")
+
+    if row['CPO, ₽'] > avg_cpo * 3 and row['CPO, ₽'] > 0:
+        recommendations.append("ОПТИМИЗИРОВАТЬ - высокая стоимость заказа")
+
+    if row['Лиды'] < 10 and row['Количество заказов'] == 0:
+        recommendations.append("ТЕСТИРОВАТЬ - мало данных")
+
+    if not recommendations:
+        recommendations.append("НАБЛЮДАТЬ - стабильные показатели")
+
+    return "; ".join(recommendations)
+
+def reference_recommendations(df, has_revenue_data):
+    # Средние - с тем же отбором значений, что и в прежнем коде
+    if has_revenue_data:
+        avg_roi = df[df['ROI, %'] != 0]['ROI, %'].mean()
+    else:
+        avg_roi = 0
+    avg_conversion = df[df['Конверсия, %'] != 0]['Конверсия, %'].mean()
+    avg_cpo = df[(df['CPO, ₽'] != 0) & (df['CPO, ₽'] < 100000)]['CPO, ₽'].mean()
+    avg_leads = df['Лиды'].mean()
+    return df.apply(
+        lambda row: determine_recommendation(row, has_revenue_data, avg_conversion, avg_roi, avg_cpo, avg_leads),
+        axis=1
+    )
+
+@pytest.mark.parametrize('revenue', [True, False])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_default_rules_match_reference(revenue, seed):
+    ads, crm = generate_exports(20_000, seed=seed, revenue=revenue, dates=False)
+    analysis = analyze(ads, crm)
+    result = analysis['result_sorted']
+    expected = reference_recommendations(result, revenue)
+
+    assert len(result) == 1000
+    mismatched = result.loc[result['Рекомендация'] != expected, ['ID объявления', 'Рекомендация']]
+    assert mismatched.empty, mismatched.assign(expected=expected[mismatched.index]).head(10).to_string()
+
+    # Категории - как прежний отбор по тексту рекомендации
+    for key, action in (('delete_ads', 'УДАЛИТЬ'), ('scale_ads', 'МАСШТАБИРОВАТЬ'), ('optimize_ads', 'ОПТИМИЗИРОВАТЬ')):
+        assert set(analysis[key].index) == set(result.index[expected.str.contains(action)])
+
+@pytest.mark.parametrize('revenue', [True, False])
+def test_default_rules_match_reference_on_boundaries(revenue):
+    # Значения на границах порогов: ROI 0/50/100/150, нулевые конверсия и CPO, объявления без заказов
+    rows = []
+    for orders, leads, roi, profit, cpo in itertools.product(
+        [0, 1, 5], [0, 3, 9, 10, 400], [-10, 0, 50, 100, 150, 151], [0, 10000, 10001], [0, 100, 5000]
+    ):
+        rows.append({
+            'Количество заказов': orders, 'Лиды': leads, 'Затраты, ₽': cpo * orders,
+            'Конверсия, %': orders / leads * 100 if leads else 0, 'CPO, ₽': cpo, 'CPL, ₽': 0,
+            'ROI, %': roi, 'Прибыль': profit, 'Общая выручка': 0, 'Средний чек': 0, 'ROMI': 0
+        })
+    df = pd.DataFrame(rows)
+    if not revenue:
+        df = df.drop(columns=['ROI, %', 'Прибыль', 'Общая выручка', 'Средний чек', 'ROMI'])
+
+    flags = DEFAULT_RULE_SET.evaluate(df, revenue, baseline_statistics(df, revenue))
+    actual = pd.Series(DEFAULT_RULE_SET.recommendation_text(flags), index=df.index)
+    expected = reference_recommendations(df, revenue)
+    assert (actual == expected).all(), df[actual != expected].assign(actual=actual, expected=expected).head(10).to_string()
+    assert np.unique(flags).size > 1
@@ -1,10 +1,40 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import re
 import datetime
-from io import BytesIO
 import base64
+import math
+import sqlite3
+import time
+import uuid
+
+from analysis_core import (
+    CRM_CSV_CHUNK_SIZE,
+    EXCEL_ENGINES,
+    INPUT_CACHE_DIR,
+    RECOMMENDATION_CATEGORIES,
+    MissingColumnsError,
+    StageProfiler,
+    TABLE_PAGE_SIZES,
+    ads_columns_mapping,
+    compute_analysis_key,
+    create_excel_report,
+    create_parquet_archive,
+    crm_columns_mapping,
+    attribution_report,
+    pyarrow_available,
+    run_analysis_pipeline,
+    table_page
+)
+from analysis_charts import analysis_figures
+from analysis_history import CATEGORY_BITS, DEFAULT_ACCOUNT, ROLLUP_PERIODS, AnalysisHistory
+from analysis_manager import JOB_CANCELLED, JOB_DONE, JOB_ERROR, JOB_FINISHED, JOB_QUEUED, AnalysisManager, SessionMemoryExceeded
+from analysis_timeseries import TIMESERIES_FREQUENCIES, timeseries_date_range, timeseries_window
+from baseline_stats import baseline_table
+from budget_simulator import DEFAULT_ELASTICITY, MAX_SPEND_MULTIPLIER, budget_inputs, simulate_budget
+from column_mapping import COLUMN_LABELS, MAPPING_METHODS, MappingRegistry, needs_confirmation, registry_changed
+from confidence_intervals import CONFIDENCE_LEVEL
+from recommendation_rules import DEFAULT_RULES_TEXT, RULE_PRESET_TEXTS, RULE_PRESETS, RuleSetError, compile_rule_set
 
 # Настройка страницы
 st.set_page_config(
@@ -64,113 +94,218 @@ st.markdown("---")
 # Инициализация состояния сессии
 if 'analysis_done' not in st.session_state:
     st.session_state.analysis_done = False
-if 'result_sorted' not in st.session_state:
-    st.session_state.result_sorted = None
-if 'delete_ads' not in st.session_state:
-    st.session_state.delete_ads = None
-if 'scale_ads' not in st.session_state:
-    st.session_state.scale_ads = None
-if 'optimize_ads' not in st.session_state:
-    st.session_state.optimize_ads = None
-if 'summary_stats' not in st.session_state:
-    st.session_state.summary_stats = None
+# Таблицы результата в сессии не хранятся: сессия держит только ключ результата в общем менеджере анализов
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'analysis_key' not in st.session_state:
+    st.session_state.analysis_key = None
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
+if 'column_overrides' not in st.session_state:
+    st.session_state.column_overrides = {}
+if 'rules_text' not in st.session_state:
+    st.session_state.rules_text = DEFAULT_RULES_TEXT
 
 # Функции для обработки данных
-def normalize_column_names(df):
-    rename_dict = {}
-    for col in df.columns:
-        clean_col = col.strip()
-        clean_col = re.sub(r'\s+', ' ', clean_col)
-        clean_col = re.sub(r'\s*,\s*', ', ', clean_col)
-        rename_dict[col] = clean_col
-    return df.rename(columns=rename_dict)
-
-def find_column(df, possible_names):
-    for name in possible_names:
-        if name in df.columns:
-            return name
-    return None
-
-def classify_source(source):
-    if pd.isna(source) or source == '' or source == ' ':
-        return 'Другое'
-    
-    source_str = str(source).lower().strip()
-    
-    if re.match(r'^\d+$', source_str):
-        return 'Рекламное объявление'
-    
-    organic_keywords = [
-        'organic', 'direct', 'none', 'null', 'undefined', 
-        'сайт', 'site', 'organic', 'прямой', 'рекомендация',
-        'recommendation', 'поиск', 'search', 'google', 'yandex',
-        'соцсети', 'social', 'vk', 'facebook', 'instagram',
-        'telegram', 'whatsapp', 'email', 'рассылка', 'unknown',
-        'не указано', 'другое', 'other'
-    ]
-    
-    for keyword in organic_keywords:
-        if keyword in source_str:
-            return 'Другое'
-    
-    if not re.match(r'^\d+$', source_str):
-        return 'Другое'
-    
-    return 'Рекламное объявление'
-
-def determine_recommendation(row, has_revenue_data, avg_conversion, avg_roi, avg_cpo, avg_leads):
-    recommendations = []
-    
-    if row['Количество заказов'] == 0:
-        recommendations.append("УДАЛИТЬ - нет заказов")
-        return "; ".join(recommendations)
-    
-    if has_revenue_data:
-        if row['ROI, %'] < 0:
-            recommendations.append("УДАЛИТЬ - отрицательный ROI")
-        elif row['ROI, %'] < 50:
-            recommendations.append("ОПТИМИЗИРОВАТЬ - низкий ROI")
-        
-        if row['ROI, %'] > 150:
-            recommendations.append("МАСШТАБИРОВАТЬ - высокий ROI")
-        
-        if row['Прибыль'] > 10000 and row['ROI, %'] > 100:
-            recommendations.append("МАСШТАБИРОВАТЬ - высокая прибыль и ROI")
+@st.cache_resource
+def get_analysis_manager():
+    return AnalysisManager()
+
+@st.cache_resource
+def get_analysis_history():
+    return AnalysisHistory()
+
+@st.cache_resource
+def get_mapping_registry():
+    return MappingRegistry()
+
+def show_column_mapping_editor(resolutions):
+    # Найденные сопоставления можно поправить; подтвержденные сохраняются в реестр и при следующей
+    # загрузке выгрузок с такими же заголовками применяются без вопросов
+    with st.form("column_mapping_form"):
+        overrides = {}
+        cols = st.columns(2)
+        for col, (kind, title, mapping) in zip(cols, (
+            ('ads', "Рекламные данные", ads_columns_mapping),
+            ('crm', "CRM данные", crm_columns_mapping)
+        )):
+            resolution = resolutions[kind]
+            options = [None] + resolution['headers']
+            overrides[kind] = {}
+            with col:
+                st.markdown(f"**{title}**")
+                for key in mapping:
+                    current = resolution['columns'].get(key, resolution['suggested'].get(key))
+                    method = 'suggested' if key in resolution['suggested'] else resolution['methods'].get(key)
+                    label = COLUMN_LABELS.get(key, key)
+                    if method is not None:
+                        label += f" ({MAPPING_METHODS[method]})"
+                    choice = st.selectbox(label, options, index=options.index(current) if current in options else 0,
+                                          format_func=lambda header: "— нет —" if header is None else header,
+                                          key=f"mapping_{resolution['signature']}_{key}")
+                    if choice is not None:
+                        overrides[kind][key] = choice
+        
+        if st.form_submit_button("✅ Подтвердить сопоставление", type="primary"):
+            registry = get_mapping_registry()
+            for kind, resolution in resolutions.items():
+                registry.put(resolution['signature'], kind, resolution['headers'], overrides[kind])
+            st.session_state.column_overrides = overrides
+            st.rerun()
+
+def load_rules_file():
+    # Загруженный файл правил заменяет текст в редакторе
+    rules_file = st.session_state.rules_uploader
+    if rules_file is not None:
+        st.session_state.rules_text = rules_file.getvalue().decode('utf-8-sig')
+
+def load_rule_preset():
+    st.session_state.rules_text = RULE_PRESET_TEXTS[st.session_state.rules_preset]
+
+def show_rules_editor():
+    # Правила хранятся в сессии; один и тот же текст компилируется один раз (compile_rule_set)
+    st.file_uploader("Файл правил (JSON или YAML)", type=['json', 'yaml', 'yml'],
+                     key="rules_uploader", on_change=load_rules_file)
+    st.text_area("Правила", height=300, key="rules_text",
+                 help="Условие (when) - выражение над метриками (orders, leads, spent, conversion, cpo, cpl, "
+                      "revenue, avg_check, roi, profit, romi), границами интервалов (conversion_low, conversion_high, "
+                      "conversion_post, cpo_low, cpo_high, roi_low, roi_high), средними (avg_conversion, avg_roi, avg_cpo, avg_leads) "
+                      "и показателями <показатель>_<метрика>: count, mean, median, trimmed, q10, q25, q75, q90, mad, "
+                      "wmean, wmedian (например, cpo > median_cpo + 3 * mad_cpo)")
+    preset = st.selectbox("Встроенный набор", list(RULE_PRESETS), format_func=lambda name: RULE_PRESETS[name][0],
+                          key="rules_preset")
+    st.button("↩️ Загрузить набор", on_click=load_rule_preset, use_container_width=True)
+    if RULE_PRESETS[preset][1]:
+        st.caption(f"Рекомендации отличаются от набора по умолчанию: {RULE_PRESETS[preset][1]}")
+    try:
+        rules = compile_rule_set(st.session_state.rules_text)
+    except RuleSetError as e:
+        st.error(str(e))
+        return None
+    st.caption(f"Правил: {len(rules.rules)}")
+    return rules
+
+# Фоновые задачи анализа: состояние опрашивается раз в JOB_POLL_SECONDS; ID задачи хранится в адресе страницы,
+# чтобы после переподключения браузера (новая сессия) вернуться к идущему или готовому анализу
+JOB_POLL_SECONDS = 0.5
+streamlit_fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+
+def get_job_param():
+    if hasattr(st, 'query_params'):
+        return st.query_params.get('job')
+    return (st.experimental_get_query_params().get('job') or [None])[0]
+
+def set_job_param(job_id):
+    if hasattr(st, 'query_params'):
+        if job_id is None:
+            st.query_params.pop('job', None)
+        else:
+            st.query_params['job'] = job_id
     else:
-        if row['Конверсия, %'] == 0:
-            recommendations.append("УДАЛИТЬ - нулевая конверсия")
-        elif row['Конверсия, %'] < avg_conversion * 0.5:
-            recommendations.append("ОПТИМИЗИРОВАТЬ - конверсия ниже среднего")
-        
-        if row['Конверсия, %'] > 30:
-            recommendations.append("МАСШТАБИРОВАТЬ - высокая конверсия")
-        
-        if row['Лиды'] > avg_leads * 2 and row['Конверсия, %'] > avg_conversion:
-            recommendations.append("МАСШТАБИРОВАТЬ - много лидов и хорошая конверсия")
-    
-    if row['CPO, ₽'] > avg_cpo * 3 and row['CPO, ₽'] > 0:
-        recommendations.append("ОПТИМИЗИРОВАТЬ - высокая стоимость заказа")
-    
-    if row['Лиды'] < 10 and row['Количество заказов'] == 0:
-        recommendations.append("ТЕСТИРОВАТЬ - мало данных")
-    
-    if not recommendations:
-        recommendations.append("НАБЛЮДАТЬ - стабильные показатели")
-    
-    return "; ".join(recommendations)
+        st.experimental_set_query_params(**({'job': job_id} if job_id else {}))
+
+def reattach_job():
+    # Новая сессия с ID задачи в адресе: задача продолжается (или уже готова) - показываем ее
+    job_id = get_job_param()
+    if st.session_state.job_id is not None or not job_id:
+        return
+    job = get_analysis_manager().job_status(job_id)
+    if job is None or job['status'] == JOB_CANCELLED:
+        set_job_param(None)
+        return
+    get_analysis_manager().join(job_id, st.session_state.session_id)
+    st.session_state.job_id = job_id
+    st.session_state.analysis_key = job['key']
+    st.session_state.analysis_done = True
+
+def cancel_analysis_job(job_id):
+    # Тот же анализ могут ждать другие сессии - тогда он продолжается, и эта сессия по-прежнему ждет результат
+    if not get_analysis_manager().cancel(job_id, st.session_state.session_id):
+        st.session_state.cancel_pending = job_id
+        return
+    st.session_state.job_id = None
+    st.session_state.analysis_key = None
+    st.session_state.analysis_done = False
+    set_job_param(None)
+
+def job_progress_panel(job_id):
+    job = get_analysis_manager().job_status(job_id)
+    if job is None or job['status'] in JOB_FINISHED or st.session_state.job_id != job_id:
+        st.rerun()
+    if job['status'] == JOB_QUEUED:
+        st.info(
+            f"Анализ в очереди: позиция {job['position'] or 1} "
+            f"(одновременно выполняется не больше {get_analysis_manager().max_running})"
+        )
+    st.progress(job['percent'], text=job['text'] or "Ожидание начала анализа...")
+    if st.session_state.get('cancel_pending') == job_id:
+        st.info("Этот же анализ ждут другие сессии - он будет остановлен, когда его отменят и они")
+    else:
+        st.button("⏹️ Отменить анализ", on_click=cancel_analysis_job, args=(job_id,))
+
+if streamlit_fragment is not None:
+    job_progress_panel = streamlit_fragment(run_every=JOB_POLL_SECONDS)(job_progress_panel)
+
+def follow_analysis_job(job_id):
+    # Результат готовой задачи; пока задача идет - прогресс и остановка скрипта
+    analysis_manager = get_analysis_manager()
+    job = analysis_manager.job_status(job_id)
+    if job is None or job['status'] == JOB_CANCELLED:
+        return None
+    if job['status'] == JOB_DONE:
+        return analysis_manager.get(job['key'], st.session_state.session_id)
+    if job['status'] == JOB_ERROR:
+        error = job['error']
+        if isinstance(error, MissingColumnsError):
+            st.error(str(error))
+            if error.resolutions is not None:
+                st.markdown("Укажите, в каких столбцах находятся нужные данные:")
+                show_column_mapping_editor(error.resolutions)
+        else:
+            st.error(f"Произошла ошибка при анализе: {str(error)}")
+        st.stop()
+
+    job_progress_panel(job_id)
+    if streamlit_fragment is None:
+        # Без фрагментов (streamlit < 1.33) страница опрашивает задачу перезапуском скрипта
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+    st.stop()
+
+def update_shared_analysis():
+    # Блокировка записи в открытый результат: он общий для всех сессий с теми же файлами и настройками
+    return get_analysis_manager().updating(st.session_state.analysis_key)
+
+def show_table_page(analysis, frame_key):
+    # В браузер отправляется только видимая страница таблицы
+    total_rows = analysis['category_totals'][frame_key]['rows']
+    columns = list(analysis[frame_key].columns)
 
-def create_excel_report(result_sorted, delete_ads, scale_ads, optimize_ads, summary_stats):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        result_sorted.to_excel(writer, sheet_name='Все объявления с рекомендациями', index=False)
-        if delete_ads is not None and not delete_ads.empty:
-            delete_ads.to_excel(writer, sheet_name='УДАЛИТЬ', index=False)
-        if scale_ads is not None and not scale_ads.empty:
-            scale_ads.to_excel(writer, sheet_name='МАСШТАБИРОВАТЬ', index=False)
-        if optimize_ads is not None and not optimize_ads.empty:
-            optimize_ads.to_excel(writer, sheet_name='ОПТИМИЗИРОВАТЬ', index=False)
-    output.seek(0)
-    return output
+    col_sort, col_order, col_size, col_page = st.columns([3, 2, 2, 2])
+    with col_sort:
+        sort_column = st.selectbox("Сортировка", [None] + columns,
+                                   format_func=lambda col: "Как в отчете" if col is None else col,
+                                   key=f"{frame_key}_sort_column")
+    with col_order:
+        ascending = st.radio("Порядок", ["По убыванию", "По возрастанию"], horizontal=True,
+                             key=f"{frame_key}_sort_order") == "По возрастанию"
+    with col_size:
+        page_size = st.selectbox("Строк на странице", TABLE_PAGE_SIZES, key=f"{frame_key}_page_size")
+
+    page_count = max(1, math.ceil(total_rows / page_size))
+    page_key = f"{frame_key}_page"
+    # После смены размера страницы или нового анализа номер страницы может выйти за пределы
+    if st.session_state.get(page_key, 1) > page_count:
+        st.session_state[page_key] = page_count
+    with col_page:
+        page = st.number_input(f"Страница (из {page_count})", min_value=1, max_value=page_count, step=1, key=page_key)
+
+    page_data = table_page(analysis, frame_key, page - 1, page_size, sort_column, ascending, update_shared_analysis)
+    st.dataframe(page_data, use_container_width=True)
+    first_row = (page - 1) * page_size
+    st.caption(f"Строки {min(first_row + 1, total_rows)}–{first_row + len(page_data)} из {total_rows}")
+
+reattach_job()
 
 # Сайдбар для загрузки файлов
 with st.sidebar:
@@ -200,6 +335,18 @@ with st.sidebar:
                                    type=['csv', 'xlsx', 'xls'],
                                    key="crm_uploader")
     
+    crm_streaming = st.checkbox("Потоковое чтение CRM (большие CSV)",
+                                help="CSV читается частями, в памяти хранятся только агрегаты по объявлениям",
+                                key="crm_streaming")
+    excel_engine = st.selectbox("Движок чтения Excel", EXCEL_ENGINES,
+                                help="auto - calamine, если установлен, иначе openpyxl",
+                                key="excel_engine")
+    account = st.text_input("Кабинет", value=DEFAULT_ACCOUNT, key="account",
+                            help="под этим названием результат сохраняется в истории анализов").strip() or DEFAULT_ACCOUNT
+    
+    with st.expander("⚙️ Правила рекомендаций"):
+        rule_set = show_rules_editor()
+    
     st.markdown("---")
     
     if st.button("🚀 Запустить анализ", type="primary", use_container_width=True):
@@ -209,6 +356,16 @@ with st.sidebar:
         else:
             st.error("Пожалуйста, загрузите оба файла")
     
+    # Нагрузка на сервер: сколько анализов выполняется и ждет, сколько памяти занято результатами
+    server_stats = get_analysis_manager().stats()
+    st.caption(
+        f"Сервер: выполняется {server_stats['running']} из {server_stats['max_running']}, "
+        f"в очереди {server_stats['queued']}, результаты {server_stats['memory_mb']:.0f} "
+        f"из {server_stats['budget_mb']:.0f} МБ"
+    )
+    session_memory_mb = get_analysis_manager().session_memory(st.session_state.session_id) / 2**20
+    st.caption(f"Эта сессия: {session_memory_mb:.0f} из {server_stats['session_budget_mb']:.0f} МБ")
+    
     st.markdown("---")
     st.markdown("### ℹ️ О программе")
     st.markdown("""
@@ -250,204 +407,101 @@ if not st.session_state.analysis_done:
             st.dataframe(example_crm)
     
 else:
-    # Запуск анализа
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    try:
-        # Чтение файлов
-        status_text.text("Чтение файлов...")
-        progress_bar.progress(10)
-        
-        if uploaded_ads.name.endswith('.csv'):
-            ads_data = pd.read_csv(uploaded_ads)
-        else:
-            ads_data = pd.read_excel(uploaded_ads)
-            
-        if uploaded_crm.name.endswith('.csv'):
-            crm_data = pd.read_csv(uploaded_crm)
-        else:
-            crm_data = pd.read_excel(uploaded_crm)
-        
-        # Нормализация названий столбцов
-        status_text.text("Обработка данных...")
-        progress_bar.progress(20)
-        
-        ads_data = normalize_column_names(ads_data)
-        crm_data = normalize_column_names(crm_data)
-        
-        # Поиск столбцов
-        ads_columns_mapping = {
-            'id': ['ID объявления', 'ID', 'Ad ID', 'AdID', 'ID рекламы', 'ID кампании'],
-            'leads': ['Результат', 'Лиды', 'Leads', 'Клики', 'Clicks', 'Конверсии'],
-            'cost_per_lead': ['Цена за результат, ₽', 'Цена за результат', 'Cost per Result', 'CPL', 'Цена за лид'],
-            'spent': ['Потрачено всего, ₽', 'Потрачено', 'Затраты', 'Spent', 'Cost', 'Расходы']
-        }
-        
-        crm_columns_mapping = {
-            'clients': ['Клиенты', 'Клиент', 'Client', 'Customers', 'Заказчики'],
-            'id': ['ID объявления', 'ID', 'Ad ID', 'AdID', 'ID рекламы', 'Источник'],
-            'revenue': ['Сумма заказов', 'Сумма заказа', 'Сумма', 'Заказ', 'Revenue', 'Выручка', 'Amount']
-        }
-        
-        ads_actual_columns = {}
-        crm_actual_columns = {}
-        
-        for key, possible_names in ads_columns_mapping.items():
-            found_col = find_column(ads_data, possible_names)
-            if found_col:
-                ads_actual_columns[key] = found_col
-        
-        for key, possible_names in crm_columns_mapping.items():
-            found_col = find_column(crm_data, possible_names)
-            if found_col:
-                crm_actual_columns[key] = found_col
-        
-        # Проверка обязательных столбцов
-        required_ads = ['id', 'leads', 'spent']
-        required_crm = ['id', 'clients']
-        
-        missing_ads = [col for col in required_ads if col not in ads_actual_columns]
-        missing_crm = [col for col in required_crm if col not in crm_actual_columns]
-        
-        if missing_ads or missing_crm:
-            st.error(f"Отсутствуют обязательные столбцы: {missing_ads + missing_crm}")
-            st.stop()
-        
-        has_revenue_data = 'revenue' in crm_actual_columns
-        
-        # Подготовка данных
-        status_text.text("Подготовка данных...")
-        progress_bar.progress(40)
-        
-        ads_rename_dict = {v: k for k, v in ads_actual_columns.items()}
-        crm_rename_dict = {v: k for k, v in crm_actual_columns.items()}
-        
-        ads_data_clean = ads_data.rename(columns=ads_rename_dict)
-        crm_data_clean = crm_data.rename(columns=crm_rename_dict)
-        
-        # Классификация источников
-        crm_data_clean['Тип источника'] = crm_data_clean['id'].apply(classify_source)
-        crm_reklama = crm_data_clean[crm_data_clean['Тип источника'] == 'Рекламное объявление'].copy()
-        crm_drugoe = crm_data_clean[crm_data_clean['Тип источника'] == 'Другое'].copy()
-        
-        # Агрегация рекламных данных
-        status_text.text("Анализ данных...")
-        progress_bar.progress(60)
-        
-        agg_dict = {'leads': 'sum', 'spent': 'sum'}
-        if 'cost_per_lead' in ads_data_clean.columns:
-            agg_dict['cost_per_lead'] = 'mean'
-        
-        ads_aggregated = ads_data_clean.groupby('id', as_index=False).agg(agg_dict)
-        
-        # Агрегация CRM данных
-        if has_revenue_data:
-            crm_reklama_agg = crm_reklama.groupby('id').agg({
-                'clients': 'count',
-                'revenue': ['sum', 'mean']
-            }).round(2)
-            crm_reklama_agg.columns = ['Количество заказов', 'Общая выручка', 'Средний чек']
-            crm_reklama_agg = crm_reklama_agg.reset_index()
-        else:
-            orders_count_reklama = crm_reklama.groupby('id').size().reset_index(name='Количество заказов')
-            crm_reklama_agg = orders_count_reklama
-        
-        # Объединение данных
-        merged_data = pd.merge(ads_aggregated, crm_reklama_agg, on='id', how='left')
-        
-        if has_revenue_data:
-            merged_data['Количество заказов'] = merged_data['Количество заказов'].fillna(0).astype(int)
-            merged_data['Общая выручка'] = merged_data['Общая выручка'].fillna(0)
-            merged_data['Средний чек'] = merged_data['Средний чек'].fillna(0)
-        else:
-            merged_data['Количество заказов'] = merged_data['Количество заказов'].fillna(0).astype(int)
-        
-        # Расчет метрик
-        merged_data['Конверсия, %'] = (merged_data['Количество заказов'] / merged_data['leads'] * 100).round(2)
-        merged_data['CPO, ₽'] = (merged_data['spent'] / merged_data['Количество заказов'])
-        merged_data['CPO, ₽'] = merged_data['CPO, ₽'].replace([float('inf'), -float('inf')], 0).round(2)
-        merged_data['CPL, ₽'] = (merged_data['spent'] / merged_data['leads']).round(2)
-        
-        if has_revenue_data:
-            merged_data['ROI, %'] = ((merged_data['Общая выручка'] - merged_data['spent']) / merged_data['spent'] * 100).round(2)
-            merged_data['Прибыль'] = (merged_data['Общая выручка'] - merged_data['spent']).round(2)
-            merged_data['ROMI'] = (merged_data['Общая выручка'] / merged_data['spent']).round(2)
-        
-        # Переименование для вывода
-        output_columns_rename = {'id': 'ID объявления', 'leads': 'Лиды', 'spent': 'Затраты, ₽'}
-        if 'cost_per_lead' in ads_data_clean.columns:
-            output_columns_rename['cost_per_lead'] = 'Цена за лид, ₽'
-        
-        merged_data_output = merged_data.rename(columns=output_columns_rename)
-        
-        # Определение рекомендаций
-        status_text.text("Формирование рекомендаций...")
-        progress_bar.progress(80)
-        
-        if has_revenue_data:
-            avg_roi = merged_data_output[merged_data_output['ROI, %'] != 0]['ROI, %'].mean()
-        else:
-            avg_roi = 0
-        
-        avg_conversion = merged_data_output[merged_data_output['Конверсия, %'] != 0]['Конверсия, %'].mean()
-        avg_cpo = merged_data_output[(merged_data_output['CPO, ₽'] != 0) & (merged_data_output['CPO, ₽'] < 100000)]['CPO, ₽'].mean()
-        avg_leads = merged_data_output['Лиды'].mean()
-        
-        merged_data_output['Рекомендация'] = merged_data_output.apply(
-            lambda row: determine_recommendation(row, has_revenue_data, avg_conversion, avg_roi, avg_cpo, avg_leads), 
-            axis=1
-        )
-        
-        # Создание категорий
-        delete_ads = merged_data_output[merged_data_output['Рекомендация'].str.contains('УДАЛИТЬ')].copy()
-        scale_ads = merged_data_output[merged_data_output['Рекомендация'].str.contains('МАСШТАБИРОВАТЬ')].copy()
-        optimize_ads = merged_data_output[merged_data_output['Рекомендация'].str.contains('ОПТИМИЗИРОВАТЬ')].copy()
-        
-        # Сортировка
-        if has_revenue_data:
-            sort_columns = ['ROI, %', 'Конверсия, %']
-        else:
-            sort_columns = ['Конверсия, %']
-        
-        result_sorted = merged_data_output.sort_values(sort_columns, ascending=[False, False])
-        
-        # Расчет статистики
-        total_leads = ads_aggregated['leads'].sum()
-        total_orders_reklama = crm_reklama_agg['Количество заказов'].sum() if has_revenue_data else orders_count_reklama['Количество заказов'].sum()
-        total_orders_drugoe = len(crm_drugoe)
-        total_spent = ads_aggregated['spent'].sum()
-        
-        avg_conversion_reklama = (total_orders_reklama / total_leads * 100) if total_leads > 0 else 0
-        
-        if has_revenue_data:
-            total_revenue_reklama = crm_reklama_agg['Общая выручка'].sum()
-            total_profit_reklama = total_revenue_reklama - total_spent
-            overall_roi_reklama = (total_profit_reklama / total_spent * 100) if total_spent > 0 else 0
-        
-        # Сохранение в session state
-        st.session_state.result_sorted = result_sorted
-        st.session_state.delete_ads = delete_ads
-        st.session_state.scale_ads = scale_ads
-        st.session_state.optimize_ads = optimize_ads
-        st.session_state.summary_stats = {
-            'total_leads': total_leads,
-            'total_orders_reklama': total_orders_reklama,
-            'total_orders_drugoe': total_orders_drugoe,
-            'total_spent': total_spent,
-            'avg_conversion_reklama': avg_conversion_reklama,
-            'has_revenue_data': has_revenue_data,
-            'total_revenue_reklama': total_revenue_reklama if has_revenue_data else 0,
-            'total_profit_reklama': total_profit_reklama if has_revenue_data else 0,
-            'overall_roi_reklama': overall_roi_reklama if has_revenue_data else 0
+    # Запуск анализа (результат берется из общего кэша, если эти же файлы с теми же настройками уже анализировались)
+    analysis_manager = get_analysis_manager()
+    session_id = st.session_state.session_id
+    analysis_manager.touch(session_id)
+    analysis = None
+
+    if rule_set is None:
+        st.error("Исправьте ошибку в правилах рекомендаций")
+        st.stop()
+
+    if uploaded_ads is not None and uploaded_crm is not None:
+        ads_bytes = uploaded_ads.getvalue()
+        crm_bytes = uploaded_crm.getvalue()
+        mapping_registry = get_mapping_registry()
+        analysis_options = {
+            'crm_chunksize': CRM_CSV_CHUNK_SIZE if crm_streaming else None,
+            'excel_engine': excel_engine,
+            'column_overrides': st.session_state.column_overrides,
+            'rules': st.session_state.rules_text,
+            'account': account
         }
-        
-        status_text.text("Анализ завершен!")
-        progress_bar.progress(100)
-        
-    except Exception as e:
-        st.error(f"Произошла ошибка при анализе: {str(e)}")
+        analysis_key = compute_analysis_key(ads_bytes, crm_bytes, ads_columns_mapping, crm_columns_mapping, analysis_options)
+        analysis = analysis_manager.get(analysis_key, session_id)
+        # Сопоставление столбцов зависит еще и от реестра: результат пересчитывается, только если для
+        # заголовков этих файлов в реестре подтверждено другое сопоставление
+        if analysis is not None and any(
+            registry_changed(resolution, mapping_registry) for resolution in analysis['data_info']['column_mapping'].values()
+        ):
+            analysis = None
+
+        if analysis is None:
+            job = analysis_manager.job_status(st.session_state.job_id) if st.session_state.job_id else None
+            # Новая задача - если файлы или настройки изменились, а также если готовый результат уже вытеснен
+            if job is None or job['key'] != analysis_key or job['status'] in (JOB_DONE, JOB_CANCELLED):
+                ads_name = uploaded_ads.name
+                crm_name = uploaded_crm.name
+                column_overrides = st.session_state.column_overrides
+                history = get_analysis_history()
+
+                # Выполняется в фоновом потоке - session_state там недоступен, все нужное передается заранее
+                def compute(progress_callback):
+                    result = run_analysis_pipeline(
+                        ads_bytes, ads_name,
+                        crm_bytes, crm_name,
+                        ads_columns_mapping, crm_columns_mapping,
+                        crm_chunksize=analysis_options['crm_chunksize'],
+                        excel_engine=analysis_options['excel_engine'],
+                        cache_dir=INPUT_CACHE_DIR,
+                        registry=mapping_registry,
+                        column_overrides=column_overrides,
+                        rules=rule_set,
+                        progress_callback=progress_callback
+                    )
+                    # Графики и входные данные симулятора бюджета - здесь, пока результат не стал общим для сессий
+                    analysis_figures(result)
+                    budget_inputs(result)
+                    # Каждый анализ дописывается в историю; ошибка записи не мешает показать результат
+                    try:
+                        history.record(result, account, analysis_key=analysis_key)
+                    except sqlite3.Error as e:
+                        result['history_error'] = str(e)
+                    return result
+
+                try:
+                    st.session_state.job_id = analysis_manager.submit(
+                        analysis_key, session_id, compute, len(ads_bytes) + len(crm_bytes)
+                    )
+                    set_job_param(st.session_state.job_id)
+                except SessionMemoryExceeded as e:
+                    # Пока идет прежний анализ сессии, показываются его ход и кнопка отмены
+                    st.warning(str(e))
+                    if job is None or job['status'] in JOB_FINISHED:
+                        st.stop()
+
+        st.session_state.analysis_key = analysis_key
+    elif st.session_state.analysis_key is not None:
+        analysis = analysis_manager.get(st.session_state.analysis_key, session_id)
+
+    if analysis is None and st.session_state.job_id is not None:
+        analysis = follow_analysis_job(st.session_state.job_id)
+
+    if analysis is None:
+        st.error("Пожалуйста, загрузите оба файла")
         st.stop()
+
+    summary_stats = analysis['summary_stats']
+    data_info = analysis['data_info']
+    
+    # Сопоставление столбцов: найденные по похожему названию нужно проверить
+    column_mapping = data_info['column_mapping']
+    mapping_unconfirmed = any(needs_confirmation(resolution) for resolution in column_mapping.values())
+    if mapping_unconfirmed:
+        st.warning("Часть столбцов найдена по похожему названию - проверьте сопоставление и подтвердите его")
+    with st.expander("🔗 Сопоставление столбцов", expanded=mapping_unconfirmed):
+        show_column_mapping_editor(column_mapping)
     
     # Отображение результатов
     st.markdown('<h2 class="sub-header">📈 Результаты анализа</h2>', unsafe_allow_html=True)
@@ -457,49 +511,57 @@ else:
     
     with col1:
         st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-        st.metric("Всего лидов", f"{st.session_state.summary_stats['total_leads']:,}")
+        st.metric("Всего лидов", f"{summary_stats['total_leads']:,}")
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col2:
         st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-        st.metric("Заказов из рекламы", f"{st.session_state.summary_stats['total_orders_reklama']:,}")
+        st.metric("Заказов из рекламы", f"{summary_stats['total_orders_reklama']:,}")
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col3:
         st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-        st.metric("Общие затраты", f"{st.session_state.summary_stats['total_spent']:,.0f} ₽")
+        st.metric("Общие затраты", f"{summary_stats['total_spent']:,.0f} ₽")
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col4:
         st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-        st.metric("Конверсия", f"{st.session_state.summary_stats['avg_conversion_reklama']:.1f}%")
+        st.metric("Конверсия", f"{summary_stats['avg_conversion_reklama']:.1f}%")
         st.markdown('</div>', unsafe_allow_html=True)
     
-    if st.session_state.summary_stats['has_revenue_data']:
+    if summary_stats['has_revenue_data']:
         col5, col6, col7 = st.columns(3)
         
         with col5:
             st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-            st.metric("Общая выручка", f"{st.session_state.summary_stats['total_revenue_reklama']:,.0f} ₽")
+            st.metric("Общая выручка", f"{summary_stats['total_revenue_reklama']:,.0f} ₽")
             st.markdown('</div>', unsafe_allow_html=True)
         
         with col6:
             st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-            st.metric("Прибыль", f"{st.session_state.summary_stats['total_profit_reklama']:,.0f} ₽")
+            st.metric("Прибыль", f"{summary_stats['total_profit_reklama']:,.0f} ₽")
             st.markdown('</div>', unsafe_allow_html=True)
         
         with col7:
             st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-            st.metric("Общий ROI", f"{st.session_state.summary_stats['overall_roi_reklama']:.1f}%")
+            st.metric("Общий ROI", f"{summary_stats['overall_roi_reklama']:.1f}%")
             st.markdown('</div>', unsafe_allow_html=True)
     
     # Распределение рекомендаций
     st.markdown('<h3 class="sub-header">🎯 Распределение рекомендаций</h3>', unsafe_allow_html=True)
     
-    total_ads = len(st.session_state.result_sorted)
-    delete_count = len(st.session_state.delete_ads) if st.session_state.delete_ads is not None else 0
-    scale_count = len(st.session_state.scale_ads) if st.session_state.scale_ads is not None else 0
-    optimize_count = len(st.session_state.optimize_ads) if st.session_state.optimize_ads is not None else 0
+    # Встроенный набор, рекомендации которого отличаются от набора по умолчанию, называется явно
+    rules_preset = next((name for name, text in RULE_PRESET_TEXTS.items() if text == st.session_state.rules_text), None)
+    if rules_preset is None:
+        st.info("ℹ️ Рекомендации рассчитаны по измененному набору правил")
+    elif RULE_PRESETS[rules_preset][1]:
+        st.info(f"ℹ️ Набор правил «{RULE_PRESETS[rules_preset][0]}», рекомендации отличаются от набора по умолчанию: "
+                f"{RULE_PRESETS[rules_preset][1]}")
+    
+    total_ads = analysis['category_totals']['result_sorted']['rows']
+    delete_count = analysis['category_totals']['delete_ads']['rows']
+    scale_count = analysis['category_totals']['scale_ads']['rows']
+    optimize_count = analysis['category_totals']['optimize_ads']['rows']
     other_count = total_ads - delete_count - scale_count - optimize_count
     
     cols = st.columns(4)
@@ -532,40 +594,113 @@ else:
         st.markdown(f"({other_count/total_ads*100:.1f}%)")
         st.markdown('</div>', unsafe_allow_html=True)
     
+    # Графики строятся по агрегированным данным и кэшируются вместе с результатом анализа
+    st.markdown('<h3 class="sub-header">📉 Графики</h3>', unsafe_allow_html=True)
+    
+    figures = analysis_figures(analysis)
+    chart_tab1, chart_tab2, chart_tab3 = st.tabs(["Затраты и эффективность", "Концентрация затрат", "Рекомендации"])
+    
+    with chart_tab1:
+        st.plotly_chart(figures['scatter'], use_container_width=True)
+    
+    with chart_tab2:
+        st.plotly_chart(figures['pareto'], use_container_width=True)
+    
+    with chart_tab3:
+        st.plotly_chart(figures['distribution'], use_container_width=True)
+    
+    # Динамика по датам - если даты есть в обеих выгрузках
+    if analysis.get('timeseries') is not None:
+        st.markdown('<h3 class="sub-header">📅 Динамика</h3>', unsafe_allow_html=True)
+        
+        first_date, last_date = timeseries_date_range(analysis['timeseries'])
+        col_range, col_freq, col_rolling = st.columns([4, 2, 2])
+        
+        with col_range:
+            if first_date < last_date:
+                # Ключ зависит от границ: после загрузки других файлов слайдер начинается заново
+                date_range = st.slider("Период", min_value=first_date.date(), max_value=last_date.date(),
+                                       value=(first_date.date(), last_date.date()), format="DD.MM.YYYY",
+                                       key=f"timeseries_range_{first_date:%Y%m%d}_{last_date:%Y%m%d}")
+            else:
+                date_range = (first_date.date(), last_date.date())
+                st.write(f"Период: {first_date:%d.%m.%Y}")
+        
+        with col_freq:
+            freq = st.selectbox("Группировка", list(TIMESERIES_FREQUENCIES),
+                                format_func=TIMESERIES_FREQUENCIES.get, key="timeseries_freq")
+        
+        with col_rolling:
+            rolling_days = st.number_input("Скользящее окно, дней", min_value=0, max_value=90, value=0,
+                                           help="0 - без скользящего окна; скользящие суммы считаются по дням",
+                                           key="timeseries_rolling")
+        
+        window = timeseries_window(analysis, date_range[0], date_range[1], freq, rolling_days, update_shared_analysis)
+        
+        trend_metrics = ['Конверсия, %', 'CPO, ₽', 'CPL, ₽', 'Затраты, ₽', 'Лиды', 'Количество заказов']
+        if summary_stats['has_revenue_data']:
+            trend_metrics = ['ROI, %', 'ROMI', 'Прибыль'] + trend_metrics
+        trend_metric = st.selectbox("Показатель", trend_metrics, key="timeseries_metric")
+        st.line_chart(window['trend'].set_index('Период')[trend_metric])
+        
+        window_tab1, window_tab2 = st.tabs(["По объявлениям за период", "По объявлениям и периодам"])
+        
+        with window_tab1:
+            show_table_page(window, 'window_ads')
+        
+        with window_tab2:
+            show_table_page(window, 'window_periods')
+    
     # Детальные таблицы
     st.markdown('<h3 class="sub-header">📋 Детальный анализ</h3>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3, tab4 = st.tabs(["Все объявления", "Удалить", "Масштабировать", "Оптимизировать"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Все объявления", "Удалить", "Масштабировать", "Оптимизировать", "Перераспределение бюджета"])
+    
+    category_totals = analysis['category_totals']
+    # Перенос бюджета с параметрами по умолчанию - для оценок во вкладках Удалить и Масштабировать
+    budget_plan = simulate_budget(budget_inputs(analysis))
+    plan_gain = (
+        budget_plan['best']['profit'] - budget_plan['current']['profit'] if summary_stats['has_revenue_data']
+        else budget_plan['best']['value'] - budget_plan['current']['value']
+    )
+    plan_gain_text = f"{plan_gain:+,.0f} ₽ прибыли" if summary_stats['has_revenue_data'] else f"{plan_gain:+,.0f} заказов"
     
     with tab1:
-        st.dataframe(st.session_state.result_sorted, use_container_width=True)
+        st.caption(
+            f"Границы - {CONFIDENCE_LEVEL:.0%} доверительный интервал: у объявлений с малым числом лидов он широкий. "
+            "Сглаженная конверсия приближена к общей тем сильнее, чем меньше лидов"
+        )
+        show_table_page(analysis, 'result_sorted')
     
     with tab2:
-        if st.session_state.delete_ads is not None and not st.session_state.delete_ads.empty:
-            st.dataframe(st.session_state.delete_ads, use_container_width=True)
+        if category_totals['delete_ads']['rows'] > 0:
+            show_table_page(analysis, 'delete_ads')
             
             # Потенциальная экономия
-            if 'Затраты, ₽' in st.session_state.delete_ads.columns:
-                total_spent_delete = st.session_state.delete_ads['Затраты, ₽'].sum()
-                st.info(f"💰 **Потенциальная экономия:** {total_spent_delete:,.0f} ₽")
+            total_spent_delete = category_totals['delete_ads']['spent']
+            st.info(f"💰 **Потенциальная экономия:** {total_spent_delete:,.0f} ₽")
+            if budget_plan['candidates'] > 0:
+                st.info(f"🔁 **При переносе этих затрат на объявления МАСШТАБИРОВАТЬ:** {plan_gain_text} "
+                        f"(см. вкладку «Перераспределение бюджета»)")
         else:
             st.success("🎉 Нет объявлений для удаления!")
     
     with tab3:
-        if st.session_state.scale_ads is not None and not st.session_state.scale_ads.empty:
-            st.dataframe(st.session_state.scale_ads, use_container_width=True)
+        if category_totals['scale_ads']['rows'] > 0:
+            show_table_page(analysis, 'scale_ads')
             
             # Потенциальная прибыль
-            if st.session_state.summary_stats['has_revenue_data'] and 'Прибыль' in st.session_state.scale_ads.columns:
-                total_profit_scale = st.session_state.scale_ads['Прибыль'].sum()
+            if summary_stats['has_revenue_data']:
+                total_profit_scale = category_totals['scale_ads']['profit']
                 st.success(f"🚀 **Текущая прибыль:** {total_profit_scale:,.0f} ₽")
-                st.success(f"📈 **Потенциальная прибыль (+50%):** {total_profit_scale * 1.5:,.0f} ₽")
+            # Оценка с убывающей отдачей и пределом роста затрат объявления
+            st.success(f"📈 **Прирост при перераспределении бюджета:** {plan_gain_text}")
         else:
             st.warning("🤔 Нет объявлений для масштабирования")
     
     with tab4:
-        if st.session_state.optimize_ads is not None and not st.session_state.optimize_ads.empty:
-            st.dataframe(st.session_state.optimize_ads, use_container_width=True)
+        if category_totals['optimize_ads']['rows'] > 0:
+            show_table_page(analysis, 'optimize_ads')
             
             # Советы по оптимизации
             st.info("""
@@ -578,37 +713,120 @@ else:
         else:
             st.success("🎉 Нет объявлений для оптимизации!")
     
+    with tab5:
+        col1, col2 = st.columns(2)
+        with col1:
+            budget_percent = st.slider("Общий бюджет, % от текущих затрат", 50, 200, 100, step=5, key="budget_percent")
+            elasticity = st.slider("Эластичность отдачи", 0.1, 1.0, DEFAULT_ELASTICITY, step=0.05, key="budget_elasticity",
+                                   help="1 - отдача растет пропорционально затратам; чем меньше, тем меньше приносит каждый следующий рубль")
+        with col2:
+            max_multiplier = st.slider("Предел роста затрат объявления, раз", 1.0, 5.0, MAX_SPEND_MULTIPLIER, step=0.5,
+                                       key="budget_max_multiplier")
+            drop_delete = st.checkbox("Отключить объявления УДАЛИТЬ", value=True, key="budget_drop_delete")
+            scale_only = st.checkbox("Переносить бюджет только на объявления МАСШТАБИРОВАТЬ", value=True, key="budget_scale_only",
+                                     help="Иначе бюджет распределяется между всеми объявлениями с заказами")
+        
+        plan = simulate_budget(
+            budget_inputs(analysis), budget_plan['current']['spend'] * budget_percent / 100,
+            elasticity, max_multiplier, drop_delete, scale_only
+        )
+        if plan['candidates'] == 0:
+            st.warning("🤔 Нет объявлений, на которые можно перенести бюджет")
+        else:
+            current, best = plan['current'], plan['best']
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Затраты", f"{best['spend']:,.0f} ₽", f"{best['spend'] - current['spend']:+,.0f} ₽")
+            with col2:
+                value_unit = " ₽" if plan['has_revenue_data'] else ""
+                st.metric(plan['value_label'], f"{best['value']:,.0f}{value_unit}", f"{best['value'] - current['value']:+,.0f}{value_unit}")
+            if plan['has_revenue_data']:
+                with col3:
+                    st.metric("Прибыль", f"{best['profit']:,.0f} ₽", f"{best['profit'] - current['profit']:+,.0f} ₽")
+            st.caption(
+                f"Лучший из {plan['scenarios']:,} сценариев: перенесено {best['moved']:,.0f} ₽ на {plan['candidates']:,} объявлений, "
+                f"отключено объявлений: {plan['removed']:,}, наклон распределения {best['tilt']:.1f} "
+                f"(0 - пропорционально текущим затратам, больше - в пользу самых окупаемых)"
+            )
+            
+            # Лучший результат при каждом уровне затрат: видно, с какого бюджета дополнительные вложения не окупаются
+            frontier_metric = 'Прибыль' if plan['has_revenue_data'] else plan['value_label']
+            st.line_chart(plan['frontier'].set_index('Затраты, ₽')[frontier_metric])
+            
+            allocation = plan['allocation']
+            st.dataframe(allocation.head(TABLE_PAGE_SIZES[-1]), use_container_width=True)
+            if len(allocation) > TABLE_PAGE_SIZES[-1]:
+                st.caption(f"Показаны {TABLE_PAGE_SIZES[-1]} объявлений с наибольшим ростом затрат из {len(allocation):,}")
+    
     # Экспорт результатов
     st.markdown('<h3 class="sub-header">📥 Экспорт результатов</h3>', unsafe_allow_html=True)
     
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     
     with col1:
-        # Создание Excel файла
-        excel_data = create_excel_report(
-            st.session_state.result_sorted,
-            st.session_state.delete_ads,
-            st.session_state.scale_ads,
-            st.session_state.optimize_ads,
-            st.session_state.summary_stats
-        )
-        
-        st.download_button(
-            label="📊 Скачать Excel отчет",
-            data=excel_data,
-            file_name=f"рекламный_анализ_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True
-        )
+        # Excel файл создается только по запросу и хранится вместе с результатом анализа
+        excel_data = analysis.get('excel_report')
+        if excel_data is None:
+            if st.button("📊 Сформировать Excel отчет", use_container_width=True):
+                export_profiler = StageProfiler()
+                with st.spinner("Формирование отчета..."), export_profiler.stage('export', 'xlsx'):
+                    excel_data = create_excel_report(
+                        analysis['result_sorted'],
+                        analysis['delete_ads'],
+                        analysis['scale_ads'],
+                        analysis['optimize_ads'],
+                        summary_stats
+                    ).getvalue()
+                with update_shared_analysis():
+                    analysis['excel_report'] = excel_data
+                    analysis['profile'] = analysis['profile'] + export_profiler.records
+        
+        if excel_data is not None:
+            st.download_button(
+                label="📊 Скачать Excel отчет",
+                data=excel_data,
+                file_name=f"рекламный_анализ_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                use_container_width=True
+            )
     
     with col2:
+        # Таблицы результата в Parquet - для загрузки в pandas/BI без разбора Excel
+        parquet_data = analysis.get('parquet_report')
+        if not pyarrow_available():
+            st.caption("Экспорт в Parquet недоступен: не установлен pyarrow")
+        elif parquet_data is None:
+            if st.button("🗂️ Сформировать Parquet", use_container_width=True):
+                export_profiler = StageProfiler()
+                with st.spinner("Формирование файлов..."), export_profiler.stage('export', 'parquet'):
+                    parquet_data = create_parquet_archive(
+                        analysis['result_sorted'],
+                        analysis['delete_ads'],
+                        analysis['scale_ads'],
+                        analysis['optimize_ads']
+                    ).getvalue()
+                with update_shared_analysis():
+                    analysis['parquet_report'] = parquet_data
+                    analysis['profile'] = analysis['profile'] + export_profiler.records
+        
+        if parquet_data is not None:
+            st.download_button(
+                label="🗂️ Скачать Parquet (ZIP)",
+                data=parquet_data,
+                file_name=f"рекламный_анализ_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}_parquet.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
+    
+    with col3:
         if st.button("🔄 Новый анализ", use_container_width=True):
+            # Результат может быть открыт и у других аналитиков - сессия только отказывается от него
+            analysis_manager.release(session_id)
+            set_job_param(None)
+            st.session_state.job_id = None
+            st.session_state.analysis_key = None
+            st.session_state.column_overrides = {}
             st.session_state.analysis_done = False
-            st.session_state.result_sorted = None
-            st.session_state.delete_ads = None
-            st.session_state.scale_ads = None
-            st.session_state.optimize_ads = None
-            st.session_state.summary_stats = None
             st.rerun()
     
     # Информация о данных
@@ -617,15 +835,96 @@ else:
         
         with col1:
             st.markdown("**Рекламные данные:**")
-            st.write(f"- Объявлений: {len(ads_data_clean)}")
-            st.write(f"- Строк: {len(ads_data)}")
-            st.write(f"- Столбцов: {len(ads_data.columns)}")
+            st.write(f"- Объявлений: {data_info['ads_count']}")
+            st.write(f"- Строк: {data_info['ads_rows']}")
+            st.write(f"- Столбцов: {data_info['ads_columns']}")
+            st.write(f"- Формат: {data_info['excel_engines']['ads'] or 'csv'}")
+            st.write(f"- Из кэша Parquet: {'да' if data_info['input_cache']['ads'] else 'нет'}")
+            st.write(f"- Память: {data_info['memory']['ads_before'] / 2**20:.1f} МБ → {data_info['memory']['ads_after'] / 2**20:.1f} МБ")
         
         with col2:
             st.markdown("**CRM данные:**")
-            st.write(f"- Клиентов всего: {len(crm_data)}")
-            st.write(f"- Из рекламы: {len(crm_reklama)}")
-            st.write(f"- Из других источников: {len(crm_drugoe)}")
+            st.write(f"- Клиентов всего: {data_info['crm_rows']}")
+            st.write(f"- Из рекламы: {data_info['crm_reklama_rows']}")
+            st.write(f"- Из других источников: {data_info['crm_drugoe_rows']}")
+            st.write(f"- Формат: {data_info['excel_engines']['crm'] or 'csv'}")
+            st.write(f"- Из кэша Parquet: {'да' if data_info['input_cache']['crm'] else 'нет'}")
+            st.write(f"- Память (из рекламы): {data_info['memory']['crm_before'] / 2**20:.1f} МБ → {data_info['memory']['crm_after'] / 2**20:.1f} МБ")
+        
+        # Сколько источников вида utm_content=... удалось сопоставить с объявлениями кабинета
+        attribution = attribution_report(analysis['attribution'])
+        if attribution is not None and attribution['rows'].sum() > 0:
+            st.markdown("**Атрибуция источников CRM по шаблонам ID:**")
+            st.dataframe(
+                attribution.rename(columns={
+                    'pattern': 'Шаблон', 'rows': 'Строк', 'matched': 'Сопоставлено', 'match_rate': 'Доля, %'
+                }),
+                hide_index=True,
+                use_container_width=True
+            )
+    
+    # Базовые показатели, на которые могут ссылаться пороги правил
+    with st.expander("📐 Базовые показатели"):
+        st.caption("В правилах: <показатель>_<метрика>, например median_cpo, q90_roi, wmean_conversion")
+        st.dataframe(baseline_table(analysis['baseline_stats']).round(2), use_container_width=True)
+    
+    # История анализов кабинета: запросы к локальной базе, без повторного чтения выгрузок
+    with st.expander("🗄️ История анализов"):
+        if analysis.get('history_error'):
+            st.warning(f"Результат не сохранен в историю: {analysis['history_error']}")
+        history = get_analysis_history()
+        history_tabs = st.tabs(["Серии рекомендаций", "Динамика объявления", "Смена рекомендаций", "Сводка по кабинетам"])
+        
+        with history_tabs[0]:
+            col1, col2 = st.columns(2)
+            with col1:
+                streak_category = st.selectbox(
+                    "Рекомендация", list(CATEGORY_BITS),
+                    format_func=lambda key: dict(RECOMMENDATION_CATEGORIES)[key], key="history_streak_category"
+                )
+            with col2:
+                streak_runs = st.number_input("Запусков подряд, не меньше", min_value=1, value=3, step=1, key="history_streak_runs")
+            st.dataframe(history.streaks(streak_category, int(streak_runs), account), hide_index=True, use_container_width=True)
+        
+        with history_tabs[1]:
+            trend_ad = st.text_input("ID объявления", key="history_trend_ad").strip()
+            if trend_ad:
+                trend = history.ad_trend(trend_ad, account)
+                if trend.empty:
+                    st.info("Объявление в истории не найдено")
+                else:
+                    trend_metric = st.selectbox(
+                        "Показатель", [col for col in trend.columns if col not in ('run_at', 'account', 'recommendation')],
+                        key="history_trend_metric"
+                    )
+                    st.line_chart(trend.set_index('run_at')[trend_metric])
+                    st.dataframe(trend, hide_index=True, use_container_width=True)
+        
+        with history_tabs[2]:
+            st.dataframe(history.churn(account), hide_index=True, use_container_width=True)
+        
+        with history_tabs[3]:
+            rollup_period = st.selectbox("Период", [None] + list(ROLLUP_PERIODS),
+                                         format_func=lambda period: "Все запуски" if period is None else period,
+                                         key="history_rollup_period")
+            st.dataframe(history.account_rollup(rollup_period), hide_index=True, use_container_width=True)
+    
+    # Производительность по стадиям конвейера
+    with st.expander("⏱️ Производительность"):
+        profile = pd.DataFrame(analysis['profile'])
+        stage_seconds = profile.groupby('stage', sort=False)['seconds'].sum()
+        st.write(f"Всего: {stage_seconds.sum():.2f} с")
+        st.bar_chart(stage_seconds)
+        st.dataframe(
+            profile.rename(columns={
+                'stage': 'Стадия', 'detail': 'Детали', 'seconds': 'Время, с',
+                'rss_mb': 'Память, МБ', 'rss_delta_mb': 'Изменение памяти, МБ'
+            }),
+            use_container_width=True
+        )
+    
+    # За время показа в результат могли добавиться окна динамики (у кэша окон своя блокировка)
+    analysis_manager.refresh(st.session_state.analysis_key)
     
     # Подвал
     st.markdown("---")